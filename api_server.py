@@ -0,0 +1,493 @@
+"""Headless HTTP API for mail merge jobs (stdlib only).
+
+A long-running process with no per-request script rerun: uploads are
+written to a job folder, the job is queued and run by run_merge() on a
+worker thread, and progress is streamed as Server-Sent Events.
+
+    python api_server.py --port 8765
+
+    # submit (multipart: recipients + template files, optional attachments)
+    curl -F recipients=@recipients.xlsx -F template=@template.html \\
+         -F default_subject="Kết quả - {{Ten}}" -F dry_run=true http://127.0.0.1:8765/jobs
+    # -> 202 {"id": "...", "status": "queued", "events": "/jobs/<id>/events"}
+
+    curl -N http://127.0.0.1:8765/jobs/<id>/events   # SSE progress
+    curl http://127.0.0.1:8765/jobs/<id>             # status + summary
+    curl -X POST http://127.0.0.1:8765/jobs/<id>/cancel
+
+Endpoints: GET /health, GET /jobs, POST /jobs, GET /jobs/<id>,
+GET /jobs/<id>/events, POST /jobs/<id>/cancel.
+
+SMTP settings come from the environment (SMTP_HOST, SMTP_PORT, SMTP_USER,
+SMTP_PASS, SMTP_USE_SSL, FROM_NAME, RATE_DELAY_DEFAULT, ...), never from
+requests. When MAILMERGE_API_TOKEN is set every request needs
+"Authorization: Bearer <token>"; the server refuses to listen on a
+non-loopback address without one. Jobs share SMTP sessions, rate limiters
+and attachment downloads like a campaign manifest (see campaign_manifest).
+
+A job can only attach and embed the files uploaded with it: FilePDF values
+and template images must be relative paths inside the job folder. URL
+attachments are refused unless MAILMERGE_API_ALLOW_URLS=true, since they
+make the server fetch arbitrary addresses.
+"""
+
+import argparse
+import ipaddress
+import itertools
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+from collections import deque
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from send_mail_merge import STATE_DIR, AttachmentCache, RateLimiter, SenderPool, run_merge
+
+API_JOBS_DIR = STATE_DIR / "api_jobs"
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+# Progress events kept per job for SSE clients (older ones are dropped).
+MAX_EVENTS = 2000
+# Finished jobs kept in memory (and on disk) before the oldest are removed.
+MAX_FINISHED_JOBS = 100
+SSE_KEEPALIVE = 15.0
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+# Request fields passed to run_merge, with their type.
+_JOB_FIELDS = {
+    "default_subject": str,
+    "from_name": str,
+    "campaign_id": str,
+    "dry_run": bool,
+    "incremental": bool,
+    "dedupe": bool,
+    "batch_size": int,
+    "max_retries": int,
+}
+_TRUE = {"1", "true", "yes", "y", "on"}
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    v = os.getenv(name)
+    return default if v is None else v.strip().lower() in _TRUE
+
+
+def _env_number(name: str, default, cast):
+    try:
+        return cast(os.getenv(name, "") or default)
+    except ValueError:
+        return default
+
+
+def smtp_settings_from_env() -> dict:
+    """run_merge SMTP/throughput arguments from the same env vars as the apps."""
+    settings = {
+        "smtp_host": os.getenv("SMTP_HOST", ""),
+        "smtp_port": _env_number("SMTP_PORT", 587, int),
+        "smtp_user": os.getenv("SMTP_USER", ""),
+        "smtp_pass": os.getenv("SMTP_PASS", ""),
+        "use_ssl": _env_bool("SMTP_USE_SSL", False),
+        "from_name": os.getenv("FROM_NAME", ""),
+        "rate_delay": _env_number("RATE_DELAY_DEFAULT", 1.5, float),
+        "max_retries": _env_number("MAX_RETRIES_DEFAULT", 0, int),
+        "build_workers": _env_number("BUILD_WORKERS_DEFAULT", 2, int),
+        "connections": _env_number("SMTP_CONNECTIONS_DEFAULT", 1, int),
+        "suppression_db": os.getenv("SUPPRESSION_DB", "") or str(STATE_DIR / "suppression.sqlite3"),
+        "interleave_domains": _env_bool("INTERLEAVE_DOMAINS_DEFAULT", False),
+        "domain_concurrency": _env_number("DOMAIN_CONCURRENCY_DEFAULT", 0, int),
+        "domain_rate_delay": _env_number("DOMAIN_RATE_DELAY_DEFAULT", 0.0, float),
+        "dkim_domain": os.getenv("DKIM_DOMAIN", "").strip(),
+        "dkim_selector": os.getenv("DKIM_SELECTOR", "").strip(),
+        "dkim_key": os.getenv("DKIM_PRIVATE_KEY", "").strip(),
+    }
+    if os.getenv("DEFAULT_SUBJECT"):
+        settings["default_subject"] = os.getenv("DEFAULT_SUBJECT")
+    return settings
+
+
+class ApiJob:
+    """One submitted merge: parameters, state and a bounded event history."""
+
+    def __init__(self, job_id: str, folder: Path, params: dict):
+        self.id = job_id
+        self.folder = folder
+        self.params = params
+        self.status = JOB_QUEUED
+        self.created_at = time.time()
+        self.finished_at = 0.0
+        self.summary: dict | None = None
+        self.error = ""
+        self.stop = threading.Event()
+        self.cancelled = False  # run_merge also sets stop when it ends
+        self._events: deque = deque(maxlen=MAX_EVENTS)
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def publish(self, kind: str, data: dict) -> None:
+        with self._cond:
+            self._seq += 1
+            self._events.append((self._seq, kind, data))
+            self._cond.notify_all()
+
+    def events_after(self, seq: int, timeout: float) -> tuple[list, bool]:
+        """Events newer than seq (waiting up to timeout) and whether the job ended."""
+        with self._cond:
+            if self._seq <= seq and not self.finished_at:
+                self._cond.wait(timeout)
+            return [e for e in self._events if e[0] > seq], bool(self.finished_at)
+
+    def finish(self, status: str) -> None:
+        with self._cond:
+            self.status = status
+            self.finished_at = time.time()
+            self._cond.notify_all()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at or None,
+            "recipients": Path(self.params["recipients"]).name,
+            "summary": self.summary,
+            "error": self.error,
+            "events": f"/jobs/{self.id}/events",
+        }
+
+
+class JobManager:
+    """Queue of ApiJobs run one at a time (or `workers` at a time) by run_merge."""
+
+    def __init__(self, base_params: dict, jobs_dir=API_JOBS_DIR, workers: int = 1):
+        self.base_params = base_params
+        self.jobs_dir = Path(jobs_dir)
+        self._jobs: dict = {}
+        self._lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+        self.sender_pool = SenderPool()
+        self.attachments = AttachmentCache()
+        self.limiter = RateLimiter(base_params.get("rate_delay", 1.5))
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"api-job-{n}", daemon=True) for n in range(max(1, workers))
+        ]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, files: dict, fields: dict) -> ApiJob:
+        """files: field name -> [(filename, bytes)]; fields: form values."""
+        for required in ("recipients", "template"):
+            if not files.get(required):
+                raise ValueError(f"Thiếu file '{required}'")
+        params = dict(self.base_params)
+        params["dry_run"] = _env_bool("DRY_RUN_DEFAULT", True)
+        for key, cast in _JOB_FIELDS.items():
+            value = str(fields.get(key, "")).strip()
+            if not value:
+                continue
+            try:
+                params[key] = value.lower() in _TRUE if cast is bool else cast(value)
+            except ValueError:
+                raise ValueError(f"Giá trị không hợp lệ cho '{key}': {value}") from None
+        rec_name = Path(files["recipients"][0][0] or "").name
+        if Path(rec_name).suffix.lower() not in (".xlsx", ".xls", ".csv"):
+            raise ValueError("Chỉ hỗ trợ .xlsx, .xls, .csv")
+        if not params["dry_run"] and not (params.get("smtp_host") and params.get("smtp_user") and params.get("smtp_pass")):
+            raise ValueError("Server chưa cấu hình SMTP_HOST/SMTP_USER/SMTP_PASS (chỉ chạy được dry_run)")
+
+        job_id = uuid.uuid4().hex[:12]
+        folder = self.jobs_dir / job_id
+        folder.mkdir(parents=True, exist_ok=True)
+        saved = {}
+        for field, items in files.items():
+            for filename, data in items:
+                name = Path(filename or field).name or field
+                (folder / name).write_bytes(data)
+                saved.setdefault(field, name)
+        params.update(
+            recipients=str(folder / saved["recipients"]),
+            template=str(folder / saved["template"]),
+            base_dir=str(folder),  # FilePDF names refer to uploaded attachments
+            attachment_root=str(folder),
+            allow_attachment_urls=_env_bool("MAILMERGE_API_ALLOW_URLS", False),
+        )
+        job = ApiJob(job_id, folder, params)
+        with self._lock:
+            self._jobs[job_id] = job
+        self._queue.put(job)
+        job.publish("queued", {"id": job_id})
+        return job
+
+    def get(self, job_id: str) -> ApiJob | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> list:
+        with self._lock:
+            return [j.to_dict() for j in sorted(self._jobs.values(), key=lambda j: j.created_at, reverse=True)]
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        if job is None:
+            return False
+        job.cancelled = True
+        job.stop.set()
+        return True
+
+    def _worker(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            self._run(job)
+            self._prune()
+
+    def _run(self, job: ApiJob) -> None:
+        if job.cancelled:
+            job.finish(JOB_CANCELLED)
+            job.publish("end", {"status": job.status})
+            return
+        job.status = JOB_RUNNING
+
+        def on_event(ev) -> None:
+            job.publish(ev.kind, {
+                "total": ev.total, "sent": ev.sent, "failed": ev.failed, "skipped": ev.skipped,
+                "processed": ev.processed, "elapsed": round(ev.elapsed, 3), "row": ev.row_index,
+                "email": ev.email, "detail": ev.detail, "attempt": ev.attempt,
+            })
+
+        try:
+            summary = run_merge(
+                **job.params,
+                progress_callback=lambda line: job.publish("log", {"line": line}),
+                event_callback=on_event,
+                stop_event=job.stop,
+                sender_pool=self.sender_pool,
+                rate_limiter=self.limiter,
+                attachment_cache=self.attachments,
+            )
+        except Exception as exc:
+            job.error = str(exc)
+            job.finish(JOB_FAILED)
+        else:
+            job.summary = {
+                "sent": summary["sent"],
+                "failed": summary["failed"],
+                "skipped": summary["skipped"],
+                "errors": [[email, err] for email, err in itertools.islice(summary["errors"], 200)],
+            }
+            for key in ("capacity", "unchanged"):
+                if key in summary:
+                    job.summary[key] = summary[key]
+            job.finish(JOB_CANCELLED if job.cancelled else JOB_DONE)
+        job.publish("end", {"status": job.status, "summary": job.summary, "error": job.error})
+
+    def _prune(self) -> None:
+        with self._lock:
+            finished = sorted((j for j in self._jobs.values() if j.finished_at), key=lambda j: j.finished_at)
+            old = finished[: max(0, len(finished) - MAX_FINISHED_JOBS)]
+            for job in old:
+                del self._jobs[job.id]
+        for job in old:
+            shutil.rmtree(job.folder, ignore_errors=True)
+
+    def close(self) -> None:
+        for job in list(self._jobs.values()):
+            job.cancelled = True
+            job.stop.set()
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self.sender_pool.close()
+        self.attachments.close()
+
+
+def parse_multipart(content_type: str, body: bytes) -> tuple[dict, dict]:
+    """Split a multipart/form-data body into (files, fields)."""
+    msg = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body)
+    if not msg.is_multipart():
+        raise ValueError("Body phải là multipart/form-data")
+    files: dict = {}
+    fields: dict = {}
+    for part in msg.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if not name:
+            continue
+        payload = part.get_payload(decode=True) or b""
+        filename = part.get_filename()
+        if filename is not None:
+            files.setdefault(name, []).append((filename, payload))
+        else:
+            fields[name] = payload.decode(part.get_content_charset() or "utf-8")
+    return files, fields
+
+
+class _ApiHandler(BaseHTTPRequestHandler):
+    manager: JobManager = None  # set by make_server
+    token: str = ""
+
+    def log_message(self, format, *args):  # keep the console for job output
+        pass
+
+    def _json(self, status: int, payload) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self) -> bool:
+        if not self.token or self.headers.get("Authorization", "") == f"Bearer {self.token}":
+            return True
+        self._json(401, {"error": "Unauthorized"})
+        return False
+
+    def _parts(self) -> list:
+        return [p for p in self.path.split("?", 1)[0].split("/") if p]
+
+    def do_GET(self):  # noqa: N802 (http.server naming)
+        parts = self._parts()
+        if parts == ["health"]:
+            self._json(200, {"status": "ok"})
+            return
+        if not self._authorized():
+            return
+        if parts == ["jobs"]:
+            self._json(200, self.manager.list())
+            return
+        job = self.manager.get(parts[1]) if len(parts) >= 2 and parts[0] == "jobs" else None
+        if job is None:
+            self._json(404, {"error": "Không tìm thấy job"})
+        elif len(parts) == 2:
+            self._json(200, job.to_dict())
+        elif parts[2:] == ["events"]:
+            self._stream_events(job)
+        else:
+            self._json(404, {"error": "Không tìm thấy"})
+
+    def do_POST(self):  # noqa: N802
+        if not self._authorized():
+            return
+        parts = self._parts()
+        if parts == ["jobs"]:
+            self._create_job()
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "cancel":
+            if self.manager.cancel(parts[1]):
+                self._json(202, self.manager.get(parts[1]).to_dict())
+            else:
+                self._json(404, {"error": "Không tìm thấy job"})
+        else:
+            self._json(404, {"error": "Không tìm thấy"})
+
+    def _create_job(self) -> None:
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = 0
+        if length <= 0:
+            self._json(411, {"error": "Thiếu Content-Length"})
+            return
+        if length > MAX_UPLOAD_BYTES:
+            self._json(413, {"error": f"Dữ liệu gửi lên vượt quá {MAX_UPLOAD_BYTES // (1024 * 1024)} MB"})
+            return
+        body = self.rfile.read(length)
+        try:
+            files, fields = parse_multipart(self.headers.get("Content-Type", ""), body)
+            job = self.manager.submit(files, fields)
+        except ValueError as exc:
+            self._json(400, {"error": str(exc)})
+            return
+        self._json(202, job.to_dict())
+
+    def _stream_events(self, job: ApiJob) -> None:
+        try:
+            last = int(self.headers.get("Last-Event-ID") or 0)
+        except ValueError:
+            last = 0
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            while True:
+                events, ended = job.events_after(last, SSE_KEEPALIVE)
+                if events:
+                    chunk = "".join(
+                        f"id: {seq}\nevent: {kind}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+                        for seq, kind, data in events
+                    )
+                    self.wfile.write(chunk.encode("utf-8"))
+                    last = events[-1][0]
+                elif not ended:
+                    self.wfile.write(b": keep-alive\n\n")
+                self.wfile.flush()
+                if ended and not events:
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            return
+
+
+def _is_loopback(addr: str) -> bool:
+    if addr == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(addr).is_loopback
+    except ValueError:
+        return False
+
+
+def make_server(port: int = 8765, addr: str = "127.0.0.1", manager: JobManager | None = None,
+                token: str | None = None) -> ThreadingHTTPServer:
+    """Create (not start) the API server; serve_forever() runs it."""
+    token = os.getenv("MAILMERGE_API_TOKEN", "") if token is None else token
+    if not token and not _is_loopback(addr):
+        raise RuntimeError(f"Cần đặt MAILMERGE_API_TOKEN khi lắng nghe trên {addr or 'mọi địa chỉ'} (không phải loopback)")
+    manager = manager or JobManager(smtp_settings_from_env())
+    handler = type("ApiHandler", (_ApiHandler,), {
+        "manager": manager,
+        "token": token,
+    })
+    server = ThreadingHTTPServer((addr, port), handler)
+    server.daemon_threads = True
+    server.manager = manager
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP API gửi mail merge (không cần Streamlit).")
+    parser.add_argument("--port", type=int, default=int(os.getenv("MAILMERGE_API_PORT", "8765") or 8765))
+    parser.add_argument("--addr", default=os.getenv("MAILMERGE_API_ADDR", "127.0.0.1"), help="Địa chỉ lắng nghe (0.0.0.0 để mở ra ngoài)")
+    parser.add_argument("--workers", type=int, default=1, help="Số job chạy song song")
+    args = parser.parse_args()
+
+    manager = JobManager(smtp_settings_from_env(), workers=args.workers)
+    try:
+        server = make_server(args.port, args.addr, manager=manager)
+    except RuntimeError as exc:
+        manager.close()
+        raise SystemExit(str(exc))
+    print(f"Mail merge API: http://{args.addr}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        manager.close()
+
+
+if __name__ == "__main__":
+    main()
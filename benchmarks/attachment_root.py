@@ -0,0 +1,106 @@
+"""Check that a confined run (attachment_root, as used by api_server) only
+ships files from its own folder.
+
+    python benchmarks/attachment_root.py
+
+Builds a small campaign into a spool folder with attachment_root set to a
+job folder, next to a "secret" file outside it and the project's
+.env.example, and checks that
+* FilePDF values that are absolute, escape with `..` or are URLs fail
+  their row instead of being attached;
+* template images outside the folder are not embedded;
+* the cid:bookmedi_logo alias is looked up inside the folder, so a
+  cid_logo_filename naming a project file (.env.example) embeds nothing,
+  while a logo uploaded with the job is embedded;
+* the HTTP API does not accept cid_logo_filename from clients.
+
+Exits non-zero if a check fails.
+"""
+
+import base64
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+# 1x1 transparent PNG
+PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+
+
+def spooled(spool_dir: Path) -> list:
+    return [p.read_bytes() for p in sorted((spool_dir / "messages").rglob("*.eml"))]
+
+
+def run(job: Path, spool_dir: Path, rows: list, html: str, logo: str) -> dict:
+    from send_mail_merge import run_merge
+
+    (job / "r.csv").write_text("Email,Ten,FilePDF\n" + "".join(f"{e},T,{f}\n" for e, f in rows), encoding="utf-8")
+    (job / "t.html").write_text(html, encoding="utf-8")
+    return run_merge(
+        recipients=str(job / "r.csv"), template=str(job / "t.html"),
+        smtp_host="", smtp_port=25, smtp_user="noreply@example.com", smtp_pass="",
+        from_name="", default_subject="check", rate_delay=0, dry_run=False,
+        base_dir=str(job), cid_logo_filename=logo, spool_dir=str(spool_dir),
+        attachment_root=str(job), allow_attachment_urls=False,
+        progress_callback=lambda _msg: None,
+    )
+
+
+def main():
+    sys.path.insert(0, str(ROOT))
+    import api_server
+
+    failures = []
+
+    def check(name, cond):
+        print(f"  {'ok  ' if cond else 'FAIL'} {name}")
+        if not cond:
+            failures.append(name)
+
+    env_example = (ROOT / ".env.example").read_bytes()
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        job, outside = tmp / "job", tmp / "outside"
+        job.mkdir()
+        outside.mkdir()
+        (outside / "secret.pdf").write_bytes(b"%PDF SECRET-OUTSIDE")
+        (outside / "x.png").write_bytes(PNG)
+        (job / "ok.pdf").write_bytes(b"%PDF ok")
+
+        print("FilePDF and template images")
+        rows = [
+            ("a@example.com", str(outside / "secret.pdf")),
+            ("b@example.com", "../outside/secret.pdf"),
+            ("c@example.com", "http://169.254.169.254/latest"),
+            ("d@example.com", "ok.pdf"),
+        ]
+        html = f'<p>hi <img src="{outside / "x.png"}"><img src="../outside/x.png"></p>'
+        summary = run(job, tmp / "spool1", rows, html, "logomedi.png")
+        messages = spooled(tmp / "spool1")
+        check("absolute, `..` and URL rows fail", summary["failed"] == 3 and summary["sent"] == 1)
+        check("only the confined attachment is shipped", len(messages) == 1 and b"SECRET-OUTSIDE" not in messages[0])
+        check("outside images are not embedded", b"Content-ID" not in messages[0])
+
+        print("cid:bookmedi_logo alias")
+        html = '<p><img src="cid:bookmedi_logo"></p>'
+        run(job, tmp / "spool2", [("e@example.com", "")], html, ".env.example")
+        messages = spooled(tmp / "spool2")
+        leaked = base64.encodebytes(env_example[:45]).strip()
+        check("project file named as logo is not embedded", len(messages) == 1 and leaked not in messages[0]
+              and b"<bookmedi_logo>" not in messages[0])
+        (job / "logomedi.png").write_bytes(PNG)
+        run(job, tmp / "spool3", [("f@example.com", "")], html, "logomedi.png")
+        messages = spooled(tmp / "spool3")
+        check("logo uploaded with the job is embedded", len(messages) == 1 and b"<bookmedi_logo>" in messages[0])
+
+    print("HTTP API")
+    check("cid_logo_filename is not a client field", "cid_logo_filename" not in api_server._JOB_FIELDS)
+
+    if failures:
+        raise SystemExit(f"{len(failures)} check(s) failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Check how command-line options override manifest campaigns.
+
+    python benchmarks/manifest_overrides.py
+
+Runs send_mail_merge.main() with --manifest on a manifest whose defaults
+set non-default values, with run_merge replaced by a recorder, and checks
+that
+* an option passed at its default value (--smtp-port 587, --rate-delay 2.0,
+  --build-workers 1) still overrides the manifest;
+* options that are not passed leave the manifest values alone;
+* per-campaign options (--recipients, --campaign-id) are refused.
+
+Exits non-zero if a check fails.
+"""
+
+import contextlib
+import functools
+import io
+import json
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def run_cli(manifest: Path, *options: str) -> tuple:
+    """(run_merge keyword dicts, exit code) of one command line."""
+    import campaign_manifest
+    import send_mail_merge
+
+    calls = []
+    real = campaign_manifest.run_merge
+
+    @functools.wraps(real)  # keeps the signature run_manifest validates against
+    def record(**kwargs):
+        calls.append(kwargs)
+        return {"sent": 0, "failed": 0, "skipped": 0}
+
+    campaign_manifest.run_merge = record
+    argv, sys.argv = sys.argv, ["send_mail_merge.py", "--manifest", str(manifest), *options]
+    code = 0
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            send_mail_merge.main()
+    except SystemExit as exc:
+        code = exc.code
+    finally:
+        campaign_manifest.run_merge, sys.argv = real, argv
+    return calls, code
+
+
+def main():
+    sys.path.insert(0, str(ROOT))
+    failures = []
+
+    def check(name, cond):
+        print(f"  {'ok  ' if cond else 'FAIL'} {name}")
+        if not cond:
+            failures.append(name)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        manifest = Path(tmp) / "campaigns.json"
+        manifest.write_text(json.dumps({
+            "defaults": {"smtp_host": "smtp.example.com", "smtp_port": 2525, "smtp_user": "noreply@example.com",
+                         "rate_delay": 5.0, "build_workers": 4, "connections": 3},
+            "campaigns": [
+                {"name": "a", "recipients": "a.csv", "template": "t.html"},
+                {"name": "b", "recipients": "b.csv", "template": "t.html", "rate_delay": 7.0},
+            ],
+        }), encoding="utf-8")
+
+        calls, code = run_cli(manifest, "--dry-run", "--smtp-port", "587", "--rate-delay", "2.0", "--build-workers", "1")
+        check("both campaigns ran", code in (0, None) and len(calls) == 2)
+        check("--smtp-port 587 (default) overrides 2525", calls and all(c["smtp_port"] == 587 for c in calls))
+        check("--rate-delay 2.0 (default) overrides 5.0 and 7.0", all(c["rate_delay"] == 2.0 for c in calls))
+        check("--build-workers 1 (default) overrides 4", all(c["build_workers"] == 1 for c in calls))
+        check("options not given keep manifest values", all(c["connections"] == 3 for c in calls))
+
+        calls, code = run_cli(manifest, "--dry-run")
+        check("no options: manifest values", len(calls) == 2 and [c["rate_delay"] for c in calls] == [5.0, 7.0]
+              and all(c["smtp_port"] == 2525 for c in calls))
+
+        calls, code = run_cli(manifest, "--recipients", "x.csv")
+        check("--recipients refused", code == 2 and not calls)
+        calls, code = run_cli(manifest, "--campaign-id", "x")
+        check("--campaign-id refused", code == 2 and not calls)
+
+    if failures:
+        raise SystemExit(f"{len(failures)} check(s) failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Peak RSS of a dry-run merge for growing recipient lists.
+
+    python benchmarks/memory.py                       # 1k and 100k rows
+    python benchmarks/memory.py --rows 1000 1000000
+
+Each size runs in a fresh interpreter (ru_maxrss is per process) on a
+generated CSV where every 10th address is invalid, so the error list is
+exercised too. With streaming rows and the spilled error log, peak RSS
+should stay roughly flat; only the dedupe set grows with unique addresses
+(use --allow-duplicates to leave it out).
+"""
+
+import argparse
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+CHILD = r"""
+import resource, sys
+sys.path.insert(0, {root!r})
+from send_mail_merge import run_merge
+s = run_merge({csv!r}, {tpl!r}, "", 0, "bench@example.com", "", dry_run=True, rate_delay=0,
+              progress_callback=lambda _m: None, dedupe={dedupe!r}, build_workers=2)
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(s["sent"], s["failed"], rss // 1024 if sys.platform != "darwin" else rss // (1024 * 1024))
+"""
+
+
+def write_csv(path: Path, rows: int) -> None:
+    with open(path, "w", encoding="utf-8") as fh:
+        fh.write("Email,Ten,Code\n")
+        for i in range(rows):
+            email = f"user{i}@example.com" if i % 10 else f"invalid-{i}"
+            fh.write(f"{email},Người nhận {i},C{i:07d}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory benchmark for run_merge")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 100000])
+    parser.add_argument("--allow-duplicates", action="store_true", help="Tắt dedupe (không giữ tập địa chỉ đã gặp)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tpl = Path(tmp) / "t.html"
+        tpl.write_text("<p>Xin chào {{Ten}}, mã của bạn: {{Code}}</p>", encoding="utf-8")
+        for rows in args.rows:
+            csv_path = Path(tmp) / f"r{rows}.csv"
+            write_csv(csv_path, rows)
+            code = CHILD.format(root=str(ROOT), csv=str(csv_path), tpl=str(tpl), dedupe=not args.allow_duplicates)
+            t0 = time.perf_counter()
+            out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=tmp)
+            if out.returncode != 0:
+                raise SystemExit(out.stderr)
+            sent, failed, rss_mb = out.stdout.split()[-3:]
+            print(f"{rows:>9} rows: peak RSS {rss_mb:>5} MB  sent={sent} failed={failed}  {time.perf_counter() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
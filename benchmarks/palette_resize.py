@@ -0,0 +1,70 @@
+"""Check that optimize_image() downscales palette PNGs (logos) smoothly.
+
+    python benchmarks/palette_resize.py
+
+Draws an anti-aliased logo with transparent corners, saves it as a 1200 px
+palette (P mode) PNG and runs it through image_optimizer._process at the
+600 px layout width. Checks that the result is still a palette PNG of the
+layout width with no more colours than the original, and that it is close
+to a LANCZOS resize of the full-colour image, edges and transparency
+included (a NEAREST resize is not). Needs Pillow.
+
+Exits non-zero if a check fails.
+"""
+
+import io
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def mean_abs_diff(a, b) -> float:
+    channels = zip(a.convert("RGBA").tobytes(), b.convert("RGBA").tobytes())
+    return sum(abs(x - y) for x, y in channels) / (a.width * a.height * 4)
+
+
+def main():
+    sys.path.insert(0, str(ROOT))
+    import image_optimizer
+    from image_optimizer import Image
+
+    if Image is None:
+        raise SystemExit("Pillow is not installed")
+    from PIL import ImageDraw
+
+    failures = []
+
+    def check(name, cond):
+        print(f"  {'ok  ' if cond else 'FAIL'} {name}")
+        if not cond:
+            failures.append(name)
+
+    big = Image.new("RGBA", (4800, 1600), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(big)
+    draw.ellipse((400, 200, 4400, 1400), fill=(20, 90, 170, 255))
+    draw.rounded_rectangle((1200, 600, 3600, 1000), 120, fill=(255, 255, 255, 255))
+    draw.ellipse((1600, 680, 1840, 920), fill=(230, 60, 40, 255))
+    logo = big.resize((1200, 400), Image.LANCZOS).quantize(64, method=Image.Quantize.FASTOCTREE)
+    buf = io.BytesIO()
+    logo.save(buf, "PNG", optimize=True)
+    data = buf.getvalue()
+
+    result = image_optimizer._process(data, "png", image_optimizer.LAYOUT_WIDTH)
+    out = Image.open(io.BytesIO(result))
+    reference = logo.convert("RGBA").resize(out.size, Image.LANCZOS)
+    nearest = logo.resize(out.size, Image.NEAREST)
+    diff = mean_abs_diff(out, reference)
+    print(f"  {len(data)} -> {len(result)} bytes, diff to LANCZOS {diff:.2f} (NEAREST {mean_abs_diff(nearest, reference):.2f})")
+
+    check("resized to the layout width", out.size == (image_optimizer.LAYOUT_WIDTH, 200))
+    check("still a palette PNG", out.format == "PNG" and out.mode == "P")
+    check("no more colours than the original", len(out.getcolors(256) or ()) <= len(logo.getcolors(256)))
+    check("close to a LANCZOS resize", diff < mean_abs_diff(nearest, reference) / 2)
+
+    if failures:
+        raise SystemExit(f"{len(failures)} check(s) failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Check that capped scheduler slices resume per row, not per address.
+
+    python benchmarks/scheduler_resume.py
+
+Schedules a sheet that mails one address three times (one row per
+document) with a daily cap of 2, runs one slice per day with a recording
+sender pool instead of SMTP, and checks that every row is delivered
+exactly once across the slices and that the job ends as done.
+
+Exits non-zero if a check fails.
+"""
+
+import email
+import functools
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+ROWS = [
+    ("a@example.com", "invoice-1"),
+    ("b@example.com", "invoice-2"),
+    ("a@example.com", "invoice-3"),
+    ("c@example.com", "invoice-4"),
+    ("a@example.com", "invoice-5"),
+]
+
+
+class RecordingSender:
+    def __init__(self, log: list):
+        self.log = log
+
+    def send(self, from_addr, recipients, data, timings=None) -> dict:
+        msg = email.message_from_bytes(data)
+        html = next(p for p in msg.walk() if p.get_content_type() == "text/html")
+        self.log.append((recipients[0], html.get_payload(decode=True).decode()))
+        return {}
+
+
+class RecordingPool:
+    def __init__(self):
+        self.log: list = []
+
+    def acquire(self, *args, **kwargs):
+        return RecordingSender(self.log)
+
+    def release(self, sender) -> None:
+        pass
+
+
+def main():
+    sys.path.insert(0, str(ROOT))
+    import scheduler
+
+    failures = []
+
+    def check(name, cond):
+        print(f"  {'ok  ' if cond else 'FAIL'} {name}")
+        if not cond:
+            failures.append(name)
+
+    pool = RecordingPool()
+    real = scheduler.run_merge
+    scheduler.run_merge = functools.partial(real, sender_pool=pool)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            (tmp / "r.csv").write_text("Email,Ten,Doc\n" + "".join(f"{e},T,{d}\n" for e, d in ROWS), encoding="utf-8")
+            (tmp / "t.html").write_text("<p>{{Doc}}</p>", encoding="utf-8")
+            sched = scheduler.Scheduler(tmp / "scheduler.sqlite3")
+            start = datetime(2030, 1, 1, 9, 0)
+            job_id = sched.add_job(
+                {
+                    "recipients": str(tmp / "r.csv"), "template": str(tmp / "t.html"),
+                    "smtp_host": "smtp.example.com", "smtp_port": 587, "smtp_user": "noreply@example.com",
+                    "from_name": "", "default_subject": "Hoá đơn", "rate_delay": 0.0, "dry_run": False,
+                    "base_dir": str(tmp), "suppression_db": str(tmp / "suppression.sqlite3"),
+                    "campaign_state_db": str(tmp / "campaign_state.sqlite3"),
+                },
+                start_at=start, daily_cap=2, smtp_pass="secret",
+            )
+            for day in range(4):
+                sched.run_pending(now=start + timedelta(days=day, seconds=1))
+                print(f"  day {day + 1}: {len(pool.log)} delivered")
+            job = next(j for j in sched.jobs() if j["id"] == job_id)
+    finally:
+        scheduler.run_merge = real
+
+    delivered = sorted((rcpt, next(d for _, d in ROWS if d in html)) for rcpt, html in pool.log)
+    check("every row delivered once", delivered == sorted(ROWS))
+    check("repeated address kept all its rows", sum(1 for r, _ in delivered if r == "a@example.com") == 3)
+    check("job finished", job["status"] == scheduler.STATUS_DONE and job["sent"] == len(ROWS))
+
+    if failures:
+        raise SystemExit(f"{len(failures)} check(s) failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""Check and time _sendmail_pipelined against a local PIPELINING server.
+
+    python benchmarks/smtp_pipelining.py                 # checks + 50 messages at 20 ms RTT
+    python benchmarks/smtp_pipelining.py --rtt 0.05 -n 100
+
+Starts a socket-based SMTP stand-in on localhost that advertises
+PIPELINING, SIZE and (in one pass) CHUNKING, and answers like a real
+pipelining server: replies are queued and written only when no further
+command is waiting, after --rtt seconds, so every write is one round trip.
+
+For both the BDAT and the DATA variant it checks that
+* a refused RCPT in the middle of the pipeline is reported and the other
+  recipients still get the message;
+* all recipients refused, a refused MAIL FROM and a rejected BDAT LAST
+  (or final DATA reply) raise the smtplib exception sendmail() would, and
+  the session stays in step for the next message;
+* a non-ASCII address (SMTPUTF8) raises SMTPNotSupportedError before
+  anything is sent, since the server does not offer SMTPUTF8.
+
+Then it sends N messages to three recipients with smtplib's sendmail()
+and with _sendmail_pipelined(), and prints round trips and time per
+message. Exits non-zero if a check fails.
+"""
+
+import argparse
+import smtplib
+import socket
+import sys
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+REJECT_MARKER = b"X-Bench-Reject: yes"
+
+
+class PipeliningServer:
+    """One-thread-per-connection SMTP stand-in that records deliveries.
+
+    Addresses starting with "bad" are refused with 550 (RCPT) or 553 (MAIL);
+    messages containing REJECT_MARKER are refused with 554 after the body.
+    SMTPUTF8 is not offered, so MAIL FROM asking for it gets 555.
+    """
+
+    def __init__(self, chunking: bool, rtt: float = 0.0):
+        self.chunking = chunking
+        self.rtt = rtt
+        self.delivered: list = []  # (recipients, size) per accepted message
+        self.round_trips = 0
+        self._listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self._listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def close(self):
+        self._listener.close()
+
+    def _handle(self, conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buf = bytearray()
+        out: list = []
+        state = {"mail": False, "rcpts": [], "data": False}
+
+        def flush():
+            if out:
+                if self.rtt:
+                    time.sleep(self.rtt)
+                conn.sendall(b"".join(out))
+                out.clear()
+                self.round_trips += 1
+
+        def fill() -> bool:
+            chunk = conn.recv(65536)
+            buf.extend(chunk)
+            return bool(chunk)
+
+        def finish(body: bytes) -> bytes:
+            rcpts, state["mail"], state["rcpts"] = state["rcpts"], False, []
+            if not rcpts:
+                return b"554 5.5.1 no valid recipients\r\n"
+            if REJECT_MARKER in body:
+                return b"554 5.7.1 message rejected\r\n"
+            self.delivered.append((rcpts, len(body)))
+            return b"250 2.0.0 queued\r\n"
+
+        try:
+            conn.sendall(b"220 localhost ESMTP bench\r\n")
+            while True:
+                if state["data"]:
+                    end = buf.find(b"\r\n.\r\n")
+                    if end < 0:
+                        flush()
+                        if not fill():
+                            return
+                        continue
+                    body = bytes(buf[:end + 2])
+                    del buf[:end + 5]
+                    state["data"] = False
+                    out.append(finish(body))
+                    continue
+                nl = buf.find(b"\r\n")
+                if nl < 0:
+                    # Nothing more queued by the client: answer everything at once.
+                    flush()
+                    if not fill():
+                        return
+                    continue
+                line = bytes(buf[:nl])
+                del buf[:nl + 2]
+                cmd = line.upper()
+                if cmd.startswith(b"EHLO"):
+                    ext = b"250-CHUNKING\r\n" if self.chunking else b""
+                    out.append(b"250-localhost\r\n250-PIPELINING\r\n250-SIZE 10485760\r\n" + ext + b"250 8BITMIME\r\n")
+                elif cmd.startswith(b"MAIL FROM:"):
+                    if b" SMTPUTF8" in cmd:
+                        state["mail"], state["rcpts"] = False, []
+                        out.append(b"555 5.5.4 SMTPUTF8 not supported\r\n")
+                        continue
+                    ok = not line[10:].strip(b"<> ").lower().startswith(b"bad")
+                    state["mail"], state["rcpts"] = ok, []
+                    out.append(b"250 2.1.0 ok\r\n" if ok else b"553 5.1.8 sender refused\r\n")
+                elif cmd.startswith(b"RCPT TO:"):
+                    addr = line[8:].strip(b"<> ").decode()
+                    if not state["mail"]:
+                        out.append(b"503 5.5.1 need MAIL first\r\n")
+                    elif addr.lower().startswith("bad"):
+                        out.append(b"550 5.1.1 no such user\r\n")
+                    else:
+                        state["rcpts"].append(addr)
+                        out.append(b"250 2.1.5 ok\r\n")
+                elif cmd == b"DATA":
+                    if state["mail"] and state["rcpts"]:
+                        state["data"] = True
+                        out.append(b"354 go ahead\r\n")
+                    else:
+                        state["mail"], state["rcpts"] = False, []
+                        out.append(b"554 5.5.1 no valid recipients\r\n")
+                elif cmd.startswith(b"BDAT") and self.chunking:
+                    size = int(line.split()[1])
+                    while len(buf) < size:
+                        if not fill():
+                            return
+                    body = bytes(buf[:size])
+                    del buf[:size]
+                    # The chunk is always consumed, even when it is refused (RFC 3030).
+                    out.append(finish(body) if state["mail"] else b"503 5.5.1 need MAIL first\r\n")
+                elif cmd == b"RSET":
+                    state["mail"], state["rcpts"] = False, []
+                    out.append(b"250 2.0.0 reset\r\n")
+                elif cmd == b"QUIT":
+                    out.append(b"221 2.0.0 bye\r\n")
+                    flush()
+                    return
+                elif cmd == b"NOOP":
+                    out.append(b"250 2.0.0 ok\r\n")
+                else:
+                    out.append(b"500 5.5.2 unknown command\r\n")
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+
+def message(marker: bool = False) -> bytes:
+    extra = REJECT_MARKER + b"\r\n" if marker else b""
+    return b"From: a@example.com\r\nSubject: bench\r\n" + extra + b"\r\n" + b"x" * 2000 + b"\r\n.leading dot\r\n"
+
+
+def run_checks(chunking: bool) -> list:
+    """Returns the names of the failed checks."""
+    from send_mail_merge import _sendmail_pipelined
+
+    server = PipeliningServer(chunking)
+    client = smtplib.SMTP("127.0.0.1", server.port, timeout=10)
+    client.ehlo()
+    failures = []
+
+    def check(name, cond):
+        print(f"  {'ok  ' if cond else 'FAIL'} {name}")
+        if not cond:
+            failures.append(name)
+
+    def expect(exc_type, *args):
+        try:
+            _sendmail_pipelined(client, *args)
+        except exc_type as exc:
+            return exc
+        return None
+
+    try:
+        check("server offers CHUNKING" if chunking else "server offers DATA only", bool(client.has_extn("chunking")) == chunking)
+        refused = _sendmail_pipelined(client, "a@example.com", ["one@x.test", "bad1@x.test", "two@x.test"], message())
+        check("mid-pipeline RCPT refusal reported", list(refused) == ["bad1@x.test"] and refused["bad1@x.test"][0] == 550)
+        check("other recipients delivered", server.delivered[-1][0] == ["one@x.test", "two@x.test"])
+        check("dot-stuffed body intact", server.delivered[-1][1] == len(message()) + (0 if chunking else 1))
+
+        exc = expect(smtplib.SMTPRecipientsRefused, "a@example.com", ["bad1@x.test", "bad2@x.test"], message())
+        check("all recipients refused -> SMTPRecipientsRefused", exc is not None and len(exc.recipients) == 2)
+
+        exc = expect(smtplib.SMTPSenderRefused, "bad@example.com", ["one@x.test"], message())
+        check("MAIL FROM refused -> SMTPSenderRefused", exc is not None and exc.smtp_code == 553)
+
+        before = len(server.delivered)
+        exc = expect(smtplib.SMTPDataError, "a@example.com", ["one@x.test"], message(marker=True))
+        label = "BDAT LAST rejected" if chunking else "final DATA reply rejected"
+        check(f"{label} -> SMTPDataError", exc is not None and exc.smtp_code == 554)
+        check(f"{label}: nothing delivered", len(server.delivered) == before)
+
+        exc = expect(smtplib.SMTPNotSupportedError, "a@example.com", ["người@x.test"], message(), ("SMTPUTF8", "BODY=8BITMIME"))
+        check("SMTPUTF8 not offered -> SMTPNotSupportedError", exc is not None and len(server.delivered) == before)
+
+        refused = _sendmail_pipelined(client, "a@example.com", ["three@x.test"], message())
+        check("session in step after errors", refused == {} and server.delivered[-1][0] == ["three@x.test"])
+        check("NOOP answered in order", client.noop()[0] == 250)
+    finally:
+        client.quit()
+        server.close()
+    return failures
+
+
+def timed(rtt: float, runs: int, pipelined: bool) -> dict:
+    from send_mail_merge import _sendmail_pipelined
+
+    server = PipeliningServer(chunking=True, rtt=rtt)
+    client = smtplib.SMTP("127.0.0.1", server.port, timeout=30)
+    client.ehlo()
+    rcpts = ["one@x.test", "two@x.test", "three@x.test"]
+    data = message()
+    start_trips = server.round_trips
+    t0 = time.perf_counter()
+    for _ in range(runs):
+        if pipelined:
+            _sendmail_pipelined(client, "a@example.com", rcpts, data)
+        else:
+            client.sendmail("a@example.com", rcpts, data)
+    elapsed = time.perf_counter() - t0
+    trips = server.round_trips - start_trips
+    client.quit()
+    server.close()
+    return {"ms": elapsed * 1000 / runs, "trips": trips / runs}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SMTP PIPELINING/CHUNKING check and benchmark")
+    parser.add_argument("-n", "--runs", type=int, default=50)
+    parser.add_argument("--rtt", type=float, default=0.02, help="Simulated round-trip time in seconds")
+    args = parser.parse_args()
+    sys.path.insert(0, str(ROOT))
+
+    failures = []
+    for chunking in (True, False):
+        print("CHUNKING (BDAT)" if chunking else "PIPELINING (DATA)")
+        failures += run_checks(chunking)
+
+    runs = max(1, args.runs)
+    print(f"\n{runs} messages, 3 recipients, {args.rtt * 1000:.0f} ms RTT")
+    base = timed(args.rtt, runs, pipelined=False)
+    new = timed(args.rtt, runs, pipelined=True)
+    for name, r in (("sendmail", base), ("pipelined", new)):
+        print(f"  {name:<10} {r['trips']:4.1f} round trips  {r['ms']:7.1f} ms/message")
+    print(f"  speed-up   {base['ms'] / new['ms']:.2f}x")
+    if failures:
+        raise SystemExit(f"{len(failures)} check(s) failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Measure import cost of the entry points with ``python -X importtime``.
+
+    python benchmarks/startup.py                 # send_mail_merge, 5 runs
+    python benchmarks/startup.py -m streamlit_app -n 3
+
+Prints the median cumulative import time of the module and of the heaviest
+third-party packages it pulls in, so regressions (e.g. pandas imported at
+module level again) show up immediately.
+"""
+
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+WATCH = ("pandas", "requests", "numpy", "openpyxl", "streamlit")
+# "import time: self [us] | cumulative | imported package"
+LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def measure(module: str) -> dict:
+    """Cumulative import time (microseconds) of module and its top-level packages."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise SystemExit(proc.stderr.strip().splitlines()[-1])
+    times: dict = {}
+    for line in proc.stderr.splitlines():
+        m = LINE.match(line)
+        if m and "." not in m.group(4):
+            times[m.group(4)] = times.get(m.group(4), 0) + int(m.group(2))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup (import) benchmark")
+    parser.add_argument("-m", "--module", default="send_mail_merge")
+    parser.add_argument("-n", "--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    runs = [measure(args.module) for _ in range(max(1, args.runs))]
+    total = statistics.median(r.get(args.module, 0) for r in runs) / 1000
+    print(f"import {args.module}: {total:.1f} ms (median of {len(runs)})")
+    for name in WATCH:
+        values = [r[name] for r in runs if name in r]
+        if values:
+            print(f"  {name:<10} {statistics.median(values) / 1000:8.1f} ms")
+        else:
+            print(f"  {name:<10} {'not imported':>11}")
+
+
+if __name__ == "__main__":
+    main()
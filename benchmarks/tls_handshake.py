@@ -0,0 +1,160 @@
+"""Reconnect cost of SmtpSender: per-connection context vs cached + resumed.
+
+    python benchmarks/tls_handshake.py                 # STARTTLS, 200 reconnects
+    python benchmarks/tls_handshake.py --smtps -n 500
+
+Starts a minimal TLS-enabled SMTP stand-in (EHLO, STARTTLS, AUTH, QUIT) on
+localhost in a child process, with a throwaway self-signed certificate
+(made with the openssl CLI, or pass --cert/--key), and reconnects N times:
+
+* baseline: a fresh ssl.create_default_context() per connection and a full
+  handshake every time (the behaviour before the shared context);
+* cached:   shared_ssl_context() and TLS session resumption (default).
+
+Prints wall time and client CPU per connection for both, plus how many
+connections resumed a session. The server runs in its own process, so its
+CPU does not count against the client.
+"""
+
+import argparse
+import os
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def serve(port: int, cert: str, key: str, implicit: bool) -> None:
+    """Child process: accept connections until killed."""
+    import socket
+    import threading
+
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(cert, key)
+    listener = socket.create_server(("127.0.0.1", port), backlog=64)
+    print(listener.getsockname()[1], flush=True)
+
+    def handle(conn):
+        # Without this, Nagle + delayed ACK add ~40 ms to some exchanges.
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            if implicit:
+                conn = ctx.wrap_socket(conn, server_side=True)
+            reader = conn.makefile("rb")
+            conn.sendall(b"220 localhost ESMTP bench\r\n")
+            tls = implicit
+            while True:
+                line = reader.readline()
+                if not line:
+                    return
+                cmd = line.strip().upper()
+                if cmd.startswith(b"EHLO"):
+                    ext = b"" if tls else b"250-STARTTLS\r\n"
+                    conn.sendall(b"250-localhost\r\n" + ext + b"250 AUTH PLAIN LOGIN\r\n")
+                elif cmd == b"STARTTLS":
+                    conn.sendall(b"220 go ahead\r\n")
+                    conn = ctx.wrap_socket(conn, server_side=True)
+                    reader = conn.makefile("rb")
+                    tls = True
+                elif cmd.startswith(b"AUTH"):
+                    conn.sendall(b"235 ok\r\n")
+                elif cmd == b"QUIT":
+                    conn.sendall(b"221 bye\r\n")
+                    return
+                else:
+                    conn.sendall(b"250 ok\r\n")
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    while True:
+        conn, _ = listener.accept()
+        threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+def make_cert(folder: Path) -> tuple:
+    cert, key = folder / "cert.pem", folder / "key.pem"
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost",
+         "-keyout", str(key), "-out", str(cert)],
+        check=True,
+        capture_output=True,
+    )
+    return str(cert), str(key)
+
+
+def measure(port: int, runs: int, smtps: bool, cached: bool) -> dict:
+    from send_mail_merge import SmtpSender
+
+    reused = 0
+    wall0, cpu0 = time.perf_counter(), time.process_time()
+    for _ in range(runs):
+        if cached:
+            sender = SmtpSender("localhost", port, "bench", "bench", use_starttls=not smtps)
+        else:
+            sender = SmtpSender("localhost", port, "bench", "bench", use_starttls=not smtps,
+                                ssl_context=ssl.create_default_context(), tls_resumption=False)
+        sender._connect()
+        reused += sender.session_reused
+        sender.close()
+    return {
+        "wall_ms": (time.perf_counter() - wall0) * 1000 / runs,
+        "cpu_ms": (time.process_time() - cpu0) * 1000 / runs,
+        "reused": reused,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TLS handshake benchmark")
+    parser.add_argument("-n", "--runs", type=int, default=200)
+    parser.add_argument("--smtps", action="store_true", help="Implicit TLS (SMTPS) instead of STARTTLS")
+    parser.add_argument("--cert")
+    parser.add_argument("--key")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        serve(args.serve, args.cert, args.key, args.smtps)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cert, key = (args.cert, args.key) if args.cert and args.key else make_cert(Path(tmp))
+        # Trust the throwaway certificate next to the system CAs, so building a
+        # context costs what it does in production.
+        bundle = Path(tmp) / "bundle.pem"
+        system = ssl.get_default_verify_paths().cafile
+        bundle.write_bytes((Path(system).read_bytes() if system else b"") + Path(cert).read_bytes())
+        os.environ["SSL_CERT_FILE"] = str(bundle)
+        cmd = [sys.executable, __file__, "--serve", "0", "--cert", cert, "--key", key]
+        if args.smtps:
+            cmd.append("--smtps")
+        server = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+        try:
+            port = int(server.stdout.readline())
+            sys.path.insert(0, str(ROOT))
+            runs = max(1, args.runs)
+            measure(port, 5, args.smtps, cached=True)  # warm up imports and the server
+            results = {
+                "baseline": measure(port, runs, args.smtps, cached=False),
+                "cached": measure(port, runs, args.smtps, cached=True),
+            }
+        finally:
+            server.kill()
+            server.wait()
+
+    mode = "SMTPS" if args.smtps else "STARTTLS"
+    print(f"{mode}, {runs} reconnects")
+    for name, r in results.items():
+        print(f"  {name:<9} {r['wall_ms']:7.2f} ms wall  {r['cpu_ms']:7.2f} ms CPU  resumed {r['reused']}/{runs}")
+    base, new = results["baseline"], results["cached"]
+    print(f"  speed-up  {base['wall_ms'] / new['wall_ms']:.2f}x wall  {base['cpu_ms'] / max(new['cpu_ms'], 1e-9):.2f}x CPU")
+
+
+if __name__ == "__main__":
+    main()
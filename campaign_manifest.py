@@ -0,0 +1,159 @@
+"""Run several campaigns from one manifest in a single process.
+
+    python send_mail_merge.py --manifest campaigns.yaml [--dry-run]
+
+The manifest (.yaml/.yml, which needs PyYAML, or .json) lists campaigns;
+each entry takes run_merge parameters, and "defaults" applies to all of
+them:
+
+    defaults:
+      smtp_host: smtp.office365.com
+      smtp_user: noreply@cdimex.com.vn
+      rate_delay: 1.5
+      suppression_db: .mailmerge/suppression.sqlite3
+    campaigns:
+      - name: versant-thang-5
+        recipients: data/thang5.xlsx
+        template: template.html
+        default_subject: "Kết quả bài thi - {{Ten}}"
+      - name: thong-bao
+        recipients: data/thong_bao.csv
+        template: thong_bao.html
+        batch_size: 50
+
+Relative paths are resolved against the manifest's folder. The password
+comes from smtp_pass in the manifest, --smtp-pass or SMTP_PASS. Other
+options given on the command line (--fast-dry-run, --build-mode,
+--connections, ...) override the manifest for every campaign; those that
+only make sense per campaign (recipients, template, campaign id, spool
+folder) are refused.
+
+Campaigns run one after another and share one process, so interpreter
+start-up and module imports are paid once. They also share logged-in SMTP
+sessions (SenderPool), one rate limiter per SMTP account and delay (the
+pace holds across campaign boundaries), downloaded URL attachments
+(AttachmentCache) and the per-process image and template caches. A
+failing campaign is recorded and the next one still runs.
+"""
+
+import inspect
+import json
+import os
+import time
+from pathlib import Path
+
+from send_mail_merge import AttachmentCache, RateLimiter, SenderPool, run_merge
+
+# run_merge parameters that hold paths.
+_PATH_KEYS = (
+    "recipients", "template", "base_dir", "spool_dir", "timings_path", "metrics_textfile",
+    "suppression_db", "campaign_state_db", "dkim_key",
+)
+# Supplied by run_manifest itself.
+_RESERVED_KEYS = (
+    "progress_callback", "event_callback", "stop_event", "sender_pool", "rate_limiter", "attachment_cache",
+)
+# Cannot be shared by all campaigns, so not accepted as overrides.
+_PER_CAMPAIGN_KEYS = ("recipients", "template", "campaign_id", "spool_dir")
+
+
+def load_manifest(path) -> list:
+    """Return the campaigns of a manifest as run_merge keyword dicts (plus "name")."""
+    path = Path(path)
+    text = path.read_text(encoding="utf-8")
+    if path.suffix.lower() in (".yaml", ".yml"):
+        try:
+            import yaml  # type: ignore
+        except ImportError:
+            raise RuntimeError("Cần cài PyYAML để đọc manifest .yaml (pip install pyyaml) hoặc dùng manifest .json") from None
+        data = yaml.safe_load(text)
+    else:
+        data = json.loads(text)
+    if not isinstance(data, dict) or not isinstance(data.get("campaigns"), list) or not data["campaigns"]:
+        raise ValueError("Manifest phải có danh sách 'campaigns'")
+
+    allowed = set(inspect.signature(run_merge).parameters) - set(_RESERVED_KEYS)
+    defaults = data.get("defaults") or {}
+    campaigns = []
+    for n, entry in enumerate(data["campaigns"], start=1):
+        params = {**defaults, **(entry or {})}
+        name = str(params.pop("name", "") or f"campaign-{n}")
+        unknown = sorted(set(params) - allowed)
+        if unknown:
+            raise ValueError(f"Chiến dịch '{name}': tham số không hợp lệ: {', '.join(unknown)}")
+        missing = [k for k in ("recipients", "template", "smtp_user") if not params.get(k)]
+        if missing:
+            raise ValueError(f"Chiến dịch '{name}': thiếu {', '.join(missing)}")
+        for key in _PATH_KEYS:
+            if params.get(key) and not Path(params[key]).is_absolute():
+                params[key] = str(path.parent / params[key])
+        params["name"] = name
+        campaigns.append(params)
+    return campaigns
+
+
+def run_manifest(path, smtp_pass: str = "", dry_run: bool = False, progress_callback=None,
+                 overrides: dict | None = None) -> list:
+    """Run every campaign of the manifest; returns one summary dict per campaign.
+
+    overrides are run_merge parameters applied on top of every campaign
+    (the command-line options); ValueError for ones that cannot be shared.
+    """
+    overrides = dict(overrides or {})
+    allowed = set(inspect.signature(run_merge).parameters) - set(_RESERVED_KEYS) - set(_PER_CAMPAIGN_KEYS)
+    refused = sorted(set(overrides) - allowed)
+    if refused:
+        raise ValueError(f"Không dùng chung cho mọi chiến dịch trong manifest: {', '.join(refused)}")
+
+    def log(message: str):
+        if progress_callback:
+            try:
+                progress_callback(message)
+            except Exception:
+                pass
+        else:
+            print(message)
+
+    campaigns = load_manifest(path)
+    sender_pool = SenderPool()
+    attachments = AttachmentCache()
+    limiters: dict = {}
+    results = []
+    try:
+        for params in campaigns:
+            name = params.pop("name")
+            params.update(overrides)
+            if dry_run:
+                params["dry_run"] = True
+            params.setdefault("smtp_pass", smtp_pass or os.getenv("SMTP_PASS", ""))
+            account = (params.get("smtp_host", ""), params.get("smtp_user", ""), float(params.get("rate_delay", 2.0)))
+            if account not in limiters:
+                limiters[account] = RateLimiter(account[2])
+            log(f"\n=== [{name}] {params['recipients']} ===")
+            started = time.monotonic()
+            try:
+                summary = run_merge(
+                    **params,
+                    progress_callback=progress_callback,
+                    sender_pool=sender_pool,
+                    rate_limiter=limiters[account],
+                    attachment_cache=attachments,
+                )
+                summary.update(name=name, seconds=round(time.monotonic() - started, 1))
+            except Exception as exc:
+                log(f"[ERR] Chiến dịch {name} dừng: {exc}")
+                summary = {"name": name, "sent": 0, "failed": 0, "skipped": 0, "error": str(exc),
+                           "seconds": round(time.monotonic() - started, 1)}
+            results.append(summary)
+    finally:
+        sender_pool.close()
+        attachments.close()
+
+    width = max(len(r["name"]) for r in results)
+    log("\nTổng kết:")
+    for r in results:
+        line = f" - {r['name']:<{width}}  sent={r['sent']}  failed={r['failed']}  skipped={r['skipped']}  {r['seconds']}s"
+        if r.get("error"):
+            line += f"  LỖI: {r['error']}"
+        log(line)
+    return results
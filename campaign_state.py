@@ -0,0 +1,119 @@
+"""Row fingerprints of delivered messages, for incremental campaigns.
+
+A recurring campaign re-reads a sheet that only grows or changes a little.
+Each row is fingerprinted from its address, every token value and the
+content hash of its attachment; run_merge(incremental=True) loads the
+fingerprints already delivered for the campaign into a set once and skips
+matching rows, so only added or edited rows (or rows whose PDF changed)
+are built and sent. The diff is a single pass over the sheet with one O(1)
+lookup per row.
+
+Attachment content hashes are cached by (path, mtime, size), so unchanged
+PDFs are not re-read on every run.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS campaign_rows (
+    campaign TEXT NOT NULL,
+    row_hash TEXT NOT NULL,
+    address TEXT NOT NULL,
+    sent_at TEXT NOT NULL,
+    PRIMARY KEY (campaign, row_hash)
+);
+CREATE TABLE IF NOT EXISTS file_hashes (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+"""
+
+
+def _now() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class CampaignState:
+    """SQLite-backed set of delivered row fingerprints per campaign."""
+
+    def __init__(self, path, commit_every: int = 200):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.commit_every = commit_every
+        self._file_memo: dict = {}
+
+    def load_sent(self, campaign: str) -> set:
+        """Fingerprints of rows already delivered in campaign."""
+        with self._lock:
+            return {r[0] for r in self._conn.execute("SELECT row_hash FROM campaign_rows WHERE campaign = ?", (campaign,))}
+
+    def file_digest(self, path) -> str:
+        """SHA-256 of a file, cached by path, mtime and size ("" if missing)."""
+        path = str(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return ""
+        stamp = (st.st_mtime_ns, st.st_size)
+        memo = self._file_memo.get(path)
+        if memo is not None and memo[0] == stamp:
+            return memo[1]
+        with self._lock:
+            row = self._conn.execute("SELECT mtime_ns, size, sha256 FROM file_hashes WHERE path = ?", (path,)).fetchone()
+        if row is not None and (row[0], row[1]) == stamp:
+            digest = row[2]
+        else:
+            h = hashlib.sha256()
+            with open(path, "rb") as fh:
+                for block in iter(lambda: fh.read(1 << 20), b""):
+                    h.update(block)
+            digest = h.hexdigest()
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO file_hashes(path, mtime_ns, size, sha256) VALUES (?, ?, ?, ?)",
+                    (path, stamp[0], stamp[1], digest),
+                )
+                self._tick()
+        self._file_memo[path] = (stamp, digest)
+        return digest
+
+    def record_sent(self, campaign: str, row_hash: str, email: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO campaign_rows(campaign, row_hash, address, sent_at) VALUES (?, ?, ?, ?)",
+                (campaign, row_hash, (email or "").strip().lower(), _now()),
+            )
+            self._tick()
+
+    def _tick(self) -> None:
+        # Caller holds the lock; commits are batched for throughput.
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+
+def row_fingerprint(email: str, tokens: dict, attachment_digest: str = "") -> str:
+    """Stable hash of what a row's message depends on."""
+    h = hashlib.sha256()
+    h.update((email or "").strip().lower().encode("utf-8"))
+    for column in sorted(tokens):
+        h.update(b"\x00" + str(column).encode("utf-8") + b"\x01" + str(tokens[column]).encode("utf-8"))
+    h.update(b"\x00" + attachment_digest.encode("ascii"))
+    return h.hexdigest()
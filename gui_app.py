@@ -1,10 +1,33 @@
 from pathlib import Path
 import os
+import queue
 import threading
+import time
 import tkinter as tk
-from tkinter import filedialog, messagebox, scrolledtext
+from tkinter import filedialog, messagebox, scrolledtext, ttk
 
-from send_mail_merge import run_merge
+from send_mail_merge import EVENT_FINISHED, EVENT_STARTED, run_merge
+
+# The log widget slows down and grows without bound on long campaigns:
+# keep only the most recent lines.
+MAX_LOG_LINES = 2000
+# How often the UI drains the worker queue, and how many items per tick.
+PUMP_INTERVAL_MS = 100
+PUMP_BATCH = 500
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, "") or default)
+    except ValueError:
+        return default
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, "") or default)
+    except ValueError:
+        return default
 
 
 class MailMergeGUI(tk.Tk):
@@ -29,8 +52,18 @@ class MailMergeGUI(tk.Tk):
         )
         self.use_ssl_var = tk.BooleanVar(value=os.getenv("SMTP_USE_SSL", "").strip().lower() in {"1", "true", "yes", "y", "on"})
         self.dry_run_var = tk.BooleanVar(value=os.getenv("DRY_RUN_DEFAULT", "true").strip().lower() in {"1", "true", "yes", "y", "on"})
+        self.rate_delay_var = tk.StringVar(value=str(_env_float("RATE_DELAY_DEFAULT", 1.5)))
+        self.build_workers_var = tk.StringVar(value=str(_env_int("BUILD_WORKERS_DEFAULT", 2)))
+        self.connections_var = tk.StringVar(value=str(_env_int("SMTP_CONNECTIONS_DEFAULT", 1)))
+        self.status_var = tk.StringVar(value="")
+
+        # The worker thread never touches Tk: it posts (kind, payload) items
+        # here and _pump() applies them on the UI thread.
+        self._ui_queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._running = False
 
         self._build_form()
+        self.after(PUMP_INTERVAL_MS, self._pump)
 
     def _build_form(self) -> None:
         pad = {"padx": 6, "pady": 4, "sticky": "w"}
@@ -63,13 +96,27 @@ class MailMergeGUI(tk.Tk):
         tk.Checkbutton(self, text="Use SSL (SMTPS)", variable=self.use_ssl_var).grid(row=8, column=0, **pad)
         tk.Checkbutton(self, text="Dry-run (không gửi thật)", variable=self.dry_run_var).grid(row=8, column=1, **pad)
 
+        # Throughput settings
+        speed = tk.Frame(self)
+        tk.Label(speed, text="Delay (giây)").pack(side=tk.LEFT)
+        tk.Spinbox(speed, from_=0.0, to=10.0, increment=0.5, width=5, textvariable=self.rate_delay_var).pack(side=tk.LEFT, padx=(4, 12))
+        tk.Label(speed, text="Build workers").pack(side=tk.LEFT)
+        tk.Spinbox(speed, from_=1, to=16, width=4, textvariable=self.build_workers_var).pack(side=tk.LEFT, padx=(4, 12))
+        tk.Label(speed, text="Kết nối SMTP").pack(side=tk.LEFT)
+        tk.Spinbox(speed, from_=1, to=8, width=4, textvariable=self.connections_var).pack(side=tk.LEFT, padx=4)
+        speed.grid(row=9, column=0, columnspan=4, sticky="w", padx=6, pady=4)
+
         # Actions
-        tk.Button(self, text="Send", command=self._on_send).grid(row=9, column=0, padx=6, pady=8)
+        self.send_button = tk.Button(self, text="Send", command=self._on_send)
+        self.send_button.grid(row=10, column=0, padx=6, pady=8)
+        self.progress = ttk.Progressbar(self, mode="determinate", maximum=1)
+        self.progress.grid(row=10, column=1, columnspan=2, sticky="ew", padx=6, pady=8)
+        tk.Label(self, textvariable=self.status_var).grid(row=10, column=3, **pad)
 
         # Log area
         self.log = scrolledtext.ScrolledText(self, height=16)
-        self.log.grid(row=10, column=0, columnspan=4, sticky="nsew", padx=6, pady=6)
-        self.grid_rowconfigure(10, weight=1)
+        self.log.grid(row=11, column=0, columnspan=4, sticky="nsew", padx=6, pady=6)
+        self.grid_rowconfigure(11, weight=1)
 
     def _pick_recipients(self) -> None:
         path = filedialog.askopenfilename(title="Chọn recipients", filetypes=[("Excel/CSV", "*.xlsx *.xls *.csv")])
@@ -81,16 +128,78 @@ class MailMergeGUI(tk.Tk):
         if path:
             self.template_var.set(path)
 
-    def _append_log(self, text: str) -> None:
-        self.log.insert(tk.END, text + "\n")
+    def _append_log(self, lines: list) -> None:
+        """Insert a batch of lines at once and trim the widget to MAX_LOG_LINES."""
+        self.log.insert(tk.END, "\n".join(lines) + "\n")
+        excess = int(self.log.index("end-1c").split(".")[0]) - 1 - MAX_LOG_LINES
+        if excess > 0:
+            self.log.delete("1.0", f"{excess + 1}.0")
         self.log.see(tk.END)
 
+    def _show_progress(self, event) -> None:
+        self.progress.configure(maximum=max(1, event.total), value=event.processed)
+        rate = event.processed / event.elapsed * 60 if event.elapsed > 0 else 0.0
+        self.status_var.set(f"{event.processed}/{event.total} • {rate:.1f} email/phút")
+
+    def _pump(self) -> None:
+        """Apply queued worker output on the UI thread, a bounded batch per tick."""
+        lines: list = []
+        latest_event = None
+        try:
+            for _ in range(PUMP_BATCH):
+                kind, payload = self._ui_queue.get_nowait()
+                if kind == "log":
+                    lines.append(payload)
+                elif kind == "event":
+                    latest_event = payload  # counts are cumulative: the last one wins
+                else:
+                    if lines:
+                        self._append_log(lines)
+                        lines = []
+                    self._finish(kind, payload)
+        except queue.Empty:
+            pass
+        if lines:
+            self._append_log(lines)
+        if latest_event is not None:
+            self._show_progress(latest_event)
+        self.after(PUMP_INTERVAL_MS, self._pump)
+
+    def _finish(self, kind: str, payload) -> None:
+        self._running = False
+        self.send_button.configure(state=tk.NORMAL)
+        if kind == "done":
+            self._append_log(["Hoàn tất."])
+        else:
+            messagebox.showerror("Lỗi", payload)
+
     def _on_send(self) -> None:
+        if self._running:
+            return
         try:
             smtp_port = int(self.smtp_port_var.get())
         except ValueError:
             messagebox.showerror("Lỗi", "SMTP Port phải là số")
             return
+        try:
+            rate_delay = max(0.0, float(self.rate_delay_var.get()))
+            build_workers = max(1, int(self.build_workers_var.get()))
+            connections = max(1, int(self.connections_var.get()))
+        except ValueError:
+            messagebox.showerror("Lỗi", "Delay, build workers và kết nối SMTP phải là số")
+            return
+
+        ui_queue = self._ui_queue
+        last_event_at = 0.0
+
+        def on_event(event) -> None:
+            # Rows arrive far faster than the UI repaints; forward only what
+            # the pump needs, but always the start and the end.
+            nonlocal last_event_at
+            now = time.monotonic()
+            if event.kind in (EVENT_STARTED, EVENT_FINISHED) or now - last_event_at >= 0.05:
+                last_event_at = now
+                ui_queue.put(("event", event))
 
         kwargs = dict(
             recipients=self.recipients_var.get(),
@@ -101,19 +210,26 @@ class MailMergeGUI(tk.Tk):
             smtp_pass=self.smtp_pass_var.get(),
             from_name=self.from_name_var.get(),
             default_subject=self.default_subject_var.get(),
-            rate_delay=1.5,
+            rate_delay=rate_delay,
             dry_run=self.dry_run_var.get(),
             use_ssl=self.use_ssl_var.get(),
-            progress_callback=self._append_log,
+            progress_callback=lambda line: ui_queue.put(("log", line)),
+            event_callback=on_event,
+            build_workers=build_workers,
+            connections=connections,
         )
 
         def worker() -> None:
             try:
-                run_merge(**kwargs)
-                self._append_log("Hoàn tất.")
+                summary = run_merge(**kwargs)
+                ui_queue.put(("done", summary))
             except Exception as exc:
-                messagebox.showerror("Lỗi", str(exc))
+                ui_queue.put(("error", str(exc)))
 
+        self._running = True
+        self.send_button.configure(state=tk.DISABLED)
+        self.progress.configure(value=0)
+        self.status_var.set("")
         threading.Thread(target=worker, daemon=True).start()
 
 
@@ -0,0 +1,97 @@
+"""Shrink inline images once per campaign instead of embedding them raw.
+
+Banners straight from the design tool are several times larger than the
+600 px layout of template_compiler.compose_email_html needs, and they are
+embedded into every message. optimize_image() resizes to the layout width,
+recompresses (JPEG quality / PNG optimisation) and drops metadata. Results
+are cached on disk by content hash and memoised per process, so each asset
+is processed once and reused for every message.
+
+Pillow is optional: without it images are embedded unchanged.
+"""
+
+import hashlib
+import io
+import os
+import threading
+from pathlib import Path
+
+try:
+    from PIL import Image, ImageOps  # type: ignore
+except Exception:  # pragma: no cover - optional dependency
+    Image = None
+    ImageOps = None
+
+# Width of the content table in the composed email.
+LAYOUT_WIDTH = 600
+JPEG_QUALITY = 82
+# Bump when the processing changes so cached outputs are regenerated.
+PIPELINE_VERSION = 2
+
+_memo: dict = {}
+_memo_lock = threading.Lock()
+
+
+def _process(data: bytes, subtype: str, max_width: int) -> bytes:
+    img = Image.open(io.BytesIO(data))
+    if getattr(img, "is_animated", False):
+        return data  # keep animated GIF/WebP as they are
+    img = ImageOps.exif_transpose(img)  # apply rotation before the EXIF is dropped
+    # Pillow resizes palette images with NEAREST: resample the colours (and
+    # transparency) instead, and quantize back to as many colours for PNG.
+    palette_colors = len(img.getcolors(256) or ()) if img.mode == "P" else 0
+    if img.width > max_width:
+        if palette_colors:
+            img = img.convert("RGBA")
+        height = max(1, round(img.height * max_width / img.width))
+        img = img.resize((max_width, height), Image.LANCZOS)
+    out = io.BytesIO()
+    if subtype == "jpeg":
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.save(out, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    elif subtype == "png":
+        if palette_colors and img.mode != "P":
+            img = img.quantize(palette_colors, method=Image.Quantize.FASTOCTREE)
+        img.save(out, "PNG", optimize=True)
+    else:
+        return data
+    result = out.getvalue()
+    # Recompressing an already small file can make it bigger: keep the smaller.
+    return result if len(result) < len(data) else data
+
+
+def optimize_image(path, subtype: str, cache_dir=None, max_width: int = LAYOUT_WIDTH) -> bytes:
+    """Return the bytes to embed for the image at path (optimised if possible)."""
+    path = Path(path)
+    st = path.stat()
+    key = (str(path), st.st_mtime_ns, st.st_size, subtype, max_width)
+    with _memo_lock:
+        cached = _memo.get(key)
+    if cached is not None:
+        return cached
+
+    data = path.read_bytes()
+    if Image is None or subtype not in ("jpeg", "png"):
+        result = data
+    else:
+        digest = hashlib.sha256(data).hexdigest()
+        out_path = Path(cache_dir) / f"{digest}.w{max_width}.v{PIPELINE_VERSION}.{subtype}" if cache_dir else None
+        if out_path is not None and out_path.exists():
+            result = out_path.read_bytes()
+        else:
+            try:
+                result = _process(data, subtype, max_width)
+            except Exception:
+                result = data  # unreadable image: embed as is
+            if out_path is not None:
+                try:
+                    out_path.parent.mkdir(parents=True, exist_ok=True)
+                    tmp = out_path.with_name(out_path.name + f".{os.getpid()}.tmp")
+                    tmp.write_bytes(result)
+                    os.replace(tmp, out_path)
+                except OSError:
+                    pass
+    with _memo_lock:
+        _memo[key] = result
+    return result
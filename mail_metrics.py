@@ -0,0 +1,210 @@
+"""Lightweight Prometheus-style metrics for running campaigns.
+
+No external dependency: metrics are kept in-process and exposed either via a
+tiny HTTP endpoint (``start_http_server``) or written to a textfile for the
+node_exporter textfile collector (``write_textfile``).
+"""
+
+import bisect
+import os
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# Default buckets (seconds) for SMTP latency
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _fmt(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+    def expose(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} counter",
+            f"{self.name} {_fmt(self._value)}",
+        ]
+
+
+class Gauge:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._value = 0.0
+        self._fn = None
+        self._lock = threading.Lock()
+
+    def set(self, value: float) -> None:
+        self._value = float(value)
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self._value -= amount
+
+    def set_function(self, fn) -> None:
+        """Compute the value lazily at scrape time."""
+        self._fn = fn
+
+    @property
+    def value(self) -> float:
+        return float(self._fn()) if self._fn is not None else self._value
+
+    def expose(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {_fmt(self.value)}",
+        ]
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sum += value
+            self._count += 1
+
+    def expose(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} histogram",
+        ]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self._counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{_fmt(bound)}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {_fmt(self._sum)}")
+        lines.append(f"{self.name}_count {self._count}")
+        return lines
+
+
+class RateMeter:
+    """Events per second over a sliding time window."""
+
+    def __init__(self, window: float = 60.0):
+        self.window = window
+        self._events: deque = deque()
+        self._lock = threading.Lock()
+
+    def mark(self, now: float | None = None) -> None:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._events.append(now)
+            self._trim(now)
+
+    def rate(self, now: float | None = None) -> float:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._trim(now)
+            if not self._events:
+                return 0.0
+            span = max(now - self._events[0], 1.0)
+            return len(self._events) / min(span, self.window)
+
+    def _trim(self, now: float) -> None:
+        cutoff = now - self.window
+        while self._events and self._events[0] < cutoff:
+            self._events.popleft()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for m in self._metrics:
+            lines.extend(m.expose())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+MESSAGES_SENT = REGISTRY.register(Counter("mailmerge_messages_sent_total", "Messages accepted by the SMTP server."))
+MESSAGES_FAILED = REGISTRY.register(Counter("mailmerge_messages_failed_total", "Rows that failed (invalid address or send error)."))
+MESSAGES_SKIPPED = REGISTRY.register(Counter("mailmerge_messages_skipped_total", "Rows skipped as duplicate, suppressed or already sent."))
+MESSAGES_RETRIED = REGISTRY.register(Counter("mailmerge_messages_retried_total", "Send attempts retried after a transient error."))
+QUEUE_DEPTH = REGISTRY.register(Gauge("mailmerge_queue_depth", "Rows still waiting to be processed in running campaigns."))
+SEND_RATE = REGISTRY.register(Gauge("mailmerge_send_rate", "Messages sent per second over the last minute."))
+CAMPAIGNS_RUNNING = REGISTRY.register(Gauge("mailmerge_campaigns_running", "Number of campaigns currently running."))
+SMTP_LATENCY = REGISTRY.register(Histogram("mailmerge_smtp_latency_seconds", "Time to deliver one message over SMTP."))
+
+SEND_METER = RateMeter()
+SEND_RATE.set_function(SEND_METER.rate)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):  # noqa: N802 (http.server naming)
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # silence per-request logging
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_http_server(port: int, addr: str = "0.0.0.0"):
+    """Serve /metrics on a daemon thread. Safe to call more than once."""
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+        return _server
+
+
+def write_textfile(path: str) -> None:
+    """Atomically write the current metrics for the node_exporter textfile collector."""
+    target = Path(path)
+    tmp = target.with_name(target.name + f".{os.getpid()}.tmp")
+    tmp.write_text(REGISTRY.render(), encoding="utf-8")
+    os.replace(tmp, target)
@@ -0,0 +1,245 @@
+"""Streaming loaders for recipient files.
+
+Rows are never materialised all at once: loaders return a RecipientTable
+whose iterrows() re-reads the source, so memory stays flat whether the
+sheet has a thousand rows or a million.
+
+CSV files are streamed with the csv module (CSV-only runs never import
+pandas). Cells stay the text in the file: unlike pd.read_csv there is no
+numeric coercion, so "00123" keeps its leading zeros and "1.50" is not
+rewritten to 1.5.
+
+Parsing .xlsx with openpyxl costs seconds for multi-MB files, and recurring
+campaigns load the same file again and again (CLI runs, Streamlit previews).
+The first load streams the sheet into a cache file of pickled column-
+oriented chunks keyed by the SHA-256 of the file content; later loads of
+identical bytes skip the XML parsing entirely and read chunk by chunk.
+"""
+
+import csv
+import hashlib
+import io
+import os
+import pickle
+import shutil
+import tempfile
+from pathlib import Path
+
+# Bump when the on-disk layout changes so stale entries are ignored.
+CACHE_VERSION = 2
+# Keep only the most recently used entries.
+MAX_ENTRIES = 32
+# Rows per pickled chunk: bounds memory while reading a cached sheet.
+CHUNK_ROWS = 2000
+
+
+class RecipientTable:
+    """Recipient rows behind the small DataFrame API run_merge uses.
+
+    open_rows() must return a fresh iterator of row dicts on every call;
+    df[col] = value adds a missing column filled with a constant.
+    """
+
+    def __init__(self, columns: list, open_rows, length: int):
+        self.columns = list(columns)
+        self._open_rows = open_rows
+        self._length = length
+        self._defaults: dict = {}
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __setitem__(self, column, value) -> None:
+        if column not in self.columns:
+            self.columns.append(column)
+        self._defaults[column] = value
+
+    def iterrows(self):
+        for i, row in enumerate(self._open_rows()):
+            for column, value in self._defaults.items():
+                row.setdefault(column, value)
+            yield i, row
+
+
+def _csv_rows(fh):
+    for row in csv.DictReader(fh, restval=""):
+        row.pop(None, None)  # cells beyond the header row
+        yield row
+
+
+def read_csv_table(source) -> RecipientTable:
+    """Read a CSV (path or binary file-like object) without pandas."""
+    if hasattr(source, "read"):
+        # Uploads are already in memory; keep their rows.
+        fh = io.TextIOWrapper(source, encoding="utf-8-sig", newline="")
+        try:
+            rows = list(_csv_rows(fh))
+            fh.seek(0)
+            columns = csv.DictReader(fh).fieldnames or []
+        finally:
+            fh.detach()  # leave the caller's buffer open
+        return RecipientTable(columns, lambda: iter(rows), len(rows))
+
+    path = Path(source)
+    with open(path, encoding="utf-8-sig", newline="") as fh:
+        reader = csv.DictReader(fh)
+        columns = reader.fieldnames or []
+        count = sum(1 for _ in reader)
+
+    def open_rows():
+        with open(path, encoding="utf-8-sig", newline="") as fh:
+            yield from _csv_rows(fh)
+
+    return RecipientTable(columns, open_rows, count)
+
+
+def content_digest(source) -> str:
+    """SHA-256 of bytes, or of a file read in blocks."""
+    if isinstance(source, (bytes, bytearray)):
+        return hashlib.sha256(source).hexdigest()
+    h = hashlib.sha256()
+    with open(source, "rb") as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _entry_path(cache_dir: Path, digest: str) -> Path:
+    return cache_dir / f"{digest}.v{CACHE_VERSION}.pkl"
+
+
+def _prune(cache_dir: Path, keep: int = MAX_ENTRIES) -> None:
+    try:
+        entries = sorted(cache_dir.glob("*.pkl"), key=lambda p: p.stat().st_mtime, reverse=True)
+    except OSError:
+        return
+    for p in entries[keep:]:
+        try:
+            p.unlink()
+        except OSError:
+            pass
+
+
+def _unique_columns(header) -> list:
+    """Column names as pandas labels them (Unnamed: N, duplicates as X.1)."""
+    columns: list = []
+    for i, name in enumerate(header):
+        name = f"Unnamed: {i}" if name is None or str(name).strip() == "" else str(name)
+        base, n = name, 0
+        while name in columns:
+            n += 1
+            name = f"{base}.{n}"
+        columns.append(name)
+    return columns
+
+
+def _sheet_rows(source, suffix: str):
+    """Yield the header, then each data row as a tuple of cell values."""
+    if suffix == ".xls":
+        import pandas as pd  # legacy format: openpyxl cannot read it
+
+        df = pd.read_excel(source)
+        yield list(df.columns)
+        yield from df.itertuples(index=False, name=None)
+        return
+
+    from openpyxl import load_workbook  # deferred: only Excel needs it
+
+    wb = load_workbook(source, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        yield next(rows, ())
+        blank = 0
+        for row in rows:
+            # Like pandas, drop trailing blank rows but keep blank rows in between.
+            if all(v is None for v in row):
+                blank += 1
+                continue
+            for _ in range(blank):
+                yield ()
+            blank = 0
+            yield row
+    finally:
+        wb.close()
+
+
+def _write_cache(path: Path, source, suffix: str) -> None:
+    rows = _sheet_rows(source, suffix)
+    columns = _unique_columns(next(rows, ()))
+    count = 0
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryFile(dir=path.parent) as body:
+        chunk: list = []
+
+        def flush():
+            # Column-oriented chunk; empty cells become "" like normalize_field would.
+            data = {c: [r[i] if i < len(r) and r[i] is not None else "" for r in chunk] for i, c in enumerate(columns)}
+            pickle.dump(data, body, protocol=pickle.HIGHEST_PROTOCOL)
+            chunk.clear()
+
+        for row in rows:
+            chunk.append(row)
+            count += 1
+            if len(chunk) >= CHUNK_ROWS:
+                flush()
+        if chunk:
+            flush()
+        body.seek(0)
+        tmp = path.with_name(path.name + f".{os.getpid()}.tmp")
+        with open(tmp, "wb") as fh:
+            pickle.dump({"columns": columns, "rows": count}, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            shutil.copyfileobj(body, fh)
+        os.replace(tmp, path)
+
+
+def _read_cache(path: Path) -> RecipientTable:
+    with open(path, "rb") as fh:
+        header = pickle.load(fh)
+    columns = header["columns"]
+
+    def open_rows():
+        with open(path, "rb") as fh:
+            pickle.load(fh)  # header
+            while True:
+                try:
+                    chunk = pickle.load(fh)
+                except EOFError:
+                    return
+                for values in zip(*(chunk[c] for c in columns)):
+                    yield dict(zip(columns, values))
+
+    return RecipientTable(columns, open_rows, header["rows"])
+
+
+def read_excel_cached(source, cache_dir) -> RecipientTable:
+    """Read the first sheet of an Excel file through the content-addressed cache.
+
+    source is a path or a binary file-like object with a name (e.g. a
+    Streamlit upload). If cache_dir is not writable a private temporary
+    directory is used instead, so loading never fails because of the cache.
+    """
+    if hasattr(source, "read"):
+        suffix = Path(getattr(source, "name", "") or "").suffix
+        source = io.BytesIO(source.read())
+        digest = content_digest(source.getvalue())
+    else:
+        suffix = Path(source).suffix
+        digest = content_digest(source)
+    path = _entry_path(Path(cache_dir), digest)
+
+    if path.exists():
+        try:
+            table = _read_cache(path)
+            os.utime(path)  # mark as recently used for pruning
+            return table
+        except Exception:
+            pass
+    try:
+        _write_cache(path, source, suffix.lower())
+    except OSError:
+        path = _entry_path(Path(tempfile.mkdtemp(prefix="mailmerge_rcpt_")), digest)
+        if hasattr(source, "seek"):
+            source.seek(0)
+        _write_cache(path, source, suffix.lower())
+    _prune(path.parent)
+    return _read_cache(path)
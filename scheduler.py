@@ -0,0 +1,427 @@
+"""Persistent scheduler for deferred and windowed campaigns (SQLite).
+
+A job is a set of run_merge() arguments plus a start time, an optional
+daily send window ("22:00"-"06:00", may wrap midnight) and an optional
+daily cap. A worker thread claims due jobs and runs them in slices: a
+slice stops when the window closes or the cap is reached, and the next
+slice resumes where it left off because every job has its own campaign id
+and runs incrementally: rows already sent are skipped by their row
+fingerprint (see campaign_state.py), so a sheet that mails one address
+several times (one row per document) loses none of those rows.
+
+SMTP passwords are never written to the database: they are kept in memory
+(Scheduler.secrets, e.g. typed into the UI) or read from SMTP_PASS.
+
+    python scheduler.py add --recipients r.xlsx --template t.html --start "2024-05-01 22:00" --window 22:00-06:00 --daily-cap 500
+    python scheduler.py worker
+    python scheduler.py list
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from send_mail_merge import EVENT_ROW_SENT, STATE_DIR, run_merge
+
+SCHEDULER_DB = STATE_DIR / "scheduler.sqlite3"
+
+STATUS_PENDING = "pending"    # waiting for start time / window / next day
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+
+# A running job without heartbeat for this long is considered orphaned
+# (worker killed) and becomes pending again.
+STALE_AFTER = 300.0
+# A running slice refreshes its heartbeat this often, from its own thread:
+# a long sheet load or a slow SMTP server produces no progress events.
+HEARTBEAT_INTERVAL = 30.0
+# Progress counters are written to the database at most this often.
+PROGRESS_INTERVAL = 2.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL DEFAULT '',
+    params TEXT NOT NULL,
+    start_at TEXT NOT NULL,
+    window_start TEXT NOT NULL DEFAULT '',
+    window_end TEXT NOT NULL DEFAULT '',
+    daily_cap INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL,
+    next_run_at TEXT NOT NULL,
+    total INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    message TEXT NOT NULL DEFAULT '',
+    heartbeat REAL NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS daily_sent (
+    job_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    sent INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (job_id, day)
+);
+"""
+
+_TIME_FMT = "%Y-%m-%d %H:%M:%S"
+
+
+def _fmt(dt: datetime) -> str:
+    return dt.strftime(_TIME_FMT)
+
+
+def _hm(value: str) -> tuple[int, int]:
+    h, m = value.strip().split(":")
+    return int(h), int(m)
+
+
+def _at(day: datetime, hm: str) -> datetime:
+    h, m = _hm(hm)
+    return day.replace(hour=h, minute=m, second=0, microsecond=0)
+
+
+def current_window(now: datetime, start: str, end: str) -> tuple[datetime, datetime] | None:
+    """(open, close) of the window containing now, or None if outside.
+
+    No window (empty start/end) means always open, closing at midnight so
+    daily caps roll over with the calendar day.
+    """
+    if not start or not end:
+        day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        return day, day + timedelta(days=1)
+    for offset in (0, -1):  # a window wrapping midnight may have opened yesterday
+        opens = _at(now + timedelta(days=offset), start)
+        closes = _at(opens, end)
+        if closes <= opens:
+            closes += timedelta(days=1)
+        if opens <= now < closes:
+            return opens, closes
+    return None
+
+
+def next_window_open(now: datetime, start: str, end: str) -> datetime:
+    """First window opening at or after now (next midnight without a window)."""
+    opens = _at(now, start) if start and end else now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return opens if opens >= now else opens + timedelta(days=1)
+
+
+class Scheduler:
+    def __init__(self, path=SCHEDULER_DB, poll_interval: float = 30.0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self.poll_interval = poll_interval
+        self.secrets: dict = {}  # job id -> SMTP password, never persisted
+        self._wake = threading.Event()
+        self._shutdown = threading.Event()
+        self._thread = None
+        self._active: dict = {}  # job id -> stop event of the running slice
+
+    # ---- job management ----
+
+    def add_job(self, params: dict, start_at: datetime | None = None, window: tuple[str, str] | None = None,
+                daily_cap: int = 0, name: str = "", smtp_pass: str = "") -> int:
+        """Persist a job; params are run_merge keyword arguments (password excluded)."""
+        params = {k: v for k, v in params.items() if k != "smtp_pass"}
+        window_start, window_end = window or ("", "")
+        if window_start or window_end:
+            _hm(window_start), _hm(window_end)  # validate "HH:MM"
+        start = _fmt(start_at or datetime.now())
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO jobs(name, params, start_at, window_start, window_end, daily_cap, status, next_run_at, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, "{}", start, window_start, window_end, int(daily_cap), STATUS_PENDING, start, _fmt(datetime.now())),
+            )
+            job_id = cur.lastrowid
+            params.setdefault("campaign_id", f"schedule-{job_id}")
+            self._conn.execute("UPDATE jobs SET params = ? WHERE id = ?", (json.dumps(params, ensure_ascii=False), job_id))
+            self._conn.commit()
+        if smtp_pass:
+            self.secrets[job_id] = smtp_pass
+        self._wake.set()
+        return job_id
+
+    def jobs(self) -> list[dict]:
+        with self._lock:
+            cur = self._conn.execute("SELECT * FROM jobs ORDER BY id DESC")
+            cols = [c[0] for c in cur.description]
+            return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+    def cancel(self, job_id: int) -> None:
+        self._update(job_id, status=STATUS_CANCELLED, message="Đã huỷ")
+        stop = self._active.get(job_id)
+        if stop is not None:
+            stop.set()
+
+    def sent_on(self, job_id: int, day: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT sent FROM daily_sent WHERE job_id = ? AND day = ?", (job_id, day)).fetchone()
+        return row[0] if row else 0
+
+    def _update(self, job_id: int, **fields) -> None:
+        cols = ", ".join(f"{k} = ?" for k in fields)
+        with self._lock:
+            self._conn.execute(f"UPDATE jobs SET {cols} WHERE id = ?", (*fields.values(), job_id))
+            self._conn.commit()
+
+    def _claim_due(self, now: datetime) -> dict | None:
+        """Atomically mark one due job as running (safe with several workers)."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = ? WHERE status = ? AND heartbeat < ?",
+                (STATUS_PENDING, STATUS_RUNNING, time.time() - STALE_AFTER),
+            )
+            cur = self._conn.execute(
+                "SELECT * FROM jobs WHERE status = ? AND next_run_at <= ? ORDER BY next_run_at, id",
+                (STATUS_PENDING, _fmt(now)),
+            )
+            cols = [c[0] for c in cur.description]
+            for row in cur.fetchall():
+                job = dict(zip(cols, row))
+                claimed = self._conn.execute(
+                    "UPDATE jobs SET status = ?, heartbeat = ? WHERE id = ? AND status = ?",
+                    (STATUS_RUNNING, time.time(), job["id"], STATUS_PENDING),
+                ).rowcount
+                self._conn.commit()
+                if claimed:
+                    return job
+        return None
+
+    # ---- execution ----
+
+    def run_pending(self, now: datetime | None = None) -> bool:
+        """Run one slice of the next due job. Returns False if nothing was due."""
+        now = now or datetime.now()
+        job = self._claim_due(now)
+        if job is None:
+            return False
+        job_id = job["id"]
+        window = current_window(now, job["window_start"], job["window_end"])
+        if window is None:
+            nxt = next_window_open(now, job["window_start"], job["window_end"])
+            self._update(job_id, status=STATUS_PENDING, next_run_at=_fmt(nxt), message=f"Chờ khung giờ gửi ({_fmt(nxt)})")
+            return True
+        opens, closes = window
+        day = opens.strftime("%Y-%m-%d")
+        allowance = 0
+        if job["daily_cap"] > 0:
+            allowance = job["daily_cap"] - self.sent_on(job_id, day)
+            if allowance <= 0:
+                nxt = next_window_open(closes, job["window_start"], job["window_end"])
+                self._update(job_id, status=STATUS_PENDING, next_run_at=_fmt(nxt), message=f"Đủ giới hạn ngày, tiếp tục lúc {_fmt(nxt)}")
+                return True
+
+        params = json.loads(job["params"])
+        params["smtp_pass"] = self.secrets.get(job_id) or os.getenv("SMTP_PASS", "")
+        if not params.get("dry_run") and not params["smtp_pass"]:
+            self._update(job_id, status=STATUS_FAILED, message="Thiếu mật khẩu SMTP (SMTP_PASS)")
+            return True
+        params.setdefault("suppression_db", str(STATE_DIR / "suppression.sqlite3"))
+        # Resume per row, not per address: the campaign's address-level sent
+        # history would skip every later row repeating an address.
+        params["incremental"] = True
+
+        stop = threading.Event()
+        reason = {"why": ""}
+        counts = {"sent": 0, "recorded": 0, "failed": 0, "processed": 0, "total": job["total"], "flushed": 0.0}
+
+        def flush():
+            self._flush_sent(job_id, day, counts["sent"] - counts["recorded"])
+            counts["recorded"] = counts["sent"]
+
+        def halt(why: str):
+            reason["why"] = reason["why"] or why
+            stop.set()
+
+        def on_event(ev):
+            counts["total"] = ev.total
+            counts["failed"] = ev.failed
+            counts["processed"] = ev.processed
+            if ev.kind == EVENT_ROW_SENT:
+                counts["sent"] += 1
+                if allowance and counts["sent"] >= allowance:
+                    halt("cap")
+            t = time.monotonic()
+            if t - counts["flushed"] >= PROGRESS_INTERVAL:
+                counts["flushed"] = t
+                flush()
+                self._update(job_id, total=counts["total"], sent=job["sent"] + counts["sent"])
+
+        finished = threading.Event()
+
+        def beat():
+            while not finished.wait(HEARTBEAT_INTERVAL):
+                try:
+                    self._update(job_id, heartbeat=time.time())
+                except sqlite3.Error as exc:
+                    print(f"[scheduler] heartbeat #{job_id}: {exc}")
+
+        threading.Thread(target=beat, name=f"mailmerge-heartbeat-{job_id}", daemon=True).start()
+        timer = threading.Timer(max(0.0, (closes - now).total_seconds()), halt, args=("window",))
+        timer.daemon = True
+        timer.start()
+        self._active[job_id] = stop
+        self._update(job_id, message=f"Đang gửi (đến {closes.strftime('%H:%M')})")
+        try:
+            run_merge(
+                progress_callback=lambda _msg: None,
+                event_callback=on_event,
+                stop_event=stop,
+                send_limit=max(0, allowance),
+                **params,
+            )
+        except Exception as exc:
+            flush()
+            self._update(job_id, status=STATUS_FAILED, message=str(exc), sent=job["sent"] + counts["sent"])
+            return True
+        finally:
+            finished.set()
+            timer.cancel()
+            self._active.pop(job_id, None)
+
+        flush()
+        fields = {"total": counts["total"], "sent": job["sent"] + counts["sent"], "failed": counts["failed"]}
+        if self._status(job_id) == STATUS_CANCELLED:
+            self.secrets.pop(job_id, None)
+        elif reason["why"] or counts["processed"] < counts["total"]:
+            # Stopped early: by the window timer, or by the cap (here or inside run_merge).
+            nxt = next_window_open(closes, job["window_start"], job["window_end"])
+            why = "Hết khung giờ gửi" if reason["why"] == "window" else "Đủ giới hạn ngày"
+            fields.update(status=STATUS_PENDING, next_run_at=_fmt(nxt), message=f"{why}, tiếp tục lúc {_fmt(nxt)}")
+        else:
+            fields.update(status=STATUS_DONE, message="Hoàn tất")
+            self.secrets.pop(job_id, None)
+        self._update(job_id, **fields)
+        return True
+
+    def _status(self, job_id: int) -> str:
+        with self._lock:
+            row = self._conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row else ""
+
+    def _flush_sent(self, job_id: int, day: str, sent: int) -> None:
+        if not sent:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO daily_sent(job_id, day, sent) VALUES (?, ?, ?)"
+                " ON CONFLICT(job_id, day) DO UPDATE SET sent = sent + excluded.sent",
+                (job_id, day, sent),
+            )
+            self._conn.commit()
+
+    # ---- worker thread ----
+
+    def _loop(self):
+        while not self._shutdown.is_set():
+            try:
+                busy = self.run_pending()
+            except Exception as exc:
+                print(f"[scheduler] {exc}")
+                busy = False
+            if not busy:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def start(self) -> "Scheduler":
+        """Start the background worker. Safe to call more than once."""
+        if self._thread is None or not self._thread.is_alive():
+            self._shutdown.clear()
+            self._thread = threading.Thread(target=self._loop, name="mailmerge-scheduler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._shutdown.set()
+        self._wake.set()
+        for ev in list(self._active.values()):
+            ev.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lịch gửi email (hẹn giờ, khung giờ, giới hạn/ngày).")
+    parser.add_argument("--db", default=str(SCHEDULER_DB), help="Đường dẫn file SQLite lịch gửi")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_add = sub.add_parser("add", help="Thêm lịch gửi")
+    p_add.add_argument("--recipients", required=True)
+    p_add.add_argument("--template", required=True)
+    p_add.add_argument("--smtp-host", default=os.getenv("SMTP_HOST", ""))
+    p_add.add_argument("--smtp-port", type=int, default=int(os.getenv("SMTP_PORT", "587")))
+    p_add.add_argument("--smtp-user", default=os.getenv("SMTP_USER", ""))
+    p_add.add_argument("--use-ssl", action="store_true")
+    p_add.add_argument("--from-name", default=os.getenv("FROM_NAME", ""))
+    p_add.add_argument("--default-subject", default="")
+    p_add.add_argument("--rate-delay", type=float, default=2.0)
+    p_add.add_argument("--base-dir", default="")
+    p_add.add_argument("--dry-run", action="store_true")
+    p_add.add_argument("--connections", type=int, default=1)
+    p_add.add_argument("--name", default="")
+    p_add.add_argument("--start", default="", help="Thời điểm bắt đầu 'YYYY-MM-DD HH:MM' (mặc định: ngay)")
+    p_add.add_argument("--window", default="", help="Khung giờ gửi hằng ngày, vd 22:00-06:00")
+    p_add.add_argument("--daily-cap", type=int, default=0, help="Số email tối đa mỗi ngày (0 = không giới hạn)")
+    sub.add_parser("list", help="Liệt kê lịch gửi")
+    p_cancel = sub.add_parser("cancel", help="Huỷ lịch gửi")
+    p_cancel.add_argument("job_id", type=int)
+    p_worker = sub.add_parser("worker", help="Chạy worker xử lý lịch gửi (chạy liên tục)")
+    p_worker.add_argument("--poll", type=float, default=30.0, help="Chu kỳ kiểm tra (giây)")
+    args = parser.parse_args()
+
+    sched = Scheduler(args.db, poll_interval=getattr(args, "poll", 30.0))
+    try:
+        if args.cmd == "add":
+            params = {
+                "recipients": str(Path(args.recipients).resolve()),
+                "template": str(Path(args.template).resolve()),
+                "smtp_host": args.smtp_host,
+                "smtp_port": args.smtp_port,
+                "smtp_user": args.smtp_user,
+                "use_ssl": args.use_ssl,
+                "from_name": args.from_name,
+                "rate_delay": args.rate_delay,
+                "dry_run": args.dry_run,
+                "connections": args.connections,
+                "base_dir": args.base_dir or None,
+            }
+            if args.default_subject:
+                params["default_subject"] = args.default_subject
+            start = datetime.strptime(args.start, "%Y-%m-%d %H:%M") if args.start else None
+            window = tuple(args.window.split("-", 1)) if args.window else None
+            job_id = sched.add_job(params, start_at=start, window=window, daily_cap=args.daily_cap, name=args.name)
+            print(f"Đã thêm lịch gửi #{job_id}")
+        elif args.cmd == "list":
+            for j in sched.jobs():
+                window = f"{j['window_start']}-{j['window_end']}" if j["window_start"] else "-"
+                print(f"#{j['id']} {j['status']:<9} {j['sent']}/{j['total']} start={j['start_at']} window={window} cap={j['daily_cap'] or '-'} {j['message']}")
+        elif args.cmd == "cancel":
+            sched.cancel(args.job_id)
+        elif args.cmd == "worker":
+            print(f"Scheduler worker: {sched.path}")
+            sched.start()
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                sched.stop()
+    finally:
+        sched.close()
+
+
+if __name__ == "__main__":
+    main()
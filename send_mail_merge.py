@@ -1,11 +1,20 @@
 import argparse
+import bisect
+import concurrent.futures
+import hashlib
+import json
 import os
+import queue
 import smtplib
 import ssl
+import threading
 import time
 import mimetypes
 import re
 import tempfile
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import datetime
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -13,15 +22,239 @@ from email.mime.image import MIMEImage
 from email.mime.application import MIMEApplication
 from email.utils import formataddr, make_msgid
 from urllib.parse import urlparse
-import pandas as pd
-import requests
 from pathlib import Path
 
+import dkim_signer
+import mail_metrics
+from campaign_state import CampaignState, row_fingerprint
+from image_optimizer import optimize_image
+from recipient_cache import read_csv_table, read_excel_cached
+from template_compiler import compile_template
+from spool import Spool, STATUS_SENT, STATUS_FAILED
+from suppression import SuppressionStore, normalize_address, REASON_HARD_BOUNCE
+
 REQUIRED_COLS = ["Email", "Ten"]
 OPTIONAL_COLS = ["Subject", "CC", "BCC", "FilePDF", "Code"]
 
-import re
-import pandas as pd  # local import for script
+# Local state (suppression list, caches, ...). Override with MAILMERGE_STATE_DIR.
+STATE_DIR = Path(os.getenv("MAILMERGE_STATE_DIR") or (Path(__file__).parent / ".mailmerge"))
+# Parsed recipient spreadsheets, keyed by content hash (see recipient_cache).
+RECIPIENTS_CACHE_DIR = STATE_DIR / "recipients"
+# Resized/recompressed inline images, keyed by content hash (see image_optimizer).
+IMAGE_CACHE_DIR = STATE_DIR / "images"
+# Fingerprints of delivered rows for incremental campaigns (see campaign_state).
+CAMPAIGN_STATE_DB = STATE_DIR / "campaigns.sqlite3"
+
+# Stages timed for every message (load is recorded once per run).
+TIMING_STAGES = ("load", "render", "inline_images", "attach", "sign", "connect", "auth", "send")
+# Upper bounds (milliseconds) of the histogram buckets; the last bucket is open-ended.
+TIMING_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# Upper bounds (KiB) of the serialised message size histogram.
+SIZE_BUCKETS_KB = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000)
+
+class MessageTimings:
+    """Stage durations (milliseconds) of a single message.
+
+    Travels with the message through the build and send workers and is
+    handed to StageTimings.record() once the message is finished.
+    """
+
+    __slots__ = ("stages", "size")
+
+    def __init__(self, stages: dict | None = None):
+        self.stages: dict[str, float] = dict(stages) if stages else {}
+        self.size = 0  # serialised message bytes, once built
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def add(self, name: str, seconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + seconds * 1000.0
+
+
+class ErrorLog:
+    """(email, error) pairs of failed rows.
+
+    The first max_in_memory entries stay in a list; past that everything is
+    spilled to an anonymous temp file so a run with millions of bad rows
+    does not grow without bound. Iterating yields all entries in order.
+    """
+
+    def __init__(self, max_in_memory: int = 1000):
+        self.max_in_memory = max_in_memory
+        self._items: list = []
+        self._file = None
+        self._count = 0
+
+    def append(self, item: tuple) -> None:
+        self._count += 1
+        if self._file is None and len(self._items) < self.max_in_memory:
+            self._items.append(item)
+            return
+        if self._file is None:
+            self._file = tempfile.TemporaryFile("w+", encoding="utf-8")
+            for it in self._items:
+                self._file.write(json.dumps(list(it), ensure_ascii=False) + "\n")
+            self._items = []
+        self._file.write(json.dumps(list(item), ensure_ascii=False) + "\n")
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self):
+        if self._file is None:
+            yield from list(self._items)
+            return
+        self._file.flush()
+        self._file.seek(0)
+        for line in self._file:
+            yield tuple(json.loads(line))
+        self._file.seek(0, os.SEEK_END)
+
+
+class StageTimings:
+    """Aggregate per-message stage durations into histograms.
+
+    Each stage keeps only fixed-size counters (count, sum, min, max, bucket
+    counts), so memory does not grow with the number of messages. When
+    jsonl_path is given, one JSON line per message is appended for offline
+    analysis.
+    """
+
+    def __init__(self, jsonl_path: str | None = None):
+        self._hist: dict[str, dict] = {}
+        self._size = {"count": 0, "sum": 0, "min": 0, "max": 0, "buckets": [0] * (len(SIZE_BUCKETS_KB) + 1)}
+        self._jsonl = open(jsonl_path, "a", encoding="utf-8") if jsonl_path else None
+
+    def _observe(self, name: str, ms: float) -> None:
+        h = self._hist.get(name)
+        if h is None:
+            h = self._hist[name] = {
+                "count": 0,
+                "sum_ms": 0.0,
+                "min_ms": ms,
+                "max_ms": ms,
+                "buckets": [0] * (len(TIMING_BUCKETS_MS) + 1),
+            }
+        h["count"] += 1
+        h["sum_ms"] += ms
+        if ms < h["min_ms"]:
+            h["min_ms"] = ms
+        if ms > h["max_ms"]:
+            h["max_ms"] = ms
+        h["buckets"][bisect.bisect_left(TIMING_BUCKETS_MS, ms)] += 1
+
+    def record(self, row_index, email: str, status: str, timings: MessageTimings | None = None) -> None:
+        """Add one finished message to the histograms and write it out if enabled."""
+        stages = timings.stages if timings is not None else {}
+        for name, ms in stages.items():
+            self._observe(name, ms)
+        size = timings.size if timings is not None else 0
+        if size:
+            h = self._size
+            h["min"] = size if not h["count"] else min(h["min"], size)
+            h["max"] = max(h["max"], size)
+            h["count"] += 1
+            h["sum"] += size
+            h["buckets"][bisect.bisect_left(SIZE_BUCKETS_KB, size / 1024)] += 1
+        if self._jsonl is not None:
+            record = {
+                "row": row_index,
+                "email": email,
+                "status": status,
+                "stages_ms": {k: round(v, 3) for k, v in stages.items()},
+            }
+            if size:
+                record["bytes"] = size
+            self._jsonl.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    def summary(self) -> dict:
+        out = {}
+        for name, h in self._hist.items():
+            labels = [f"le_{b}ms" for b in TIMING_BUCKETS_MS] + ["inf"]
+            out[name] = {
+                "count": h["count"],
+                "total_ms": round(h["sum_ms"], 3),
+                "mean_ms": round(h["sum_ms"] / h["count"], 3),
+                "min_ms": round(h["min_ms"], 3),
+                "max_ms": round(h["max_ms"], 3),
+                "buckets": dict(zip(labels, h["buckets"])),
+            }
+        return out
+
+    def size_summary(self) -> dict:
+        """Serialised message sizes; p95 is the upper bound of its histogram bucket."""
+        h = self._size
+        if not h["count"]:
+            return {"messages": 0, "total_bytes": 0}
+        p95 = None
+        seen = 0
+        for bound, n in zip(SIZE_BUCKETS_KB + (None,), h["buckets"]):
+            seen += n
+            if seen >= 0.95 * h["count"]:
+                p95 = bound * 1024 if bound is not None else h["max"]
+                break
+        return {
+            "messages": h["count"],
+            "total_bytes": h["sum"],
+            "mean_bytes": h["sum"] // h["count"],
+            "min_bytes": h["min"],
+            "max_bytes": h["max"],
+            "p95_bytes": min(p95, h["max"]),
+        }
+
+    def close(self) -> None:
+        if self._jsonl is not None:
+            self._jsonl.close()
+            self._jsonl = None
+
+
+# Kinds of ProgressEvent emitted by run_merge, in lifecycle order.
+EVENT_STARTED = "started"
+EVENT_ROW_SENT = "row_sent"
+EVENT_ROW_FAILED = "row_failed"
+EVENT_ROW_SKIPPED = "row_skipped"
+EVENT_RETRY = "retry"
+EVENT_FINISHED = "finished"
+
+
+@dataclass(frozen=True)
+class ProgressEvent:
+    """Structured progress update passed to run_merge's event_callback.
+
+    sent/failed/total are running counts for the whole campaign, so a
+    consumer can render progress from the latest event alone.
+    """
+
+    kind: str
+    total: int
+    sent: int
+    failed: int
+    elapsed: float
+    row_index: int | None = None
+    email: str = ""
+    detail: str = ""
+    attempt: int = 0
+    skipped: int = 0
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed + self.skipped
+
+
+@contextmanager
+def _timed(timings: MessageTimings | None, name: str):
+    if timings is None:
+        yield
+    else:
+        with timings.stage(name):
+            yield
+
 
 def is_valid_email(email: str) -> bool:
     """Very basic check for email format."""
@@ -37,6 +270,8 @@ def normalize_field(value: object) -> str:
         if 'pandas' in str(type(value)).lower():
             # Fallback if a pandas NA type sneaks in; convert to empty
             try:
+                import pandas as pd  # already loaded if a pandas value is present
+
                 if pd.isna(value):
                     return ""
             except Exception:
@@ -49,12 +284,13 @@ def normalize_field(value: object) -> str:
         s = str(value).strip()
         return "" if s.lower() == "nan" else s
 
-def load_recipients(path: Path) -> pd.DataFrame:
+def load_recipients(path: Path):
+    """Open the recipients sheet as a streaming RecipientTable (see recipient_cache)."""
     ext = path.suffix.lower()
     if ext in [".xlsx", ".xls"]:
-        df = pd.read_excel(path)
+        df = read_excel_cached(path, RECIPIENTS_CACHE_DIR)
     elif ext in [".csv"]:
-        df = pd.read_csv(path)
+        df = read_csv_table(path)
     else:
         raise ValueError("Chỉ hỗ trợ .xlsx, .xls, .csv")
     for col in REQUIRED_COLS:
@@ -66,22 +302,28 @@ def load_recipients(path: Path) -> pd.DataFrame:
             df[col] = ""
     return df
 
+# {{Key}} placeholders; supports whitespace inside braces: {{ Key }}.
+TOKEN_PATTERN = re.compile(r"\{\{\s*([A-Za-z0-9_]+)\s*\}\}")
+
+
+def has_tokens(text: str) -> bool:
+    """True if text contains any {{Key}} placeholder."""
+    return bool(text) and TOKEN_PATTERN.search(text) is not None
+
+
 def render_template(html: str, mapping: dict) -> str:
     if not html:
         return ""
     if not mapping:
         return html
     # Replace {{Key}} placeholders with values from mapping.
-    # Supports whitespace inside braces: {{ Key }}.
-    pattern = re.compile(r"\{\{\s*([A-Za-z0-9_]+)\s*\}\}")
-
     def _repl(m: re.Match) -> str:
         key = m.group(1)
         if key in mapping:
             return str(mapping.get(key, ""))
         return m.group(0)
 
-    return pattern.sub(_repl, html)
+    return TOKEN_PATTERN.sub(_repl, html)
 
 def build_message(sender_name, sender_email, to_email, cc, bcc, subject, html_body, text_fallback=None, inline_images=None):
     """Create an email message with HTML, text fallback and optional inline images.
@@ -116,28 +358,55 @@ def build_message(sender_name, sender_email, to_email, cc, bcc, subject, html_bo
 def _is_http_url(url: str) -> bool:
     return url.startswith("http://") or url.startswith("https://")
 
-def _collect_inline_images(html: str, base_dir: Path | None, cid_logo_filename: str = "logomedi.png") -> tuple[str, list]:
+
+def _confined_path(value: str, root: Path) -> Path:
+    """value as a path inside root; ValueError for absolute paths or `..` escapes."""
+    candidate = Path(value)
+    if candidate.is_absolute() or candidate.drive:
+        raise ValueError(f"Không cho phép đường dẫn tuyệt đối: {value}")
+    resolved = (root / candidate).resolve()
+    if not resolved.is_relative_to(root.resolve()):
+        raise ValueError(f"Đường dẫn nằm ngoài thư mục cho phép: {value}")
+    return resolved
+
+
+def _collect_inline_images(
+    html: str, base_dir: Path | None, cid_logo_filename: str = "logomedi.png", image_cache_dir: str | None = None,
+    root: Path | None = None,
+) -> tuple[str, list]:
     """Find local <img src> in HTML and return html with cid + MIMEImage parts.
 
     Only processes src values that are not http(s), not data: and not cid:.
+    With image_cache_dir, JPEG/PNG images are resized to the layout width and
+    recompressed once (see image_optimizer) instead of embedded raw. With
+    root, only images inside root are embedded (no absolute paths, no
+    project-root fallback), and the cid:bookmedi_logo alias is looked up
+    in root too.
     """
+
+    def read_image(path: Path, subtype: str) -> bytes:
+        if image_cache_dir is None:
+            with open(path, "rb") as f:
+                return f.read()
+        return optimize_image(path, subtype, image_cache_dir)
+
     if not html:
         return html, []
 
     image_parts = []
+    used_cids: set = set()
     # Match src values in <img> tags, supporting single/double quotes and newlines
     pattern = re.compile(r"<img\b[^>]*?src=[\"']([^\"']+)[\"']", re.IGNORECASE | re.DOTALL)
     matches = list({m.group(1).strip() for m in pattern.finditer(html)})
     project_base = Path(__file__).parent.resolve()
 
     # Special fixed CID alias: cid:bookmedi_logo -> chosen logo file at project root
+    # (inside root when files are confined)
     if "cid:bookmedi_logo" in html:
         safe_name = Path(cid_logo_filename).name
-        logo_path = project_base / safe_name
+        logo_path = _confined_path(safe_name, root) if root is not None else project_base / safe_name
         if logo_path.exists():
             try:
-                with open(logo_path, "rb") as f:
-                    data = f.read()
                 mime_type, _ = mimetypes.guess_type(str(logo_path))
                 if not mime_type:
                     ext = logo_path.suffix.lower().lstrip(".")
@@ -146,6 +415,7 @@ def _collect_inline_images(html: str, base_dir: Path | None, cid_logo_filename:
                 subtype = "png"
                 if mime_type and mime_type.startswith("image/"):
                     subtype = mime_type.split("/", 1)[1]
+                data = read_image(logo_path, subtype)
                 img = MIMEImage(data, _subtype=subtype)
                 img.add_header("Content-ID", "<bookmedi_logo>")
                 img.add_header("Content-Disposition", "inline", filename=logo_path.name)
@@ -159,7 +429,11 @@ def _collect_inline_images(html: str, base_dir: Path | None, cid_logo_filename:
             continue
         try:
             img_path = Path(s)
-            if not img_path.is_absolute() and base_dir is not None:
+            if root is not None:
+                img_path = _confined_path(s, root)
+                if not img_path.exists():
+                    continue
+            elif not img_path.is_absolute() and base_dir is not None:
                 img_path = Path(base_dir) / img_path
             if not img_path.exists():
                 # Fallback: also look under project root
@@ -176,14 +450,17 @@ def _collect_inline_images(html: str, base_dir: Path | None, cid_logo_filename:
                     mime_type = f"image/{'jpeg' if ext == 'jpg' else ext}"
             if not mime_type or not mime_type.startswith("image/"):
                 continue
-            with open(img_path, "rb") as f:
-                data = f.read()
             subtype = mime_type.split("/", 1)[1]
-            img = MIMEImage(data, _subtype=subtype)
-            cid = make_msgid()[1:-1]
-            img.add_header("Content-ID", f"<{cid}>")
-            img.add_header("Content-Disposition", "inline", filename=img_path.name)
-            image_parts.append(img)
+            data = read_image(img_path, subtype)
+            # Content-derived CID: the same image gets the same CID in every
+            # message, so identical messages stay byte-identical.
+            cid = hashlib.sha256(data).hexdigest()[:32] + "@mailmerge"
+            if cid not in used_cids:
+                used_cids.add(cid)
+                img = MIMEImage(data, _subtype=subtype)
+                img.add_header("Content-ID", f"<{cid}>")
+                img.add_header("Content-Disposition", "inline", filename=img_path.name)
+                image_parts.append(img)
             html = html.replace(src, f"cid:{cid}")
         except Exception:
             # ignore broken image embedding; leave original src
@@ -191,6 +468,8 @@ def _collect_inline_images(html: str, base_dir: Path | None, cid_logo_filename:
     return html, image_parts
 
 def _download_to_temp(url: str) -> Path:
+    import requests  # deferred: only URL attachments need it
+
     resp = requests.get(url, stream=True, timeout=30)
     resp.raise_for_status()
     filename = Path(urlparse(url).path).name or "attachment.pdf"
@@ -202,16 +481,55 @@ def _download_to_temp(url: str) -> Path:
         return Path(tmp.name)
 
 
-def _resolve_file_path(path_or_url: str, base_dir: Path | None) -> Path:
+def _resolve_file_path(path_or_url: str, base_dir: Path | None, root: Path | None = None, allow_urls: bool = True) -> Path:
+    """Local path of a FilePDF value; with root, it must be a relative path inside root."""
     s = str(path_or_url).strip()
     if s.startswith("http://") or s.startswith("https://"):
+        if not allow_urls:
+            raise ValueError(f"Không cho phép tệp đính kèm qua URL: {s}")
         return _download_to_temp(s)
+    if root is not None:
+        return _confined_path(s, root)
     fpath = Path(s)
     if not fpath.is_absolute() and base_dir is not None:
         fpath = base_dir / fpath
     return fpath
 
 
+class AttachmentCache:
+    """Resolve FilePDF values, downloading each URL only once.
+
+    Rows (or campaigns sharing the cache) that point at the same URL reuse
+    the first download; close() removes the downloaded files.
+    """
+
+    def __init__(self):
+        self._paths: dict = {}
+        self._locks: dict = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, path_or_url: str, base_dir: Path | None, root: Path | None = None, allow_urls: bool = True) -> Path:
+        url = str(path_or_url).strip()
+        if not _is_http_url(url) or not allow_urls:
+            return _resolve_file_path(url, base_dir, root=root, allow_urls=allow_urls)
+        with self._lock:
+            url_lock = self._locks.setdefault(url, threading.Lock())
+        with url_lock:  # concurrent builders wait for the first download
+            path = self._paths.get(url)
+            if path is None or not path.exists():
+                path = self._paths[url] = _download_to_temp(url)
+            return path
+
+    def close(self) -> None:
+        with self._lock:
+            paths, self._paths = list(self._paths.values()), {}
+        for path in paths:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
 def attach_file(msg, file_path: Path):
     fpath = Path(file_path)
     if not fpath.exists():
@@ -225,31 +543,574 @@ def attach_file(msg, file_path: Path):
     part.add_header("Content-Disposition", "attachment", filename=fpath.name)
     msg.attach(part)
 
-def send_email_smtp(host, port, user, password, use_starttls, msg, to_email, cc="", bcc="", dry_run=False):
+def _drop_suppressed(field: str, suppressed: set) -> tuple:
+    """Split a CC/BCC field into (kept field, suppressed addresses)."""
+    kept, dropped = [], []
+    for addr in (e.strip() for e in field.split(",")):
+        if addr:
+            (dropped if normalize_address(addr) in suppressed else kept).append(addr)
+    return ", ".join(kept), dropped
+
+
+def _recipient_list(to_email: str, cc: str = "", bcc: str = "") -> list:
     recipients = [to_email]
     if cc:
         recipients += [e.strip() for e in cc.split(",") if e.strip()]
     if bcc:
         recipients += [e.strip() for e in bcc.split(",") if e.strip()]
+    return recipients
+
+
+def _fixed_boundaries(msg) -> None:
+    """Give every multipart a fixed boundary instead of a random one.
+
+    With random boundaries no two messages have the same body, so the DKIM
+    body hash (see dkim_signer) could never be reused. The bodies built here
+    are base64 throughout (text, images and attachments), and base64 lines
+    cannot contain "=_", so a constant boundary cannot collide with content.
+    """
+    for n, part in enumerate(p for p in msg.walk() if p.is_multipart()):
+        part.set_boundary(f"=_mm{n:02d}_mailmerge_boundary")
+
+
+def _serialize_message(msg) -> bytes:
+    """Flatten msg to wire format (CRLF line endings) like smtplib.send_message does."""
+    return msg.as_bytes(policy=msg.policy.clone(linesep="\r\n"))
+
+
+def _sendmail_pipelined(server, from_addr: str, recipients: list, data: bytes, mail_options=()) -> dict:
+    """Send one transaction using ESMTP PIPELINING (RFC 2920), plus CHUNKING/BDAT
+    (RFC 3030) when offered.
+
+    MAIL FROM, every RCPT TO and DATA (or BDAT ... LAST with the payload) are
+    written in a single batch before any reply is read, so a message costs one
+    round-trip with CHUNKING and two with DATA, instead of 3 + len(recipients).
+    Errors are raised as the same smtplib exceptions sendmail() uses and
+    partially refused recipients are returned like sendmail() does.
+    """
+    options = list(mail_options)
+    # Checked before anything is written, as smtplib's mail() does: otherwise
+    # the server's 555/501 reply would read as a refused sender.
+    if "SMTPUTF8" in options and not server.has_extn("smtputf8"):
+        raise smtplib.SMTPNotSupportedError("SMTPUTF8 not supported by server")
+    if server.has_extn("size"):
+        options.append(f"SIZE={len(data)}")
+    encoding = "utf-8" if "SMTPUTF8" in options else "ascii"
+    chunking = server.has_extn("chunking")
+
+    opt_str = (" " + " ".join(options)) if options else ""
+    batch = [f"MAIL FROM:{smtplib.quoteaddr(from_addr)}{opt_str}\r\n"]
+    batch += [f"RCPT TO:{smtplib.quoteaddr(r)}\r\n" for r in recipients]
+    if chunking:
+        payload = data
+        batch.append(f"BDAT {len(payload)} LAST\r\n")
+        server.send("".join(batch).encode(encoding) + payload)
+    else:
+        batch.append("DATA\r\n")
+        server.send("".join(batch).encode(encoding))
+
+    code, resp = server.getreply()
+    mail_ok = code == 250
+    mail_reply = (code, resp)
+    senderrs = {}
+    for r in recipients:
+        code, resp = server.getreply()
+        if code not in (250, 251):
+            senderrs[r] = (code, resp)
+    data_code, data_resp = server.getreply()
+
+    if not chunking and data_code == 354:
+        # Nothing else to pipeline: stream the dot-stuffed body.
+        body = re.sub(rb"(?m)^\.", b"..", data)
+        if not body.endswith(b"\r\n"):
+            body += b"\r\n"
+        server.send(body + b".\r\n")
+        data_code, data_resp = server.getreply()
+
+    if not mail_ok:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+    if len(senderrs) == len(recipients):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused(senderrs)
+    if data_code != 250:
+        if data_code != 421:
+            server.rset()
+        raise smtplib.SMTPDataError(data_code, data_resp)
+    return senderrs
+
+
+_ssl_context: ssl.SSLContext | None = None
+_ssl_context_lock = threading.Lock()
+# Last TLS session per (host, port, context), offered again on reconnect.
+_tls_sessions: dict = {}
+
+
+def shared_ssl_context() -> ssl.SSLContext:
+    """Process-wide client SSL context.
+
+    ssl.create_default_context() loads and parses the system CA bundle on
+    every call; the context is built once and shared by all connections.
+    """
+    global _ssl_context
+    if _ssl_context is None:
+        with _ssl_context_lock:
+            if _ssl_context is None:
+                _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+
+class _ResumingContext:
+    """SSL context proxy that offers a saved TLS session to wrap_socket().
+
+    smtplib wraps the socket itself (starttls() and SMTP_SSL), so this is
+    how the session is passed through. A session the server no longer
+    accepts simply results in a full handshake.
+    """
+
+    def __init__(self, context: ssl.SSLContext, session):
+        self._context = context
+        self._session = session
+
+    def wrap_socket(self, sock, **kwargs):
+        if self._session is not None:
+            kwargs.setdefault("session", self._session)
+        return self._context.wrap_socket(sock, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+
+class SmtpSender:
+    """A reusable SMTP session (STARTTLS or SMTPS).
+
+    Connects and logs in lazily on the first send, then keeps the session
+    open for up to max_messages messages, so a campaign pays the TCP, TLS and
+    AUTH cost once per connection instead of once per message. A session
+    dropped by the server between messages is re-established transparently.
+    When the server advertises PIPELINING (and CHUNKING) the transaction is
+    batched via _sendmail_pipelined, unless pipelining=False.
+
+    TLS uses shared_ssl_context() unless ssl_context is given, and a
+    reconnect to the same server resumes the previous TLS session
+    (session ticket) instead of a full handshake, unless
+    tls_resumption=False.
+    """
+
+    def __init__(self, host, port, user, password, use_starttls=True, max_messages: int = 100, timeout: float | None = 60, pipelining: bool = True,
+                 ssl_context: ssl.SSLContext | None = None, tls_resumption: bool = True):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.use_starttls = use_starttls
+        self.max_messages = max(1, int(max_messages))
+        self.timeout = timeout
+        self.pipelining = pipelining
+        self.ssl_context = ssl_context
+        self.tls_resumption = tls_resumption
+        self.session_reused = False  # whether the current connection resumed a TLS session
+        self._server = None
+        self._count = 0
+
+    def _sendmail(self, from_addr: str, recipients: list, data: bytes, mail_options) -> dict:
+        server = self._server
+        if self.pipelining and server.has_extn("pipelining"):
+            return _sendmail_pipelined(server, from_addr, recipients, data, mail_options)
+        return server.sendmail(from_addr, recipients, data, mail_options=mail_options)
+
+    def _connect(self, timings: MessageTimings | None = None) -> None:
+        # connect covers TCP + TLS handshake, auth the LOGIN exchange.
+        t0 = time.perf_counter()
+        kwargs = {"timeout": self.timeout} if self.timeout else {}
+        context = self.ssl_context or shared_ssl_context()
+        session_key = (self.host, int(self.port), id(context))
+        if self.tls_resumption:
+            context = _ResumingContext(context, _tls_sessions.get(session_key))
+        if self.use_starttls:
+            server = smtplib.SMTP(self.host, self.port, **kwargs)
+            try:
+                server.ehlo()
+                server.starttls(context=context)
+                server.ehlo()
+            except Exception:
+                server.close()
+                raise
+        else:
+            server = smtplib.SMTP_SSL(self.host, self.port, context=context, **kwargs)
+        if timings is not None:
+            timings.add("connect", time.perf_counter() - t0)
+        try:
+            with _timed(timings, "auth"):
+                server.login(self.user, self.password)
+        except Exception:
+            server.close()
+            raise
+        tls_sock = server.sock if isinstance(server.sock, ssl.SSLSocket) else None
+        self.session_reused = bool(tls_sock is not None and tls_sock.session_reused)
+        # TLS 1.3 tickets arrive after the handshake; by now the login reply
+        # has been read, so the session is resumable.
+        if self.tls_resumption and tls_sock is not None and tls_sock.session is not None:
+            _tls_sessions[session_key] = tls_sock.session
+        self._server = server
+        self._count = 0
+
+    def send(self, from_addr: str, recipients: list, data: bytes, timings: MessageTimings | None = None) -> dict:
+        """Deliver data; returns {recipient: (code, resp)} for refused recipients."""
+        if self._server is None or self._count >= self.max_messages:
+            self.close()
+            self._connect(timings)
+        # Non-ASCII envelope addresses need SMTPUTF8, as send_message would request.
+        mail_options = ()
+        if any(not a.isascii() for a in [from_addr, *recipients]):
+            mail_options = ("SMTPUTF8", "BODY=8BITMIME")
+        try:
+            with _timed(timings, "send"):
+                refused = self._sendmail(from_addr, recipients, data, mail_options)
+        except smtplib.SMTPServerDisconnected:
+            if self._count == 0:
+                self._server = None
+                raise
+            # A reused session timed out on the server side: reconnect once.
+            self._server = None
+            self._connect(timings)
+            with _timed(timings, "send"):
+                refused = self._sendmail(from_addr, recipients, data, mail_options)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError,
+                smtplib.SMTPNotSupportedError):
+            # smtplib already sent RSET (or nothing was sent); the session is still usable.
+            self._count += 1
+            raise
+        except Exception:
+            self.close()
+            raise
+        self._count += 1
+        return refused or {}
+
+    def close(self) -> None:
+        server, self._server = self._server, None
+        if server is None:
+            return
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+
+class SenderPool:
+    """Logged-in SmtpSender sessions kept between runs that share an account.
+
+    run_merge takes sessions with acquire() and hands them back with
+    release() instead of closing them, so consecutive campaigns (see
+    campaign_manifest) skip the connect, TLS and AUTH round-trips.
+    """
+
+    def __init__(self):
+        self._idle: dict = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(host, port, user, password, use_starttls, pipelining) -> tuple:
+        return (host, int(port), user, password, bool(use_starttls), bool(pipelining))
+
+    def acquire(self, host, port, user, password, use_starttls=True, pipelining=True) -> SmtpSender:
+        key = self._key(host, port, user, password, use_starttls, pipelining)
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+        return SmtpSender(host, port, user, password, use_starttls=use_starttls, pipelining=pipelining)
+
+    def release(self, sender: SmtpSender) -> None:
+        key = self._key(sender.host, sender.port, sender.user, sender.password, sender.use_starttls, sender.pipelining)
+        with self._lock:
+            self._idle.setdefault(key, []).append(sender)
+
+    def close(self) -> None:
+        with self._lock:
+            senders = [s for idle in self._idle.values() for s in idle]
+            self._idle.clear()
+        for sender in senders:
+            sender.close()
+
+
+def send_email_smtp(host, port, user, password, use_starttls, msg, to_email, cc="", bcc="", dry_run=False, timings=None, signer=None):
+    recipients = _recipient_list(to_email, cc, bcc)
 
     if dry_run:
         print(f"[DRY-RUN] Would send to: {recipients}")
         return
 
-    # In Python 3.3+, smtplib.send_message is preferred as it handles
-    # non-ASCII headers and body properly (using SMTPUTF8 if needed).
-    if use_starttls:
-        context = ssl.create_default_context()
-        with smtplib.SMTP(host, port) as server:
-            server.ehlo()
-            server.starttls(context=context)
-            server.ehlo()
-            server.login(user, password)
-            server.send_message(msg, from_addr=msg["From"], to_addrs=recipients)
+    data = _serialize_message(msg)
+    if signer is not None:
+        data = signer.sign(data)
+    sender = SmtpSender(host, port, user, password, use_starttls=use_starttls, timeout=None)
+    try:
+        sender.send(msg["From"], recipients, data, timings=timings)
+    finally:
+        sender.close()
+
+
+def _is_transient_smtp_error(exc: Exception) -> bool:
+    """True for errors worth retrying: dropped connections and 4xx replies."""
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return 400 <= exc.smtp_code < 500
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return bool(exc.recipients) and all(400 <= code < 500 for code, _ in exc.recipients.values())
+    return isinstance(exc, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError))
+
+
+class RateLimiter:
+    """Space sends at least interval seconds apart across all connections."""
+
+    def __init__(self, interval: float):
+        self.interval = max(0.0, float(interval))
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if self.interval <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def email_domain(email: str) -> str:
+    return (email or "").rsplit("@", 1)[-1].strip().lower()
+
+
+class DomainScheduler:
+    """Hand out jobs round-robin across recipient domains, with caps.
+
+    Jobs are bucketed by domain on put(); get() serves the domains in turn,
+    skipping a domain while it has `concurrency` jobs in flight (until
+    done() is called for them) or while its pacing interval has not
+    elapsed, so a large domain (gmail.com) cannot monopolise the senders
+    while the rest of the list waits. limits maps a domain to
+    {"concurrency": n, "rate_delay": seconds}, overriding the defaults.
+    At most max_pending jobs are buffered; put() blocks beyond that.
+
+    requeue() puts a job back (e.g. a built message that got a 4xx reply)
+    at the front of its domain with a not-before time and cools the domain
+    down, so the caller moves on to other domains instead of sleeping.
+    get() only reports the end once nothing is pending or in flight, since
+    an in-flight job may still come back.
+    """
+
+    def __init__(self, concurrency: int = 0, rate_delay: float = 0.0, limits: dict | None = None,
+                 max_pending: int = 20000, stop_event: threading.Event | None = None):
+        self.concurrency = max(0, int(concurrency))
+        self.rate_delay = max(0.0, float(rate_delay))
+        self.limits = {d.lower(): v for d, v in (limits or {}).items()}
+        self.max_pending = max(1, int(max_pending))
+        self._stop = stop_event or threading.Event()
+        self._buckets: OrderedDict = OrderedDict()  # domain -> deque, in round-robin order
+        self._inflight: dict = {}
+        self._inflight_total = 0
+        self._next: dict = {}
+        self._pending = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _limit(self, domain: str) -> tuple[int, float]:
+        custom = self.limits.get(domain) or {}
+        return int(custom.get("concurrency", self.concurrency)), float(custom.get("rate_delay", self.rate_delay))
+
+    def put(self, job, domain: str) -> None:
+        with self._cond:
+            while self._pending >= self.max_pending and not self._stop.is_set():
+                self._cond.wait(0.5)
+            bucket = self._buckets.get(domain)
+            if bucket is None:
+                bucket = self._buckets[domain] = deque()
+            bucket.append(job)
+            self._pending += 1
+            self._cond.notify_all()
+
+    def requeue(self, job: dict, domain: str, delay: float) -> None:
+        """Put job back first in line for domain, not before delay seconds.
+
+        Never blocks (the caller holds an in-flight slot that max_pending
+        waits on); the domain is held back for the same delay.
+        """
+        with self._cond:
+            not_before = time.monotonic() + max(0.0, delay)
+            job["not_before"] = not_before
+            bucket = self._buckets.get(domain)
+            if bucket is None:
+                bucket = self._buckets[domain] = deque()
+            bucket.appendleft(job)
+            self._pending += 1
+            self._next[domain] = max(self._next.get(domain, 0.0), not_before)
+            self._cond.notify_all()
+
+    def close(self) -> None:
+        """No more put(); get() returns None once the buckets are empty."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def get(self):
+        """Next eligible job, or None when closed and drained (or stopped)."""
+        with self._cond:
+            while not self._stop.is_set():
+                now = time.monotonic()
+                wake = None
+                for domain in self._buckets:
+                    concurrency, rate_delay = self._limit(domain)
+                    if concurrency and self._inflight.get(domain, 0) >= concurrency:
+                        continue
+                    bucket = self._buckets[domain]
+                    ready_at = max(self._next.get(domain, 0.0), bucket[0].get("not_before", 0.0) if isinstance(bucket[0], dict) else 0.0)
+                    if ready_at > now:
+                        wake = ready_at if wake is None else min(wake, ready_at)
+                        continue
+                    bucket = self._buckets.pop(domain)
+                    job = bucket.popleft()
+                    if bucket:
+                        self._buckets[domain] = bucket  # back of the round-robin order
+                    self._pending -= 1
+                    self._inflight[domain] = self._inflight.get(domain, 0) + 1
+                    self._inflight_total += 1
+                    if rate_delay:
+                        self._next[domain] = now + rate_delay
+                    self._cond.notify_all()
+                    return job
+                if self._closed and not self._pending and not self._inflight_total:
+                    return None
+                self._cond.wait(0.5 if wake is None else min(0.5, max(0.0, wake - now)))
+            return None
+
+    def done(self, domain: str) -> None:
+        with self._cond:
+            self._inflight[domain] = max(0, self._inflight.get(domain, 0) - 1)
+            self._inflight_total = max(0, self._inflight_total - 1)
+            self._cond.notify_all()
+
+
+def _deliver(smtp: SmtpSender, from_addr: str, rcpts: list, data: bytes, mt: MessageTimings | None,
+             limiter: RateLimiter, max_retries: int, retry_delay: float, on_retry=None) -> dict:
+    """Send data through smtp, retrying transient errors with exponential backoff.
+
+    on_retry(exc, attempt) is called before each retry. Returns refused
+    recipients like SmtpSender.send; the last error is raised when retries
+    are exhausted or the error is permanent.
+    """
+    attempt = 0
+    while True:
+        limiter.wait()
+        try:
+            return smtp.send(from_addr, rcpts, data, timings=mt)
+        except Exception as e:
+            if attempt >= max_retries or not _is_transient_smtp_error(e):
+                raise
+            attempt += 1
+            if on_retry is not None:
+                on_retry(e, attempt)
+            time.sleep(max(0.0, retry_delay) * (2 ** (attempt - 1)))
+
+
+# To header of batched messages, whose real recipients are envelope-only (BCC).
+BATCH_TO_HEADER = "undisclosed-recipients:;"
+# Batch groups the reader keeps open at once; a new key flushes the oldest.
+BATCH_OPEN_GROUPS = 8
+# A partial batch group is flushed after this many seconds ...
+BATCH_MAX_AGE = 2.0
+# ... and once this many rows are held across all open groups.
+BATCH_MAX_HELD = 2000
+
+
+def _build_job(ctx: dict, job: dict) -> tuple[bytes, list, dict]:
+    """Render one row and serialise it to SMTP-ready bytes.
+
+    Only plain data goes in (ctx/job dicts, with the attachment already
+    resolved to a local path in job["attachment"]) and comes out, so this
+    can run in build worker threads or processes. Returns (message bytes,
+    envelope recipients, stage timings in ms). A job with "members" is a
+    batch: one message addressed to BATCH_TO_HEADER with every member (and
+    their BCC) as envelope recipients.
+    """
+    mt = MessageTimings()
+    with mt.stage("render"):
+        tokens = dict(job["tokens"])
+        tokens["NgayGui"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        subject = render_template(job["subj_tpl"] or ctx["default_subject"], tokens)
+        body_html = render_template(ctx["html"], tokens)
+    with mt.stage("inline_images"):
+        body_html_with_cid, inline_imgs = _collect_inline_images(
+            body_html,
+            Path(ctx["tpl_dir"]),
+            cid_logo_filename=ctx["cid_logo_filename"],
+            image_cache_dir=ctx.get("image_cache_dir"),
+            root=Path(ctx["attachment_root"]) if ctx.get("attachment_root") else None,
+        )
+    members = job.get("members")
+    if members:
+        # Batch of identical messages: recipients only go in the envelope.
+        to_header = BATCH_TO_HEADER
+        recipients = []
+        for member in members:
+            recipients += _recipient_list(member["email"], "", member["bcc"])
     else:
-        with smtplib.SMTP_SSL(host, port) as server:
-            server.login(user, password)
-            server.send_message(msg, from_addr=msg["From"], to_addrs=recipients)
+        to_header = job["email"]
+        recipients = _recipient_list(job["email"], job["cc"], job["bcc"])
+    # attach covers MIME assembly, reading/encoding the attachment and serialisation
+    with mt.stage("attach"):
+        msg = build_message(
+            ctx["from_name"], ctx["sender_email"], to_header, job["cc"], job["bcc"],
+            subject, body_html_with_cid, inline_images=inline_imgs,
+        )
+        # Attach file only when provided
+        if job.get("attachment"):
+            attach_file(msg, Path(job["attachment"]))
+        _fixed_boundaries(msg)
+        data = _serialize_message(msg)
+    dkim = ctx.get("dkim")
+    if dkim:
+        with mt.stage("sign"):
+            data = dkim_signer.load_signer(dkim["domain"], dkim["selector"], dkim["key"]).sign(data)
+    return data, recipients, mt.stages
+
+
+# Campaign context of a build worker process, set once by the pool initializer
+# so that only the compact row dict crosses the process boundary per message.
+_WORKER_CTX: dict | None = None
+
+
+def _init_build_process(ctx: dict) -> None:
+    global _WORKER_CTX
+    _WORKER_CTX = ctx
+
+
+def _build_job_in_process(job: dict) -> tuple[bytes, list, dict]:
+    return _build_job(_WORKER_CTX, job)
+
+
+def _human_bytes(num: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if num < 1024 or unit == "GB":
+            return f"{num:.0f} {unit}" if unit == "B" else f"{num:.1f} {unit}"
+        num /= 1024
+
+
+def _human_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    h, rem = divmod(seconds, 3600)
+    m, s = divmod(rem, 60)
+    return f"{h}h{m:02d}m{s:02d}s" if h else f"{m}m{s:02d}s"
+
+
+def _job_label(job: dict) -> str:
+    members = job.get("members")
+    return f"{job['email']} (+{len(members) - 1})" if members else job["email"]
+
 
 def run_merge(
     recipients: str,
@@ -266,19 +1127,157 @@ def run_merge(
     base_dir: str | None = None,
     cid_logo_filename: str = "logomedi.png",
     progress_callback=None,
+    event_callback=None,
+    timings_path: str | None = None,
+    max_retries: int = 0,
+    retry_delay: float = 5.0,
+    metrics_textfile: str | None = None,
+    suppression_db: str | None = None,
+    campaign_id: str = "",
+    dedupe: bool = False,
+    build_workers: int = 1,
+    build_mode: str | None = None,
+    connections: int = 1,
+    queue_size: int = 64,
+    smtp_pipelining: bool = True,
+    batch_size: int = 0,
+    spool_dir: str | None = None,
+    stop_event: threading.Event | None = None,
+    send_limit: int = 0,
+    dry_run_fast: bool = False,
+    optimize_images: bool = True,
+    compile_html: bool = True,
+    dkim_domain: str = "",
+    dkim_selector: str = "",
+    dkim_key: str = "",
+    incremental: bool = False,
+    campaign_state_db: str | None = None,
+    sender_pool: SenderPool | None = None,
+    rate_limiter: RateLimiter | None = None,
+    attachment_cache: AttachmentCache | None = None,
+    interleave_domains: bool = False,
+    domain_concurrency: int = 0,
+    domain_rate_delay: float = 0.0,
+    domain_limits: dict | None = None,
+    attachment_root: str | None = None,
+    allow_attachment_urls: bool = True,
 ) -> dict:
     """Run the mail merge process.
 
     Parameters mirror the CLI flags. progress_callback, if provided,
     will be called with a single string argument for each log line.
-    Returns a dict summary with sent, failed, and errors list.
+    event_callback, if provided, receives a ProgressEvent for the start,
+    every sent/failed row, every retry and the end of the campaign.
+    Both callbacks are always invoked on the calling thread.
+    timings_path, if provided, receives one JSON line of stage timings
+    per message. Transient SMTP errors are retried up to max_retries times
+    with exponential backoff starting at retry_delay seconds. Counters and
+    gauges in mail_metrics are updated as rows are processed; when
+    metrics_textfile is given it is rewritten periodically for the
+    node_exporter textfile collector.
+
+    Rows whose address is on the suppression list in suppression_db, or was
+    already sent under the same campaign_id, are skipped before any message
+    is built; suppressed CC/BCC addresses are removed from the rows that
+    keep them. With dedupe, a row repeating an address seen earlier in the
+    sheet is skipped as well (off by default: a sheet may mail one person
+    several times on purpose, e.g. with different attachments). Hard
+    bounces (5xx recipient refusals) are added to the suppression list.
+
+    Work is pipelined: a reader thread feeds build_workers threads that
+    render and serialise messages, which feed `connections` sender threads
+    each holding a reusable SMTP session. Stages are linked by queues of at
+    most queue_size items, so memory stays flat while rendering overlaps
+    with network round-trips. rate_delay is enforced globally between sends.
+    smtp_pipelining uses ESMTP PIPELINING/CHUNKING when the server offers them.
+
+    batch_size > 0 enables batch submission for announcements: when the
+    template and subject contain no {{tokens}}, rows without CC that share
+    subject and attachment are sent as one message (To: undisclosed
+    recipients) with up to batch_size envelope recipients, so the message
+    is built and transferred once per group. Progress is still reported
+    per row. Rows are grouped as they stream in: at most BATCH_OPEN_GROUPS
+    partial groups (BATCH_MAX_HELD rows) are held, and a group older than
+    BATCH_MAX_AGE seconds is sent as it is, so rows with their own
+    attachment or subject do not wait for the end of the sheet.
+
+    With spool_dir, messages are only built and written to an on-disk
+    outbox (see spool.Spool) at full speed; drain_spool() sends them later.
+    Setting stop_event from another thread ends the run early: queued rows
+    are dropped unsent, messages already on the wire still complete.
+    send_limit > 0 caps the number of recipients handed to SMTP in this run
+    (e.g. a daily quota); the run stops once it is used up.
+
+    A dry run also reports message sizes and the estimated send duration
+    at rate_delay in summary["capacity"]. With dry_run_fast the pacing
+    sleeps are skipped and building runs in a process pool over every CPU
+    core (unless build_mode or build_workers say otherwise), so a campaign
+    can be sized in seconds; add spool_dir to keep the .eml files.
+
+    optimize_images resizes inline JPEG/PNG images to the 600 px layout
+    width and recompresses them once per campaign (needs Pillow, otherwise
+    images are embedded unchanged).
+
+    compile_html inlines the template's CSS and minifies it once before the
+    run (see template_compiler), so every message is smaller and cheaper to
+    render.
+
+    dkim_key (a PEM private key; needs dkim_domain and dkim_selector) turns
+    on DKIM signing inside the build workers, see dkim_signer. Spooled
+    messages are stored signed.
+
+    incremental (needs campaign_id) only processes rows that are new or
+    changed since earlier runs of the campaign: a row is skipped when its
+    fingerprint (address, every column value, attachment content hash) was
+    already delivered, see campaign_state. Addresses sent before with
+    different content are sent again. A changed template is not detected;
+    use a new campaign_id for it. Dry runs and spool runs do not record
+    fingerprints.
+
+    sender_pool, rate_limiter and attachment_cache let several runs in one
+    process share logged-in SMTP sessions, the pacing of an account and
+    downloaded URL attachments (see campaign_manifest). When given,
+    rate_limiter replaces the pacing from rate_delay; the caller closes the
+    shared objects.
+
+    interleave_domains (implied by any domain_* limit) buckets rows by
+    recipient domain and hands them to the build workers round-robin
+    across domains (see DomainScheduler), so a list that is mostly
+    gmail.com does not send thousands of messages to one receiver in a
+    row. domain_concurrency caps the messages in flight per domain,
+    domain_rate_delay spaces them per domain, domain_limits overrides both
+    for given domains ({"gmail.com": {"concurrency": 2, "rate_delay": 1}}),
+    and a transient error (e.g. 421 4.7.28) puts the built message back
+    into the scheduler with the retry delay as a cooldown for its domain,
+    so the sender moves on to other domains instead of sleeping. Batches
+    are formed per domain. Pacing is measured when a
+    row is handed out for building; rate_delay still applies globally.
+
+    With build_mode="process" the base64 encoding of attachments and images
+    runs in a ProcessPoolExecutor instead of being serialised by the GIL;
+    build_workers=0 sizes the pool (or thread count) to the CPU cores.
+    build_mode=None picks "process" for a fast dry run, "thread" otherwise.
+
+    attachment_root confines files to one folder for untrusted input (see
+    api_server): FilePDF values and template images must be relative paths
+    inside it, and a row pointing elsewhere fails. allow_attachment_urls=False
+    refuses http(s) FilePDF values.
+
+    Returns a dict summary with sent, failed, skipped, errors (an ErrorLog) and
+    per-stage timing histograms.
     """
     rec_path = Path(recipients)
     tpl_path = Path(template)
     base = Path(base_dir) if base_dir else None
 
-    df = load_recipients(rec_path)
-    html = tpl_path.read_text(encoding="utf-8")
+    timings = StageTimings(timings_path)
+    load_timings = MessageTimings()
+    with load_timings.stage("load"):
+        df = load_recipients(rec_path)
+        html = tpl_path.read_text(encoding="utf-8")
+        if compile_html:
+            html = compile_template(html)
+    timings.record(None, "", "load", load_timings)
 
     def log(message: str):
         if progress_callback:
@@ -289,102 +1288,842 @@ def run_merge(
         else:
             print(message)
 
-    sent, failed = 0, 0
-    errors = []
-
-    for i, row in df.iterrows():
-        email = normalize_field(row["Email"])
-        ten = normalize_field(row["Ten"])
-        fpdf = normalize_field(row.get("FilePDF", ""))
-        cc = normalize_field(row.get("CC", ""))
-        bcc = normalize_field(row.get("BCC", ""))
-        subj_tpl = normalize_field(row.get("Subject", "")) or default_subject
-
-        # Build token mapping from ALL columns (including optional Code, etc.)
-        tokens = {str(col): normalize_field(row.get(col, "")) for col in df.columns}
-        tokens["Ten"] = ten
-        tokens["Email"] = email
-        tokens["NgayGui"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        subject = render_template(subj_tpl, tokens)
-        body_html = render_template(html, tokens)
-        # Prepare inline images referenced by template
-        if not email or not is_valid_email(email):
-            failed += 1
-            err_msg = f"Email không hợp lệ: '{email}'. Có thể bạn đã nhập nhầm Tên vào cột Email?"
-            errors.append((email or "N/A", err_msg))
-            log(f"[ERR] {email} -> {err_msg}")
-            continue
+    if incremental and not campaign_id:
+        raise ValueError("Chế độ chỉ gửi dòng mới/thay đổi cần có mã chiến dịch (campaign_id)")
+    store = SuppressionStore(suppression_db) if suppression_db else None
+    # CC/BCC are only checked against the suppression list: someone copied on
+    # every row must not be dropped for having been sent to already.
+    suppressed = store.load_blocked(None) if store is not None else set()
+    # Incremental runs decide per row fingerprint, not per address already sent.
+    blocked = store.load_blocked(campaign_id) if store is not None and campaign_id and not incremental else suppressed
+    state = CampaignState(campaign_state_db or CAMPAIGN_STATE_DB) if incremental else None
+    delivered = state.load_sent(campaign_id) if state is not None else set()
+
+    sent, failed, skipped, unchanged = 0, 0, 0, 0
+    errors = ErrorLog()
+    started_at = time.monotonic()
+    total = len(df)
+    columns = [str(c) for c in df.columns]
+
+    def emit(kind: str, row_index=None, email: str = "", detail: str = "", attempt: int = 0):
+        if event_callback is None:
+            return
+        try:
+            event_callback(
+                ProgressEvent(
+                    kind=kind,
+                    total=total,
+                    sent=sent,
+                    failed=failed,
+                    skipped=skipped,
+                    elapsed=time.monotonic() - started_at,
+                    row_index=row_index,
+                    email=email,
+                    detail=detail,
+                    attempt=attempt,
+                )
+            )
+        except Exception:
+            pass
+
+    ctx = {
+        "html": html,
+        "default_subject": default_subject,
+        "from_name": from_name,
+        "sender_email": smtp_user,
+        "tpl_dir": str(tpl_path.parent),
+        "base_dir": str(base) if base else None,
+        "cid_logo_filename": cid_logo_filename,
+        "image_cache_dir": str(IMAGE_CACHE_DIR) if optimize_images else None,
+        "dkim": None,
+        "attachment_root": str(Path(attachment_root).resolve()) if attachment_root else None,
+    }
+    file_root = Path(ctx["attachment_root"]) if attachment_root else None
+    if dkim_key:
+        if not (dkim_domain and dkim_selector):
+            raise ValueError("Ký DKIM cần đủ domain, selector và file khóa")
+        # Fail before the first row if the key is unusable; build threads reuse
+        # this parsed key, build processes parse it once each.
+        dkim_signer.load_signer(dkim_domain, dkim_selector, dkim_key)
+        ctx["dkim"] = {"domain": dkim_domain, "selector": dkim_selector, "key": str(Path(dkim_key).resolve())}
+    fast_dry_run = dry_run and dry_run_fast
+    if build_mode is None:
+        # A fast dry run only builds messages: threads would share one core under the GIL.
+        build_mode = "process" if fast_dry_run else "thread"
+    if build_mode not in ("thread", "process"):
+        raise ValueError(f"build_mode không hợp lệ: {build_mode}")
+    if fast_dry_run and int(build_workers) == 1:
+        build_workers = 0
+    build_workers = int(build_workers) if int(build_workers) > 0 else (os.cpu_count() or 1)
+    connections = max(1, int(connections))
+    pool = None
+    if build_mode == "process":
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=build_workers, initializer=_init_build_process, initargs=(ctx,)
+        )
+    job_q: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+    send_q: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+    stop = stop_event if stop_event is not None else threading.Event()
+    domains = None
+    if interleave_domains or domain_concurrency or domain_rate_delay or domain_limits:
+        # Build-only runs (spool, fast dry run) keep the order but skip the pacing.
+        unpaced = spool_dir or fast_dry_run
+        domains = DomainScheduler(
+            concurrency=0 if unpaced else domain_concurrency,
+            rate_delay=0.0 if unpaced else domain_rate_delay,
+            limits=None if unpaced else domain_limits,
+            stop_event=stop,
+        )
+    # Results flow back to the calling thread, which owns counters, callbacks and stores.
+    results: queue.Queue = queue.Queue()
+    if fast_dry_run:
+        limiter = RateLimiter(0)
+    else:
+        limiter = rate_limiter if rate_limiter is not None else RateLimiter(rate_delay)
+    attachments = attachment_cache if attachment_cache is not None else AttachmentCache()
+    spool = None
+    if spool_dir:
+        spool = Spool(spool_dir)
+        spool.write_manifest(sender=smtp_user, campaign_id=campaign_id, recipients=str(rec_path), template=str(tpl_path))
+    batching = batch_size > 1 and not has_tokens(html) and not has_tokens(default_subject)
+    builders_left = [build_workers]
+    builders_lock = threading.Lock()
+
+    def submit(job):
+        if domains is None:
+            job_q.put(job)
+        else:
+            domains.put(job, job["domain"])
+
+    def next_job():
+        return job_q.get() if domains is None else domains.get()
+
+    def release(job):
+        if domains is not None:
+            domains.done(job["domain"])
+
+    def reader():
+        seen: set = set()
+        groups: dict = {}  # key -> rows, oldest group first
+        opened: dict = {}  # key -> time the group was opened
+        held = 0
 
-        body_html_with_cid, inline_imgs = _collect_inline_images(body_html, tpl_path.parent, cid_logo_filename=cid_logo_filename)
+        def flush_group(key):
+            nonlocal held
+            members = groups.pop(key)
+            del opened[key]
+            held -= len(members)
+            job = members[0]
+            if len(members) > 1:
+                job = dict(job, members=[
+                    {"index": m["index"], "email": m["email"], "bcc": m["bcc"], "row_hash": m.get("row_hash")} for m in members
+                ], bcc="")
+            submit(job)
 
         try:
-            msg = build_message(from_name, smtp_user, email, cc, bcc, subject, body_html_with_cid, inline_images=inline_imgs)
-
-            # Attach file only when provided
-            if fpdf:
-                resolved_path = _resolve_file_path(fpdf, base)
-                attach_file(msg, resolved_path)
-
-            use_starttls = not use_ssl
-            send_email_smtp(
-                host=smtp_host,
-                port=smtp_port,
-                user=smtp_user,
-                password=smtp_pass,
-                use_starttls=use_starttls,
-                msg=msg,
-                to_email=email,
-                cc=cc,
-                bcc=bcc,
-                dry_run=dry_run,
+            for i, row in df.iterrows():
+                if stop.is_set():
+                    break
+                email = normalize_field(row["Email"])
+                addr_key = normalize_address(email)
+                if addr_key and (addr_key in blocked or (dedupe and addr_key in seen)):
+                    reason = "trùng trong danh sách" if addr_key in seen else "đã chặn hoặc đã gửi trước đó"
+                    results.put(("skipped", i, email, reason))
+                    continue
+                if dedupe:
+                    seen.add(addr_key)
+                if not email or not is_valid_email(email):
+                    err_msg = f"Email không hợp lệ: '{email}'. Có thể bạn đã nhập nhầm Tên vào cột Email?"
+                    results.put(("invalid", i, email, err_msg))
+                    continue
+                # Build token mapping from ALL columns (including optional Code, etc.)
+                tokens = {col: normalize_field(row.get(col, "")) for col in columns}
+                tokens["Ten"] = normalize_field(row["Ten"])
+                tokens["Email"] = email
+                cc, bcc = normalize_field(row.get("CC", "")), normalize_field(row.get("BCC", ""))
+                if suppressed and (cc or bcc):
+                    cc, dropped_cc = _drop_suppressed(cc, suppressed)
+                    bcc, dropped_bcc = _drop_suppressed(bcc, suppressed)
+                    if dropped_cc or dropped_bcc:
+                        results.put(("note", f"[SKIP CC/BCC] {email}: bỏ địa chỉ đã chặn {', '.join(dropped_cc + dropped_bcc)}"))
+                job = {
+                    "index": i,
+                    "email": email,
+                    "cc": cc,
+                    "bcc": bcc,
+                    "fpdf": normalize_field(row.get("FilePDF", "")),
+                    "subj_tpl": normalize_field(row.get("Subject", "")),
+                    "tokens": tokens,
+                    "domain": email_domain(email),
+                }
+                if state is not None:
+                    fpdf = job["fpdf"]
+                    if fpdf and not _is_http_url(fpdf):
+                        try:
+                            fpdf = state.file_digest(_resolve_file_path(fpdf, base, root=file_root).resolve())
+                        except ValueError:
+                            pass  # refused path: the build step fails the row
+                    job["row_hash"] = row_fingerprint(email, tokens, fpdf)
+                    if job["row_hash"] in delivered:
+                        results.put(("unchanged", i, email))
+                        continue
+                batchable = batching and not job["cc"] and not has_tokens(job["subj_tpl"])
+                key = (job["subj_tpl"], job["fpdf"], job["domain"] if domains is not None else "") if batchable else None
+                if groups:
+                    # Partial groups must not pile up until the sheet ends (rows
+                    # with their own FilePDF or Subject each open a group):
+                    # flush the oldest on a new key beyond BATCH_OPEN_GROUPS,
+                    # when it gets old, or when too many rows are held.
+                    now = time.monotonic()
+                    while groups and (
+                        (key is not None and key not in groups and len(groups) >= BATCH_OPEN_GROUPS)
+                        or held >= BATCH_MAX_HELD
+                        or now - opened[next(iter(groups))] >= BATCH_MAX_AGE
+                    ):
+                        flush_group(next(iter(groups)))
+                if batchable:
+                    if key not in groups:
+                        groups[key] = []
+                        opened[key] = time.monotonic()
+                    groups[key].append(job)
+                    held += 1
+                    if len(groups[key]) >= batch_size:
+                        flush_group(key)
+                    continue
+                submit(job)
+            for key in list(groups):
+                if stop.is_set():
+                    break
+                flush_group(key)
+        except BaseException as exc:
+            stop.set()
+            results.put(("crash", exc))
+        finally:
+            if domains is not None:
+                domains.close()
+            else:
+                for _ in range(build_workers):
+                    job_q.put(None)
+
+    def builder():
+        try:
+            while True:
+                job = next_job()
+                if job is None:
+                    break
+                if stop.is_set():
+                    continue
+                if "built" in job:  # a retry handed back by the domain scheduler
+                    send_q.put((job, *job.pop("built")))
+                    continue
+                try:
+                    # URL attachments are downloaded here; workers only get local paths.
+                    t_resolve = time.perf_counter()
+                    if job["fpdf"]:
+                        job["attachment"] = str(attachments.resolve(job["fpdf"], base, root=file_root, allow_urls=allow_attachment_urls))
+                    resolve_s = time.perf_counter() - t_resolve
+                    if pool is not None:
+                        data, rcpts, stages = pool.submit(_build_job_in_process, job).result()
+                    else:
+                        data, rcpts, stages = _build_job(ctx, job)
+                    mt = MessageTimings(stages)
+                    mt.add("attach", resolve_s)
+                    mt.size = len(data)
+                except Exception as e:
+                    release(job)
+                    results.put(("failed", job, e, None))
+                    continue
+                send_q.put((job, data, rcpts, mt))
+        except BaseException as exc:
+            stop.set()
+            results.put(("crash", exc))
+        finally:
+            with builders_lock:
+                builders_left[0] -= 1
+                last = builders_left[0] == 0
+            if last:
+                for _ in range(connections):
+                    send_q.put(None)
+
+    quota = {"left": send_limit}
+    quota_lock = threading.Lock()
+
+    def take_quota(n: int) -> bool:
+        if send_limit <= 0:
+            return True
+        with quota_lock:
+            if quota["left"] < n:
+                return False
+            quota["left"] -= n
+            return True
+
+    def retried(job, e, attempt):
+        results.put(("retry", job, e, attempt))
+
+    def send_one(smtp, job, data, rcpts, mt):
+        if not job.get("attempt") and not take_quota(len(job.get("members") or [job])):
+            stop.set()
+            return
+        if spool is not None:
+            # Build-only phase: no pacing, the drain applies the provider's rate.
+            try:
+                members = [{"index": m["index"], "email": m["email"]} for m in job.get("members") or []]
+                spool.add(job["index"], job["email"], rcpts, data, members=members)
+                results.put(("sent", job, rcpts, mt, 0.0, {}))
+            except Exception as e:
+                results.put(("failed", job, e, mt))
+            return
+        if smtp is None:
+            limiter.wait()
+            results.put(("sent", job, rcpts, mt, 0.0, {}))
+            return
+        t_send = time.perf_counter()
+        if domains is not None:
+            # One attempt per hand-out: on a transient error (e.g. 421 4.7.28)
+            # the built message goes back to the scheduler with a cooldown for
+            # its domain, and this sender carries on with other domains.
+            attempt = job.get("attempt", 0)
+            try:
+                refused = _deliver(smtp, smtp_user, rcpts, data, mt, limiter, 0, retry_delay)
+            except Exception as e:
+                if attempt < max_retries and _is_transient_smtp_error(e):
+                    job["attempt"] = attempt + 1
+                    job["built"] = (data, rcpts, mt)
+                    retried(job, e, attempt + 1)
+                    domains.requeue(job, job["domain"], max(0.0, retry_delay) * (2 ** attempt))
+                else:
+                    results.put(("failed", job, e, mt))
+                return
+            results.put(("sent", job, rcpts, mt, time.perf_counter() - t_send, refused))
+            return
+        try:
+            refused = _deliver(
+                smtp, smtp_user, rcpts, data, mt, limiter, max_retries, retry_delay,
+                on_retry=lambda e, attempt: retried(job, e, attempt),
             )
-            sent += 1
-            log(f"[OK] {email}")
+            results.put(("sent", job, rcpts, mt, time.perf_counter() - t_send, refused))
         except Exception as e:
-            failed += 1
-            errors.append((email, str(e)))
-            log(f"[ERR] {email} -> {e}")
+            results.put(("failed", job, e, mt))
 
-        time.sleep(max(0.0, rate_delay))
+    def sender_loop():
+        smtp = None
+        if not (dry_run or spool is not None):
+            if sender_pool is not None:
+                smtp = sender_pool.acquire(smtp_host, smtp_port, smtp_user, smtp_pass, use_starttls=not use_ssl, pipelining=smtp_pipelining)
+            else:
+                smtp = SmtpSender(smtp_host, smtp_port, smtp_user, smtp_pass, use_starttls=not use_ssl, pipelining=smtp_pipelining)
+        try:
+            while True:
+                item = send_q.get()
+                if item is None:
+                    break
+                if stop.is_set():
+                    continue
+                job, data, rcpts, mt = item
+                try:
+                    send_one(smtp, job, data, rcpts, mt)
+                finally:
+                    release(job)
+        except BaseException as exc:
+            stop.set()
+            results.put(("crash", exc))
+        finally:
+            if smtp is not None:
+                if sender_pool is not None:
+                    sender_pool.release(smtp)
+                else:
+                    smtp.close()
+            results.put(("sender_done",))
+
+    remaining = total
+    mail_metrics.CAMPAIGNS_RUNNING.inc()
+    mail_metrics.QUEUE_DEPTH.inc(remaining)
+    last_textfile = 0.0
+
+    def publish_metrics(force: bool = False):
+        nonlocal last_textfile
+        if not metrics_textfile:
+            return
+        now = time.monotonic()
+        if force or now - last_textfile >= 5.0:
+            last_textfile = now
+            try:
+                mail_metrics.write_textfile(metrics_textfile)
+            except Exception:
+                pass
+
+    def row_done():
+        nonlocal remaining
+        remaining -= 1
+        mail_metrics.QUEUE_DEPTH.dec()
+        publish_metrics()
+
+    def row_sent(member: dict):
+        nonlocal sent
+        row_done()
+        sent += 1
+        if spool is not None:
+            log(f"[SPOOLED] {member['email']}")
+            emit(EVENT_ROW_SENT, member["index"], member["email"], "spooled")
+            return
+        if store is not None and not dry_run:
+            store.record_sent(campaign_id, member["email"])
+        if state is not None and not dry_run:
+            state.record_sent(campaign_id, member["row_hash"], member["email"])
+        mail_metrics.MESSAGES_SENT.inc()
+        mail_metrics.SEND_METER.mark()
+        log(f"[OK] {member['email']}")
+        emit(EVENT_ROW_SENT, member["index"], member["email"])
+
+    def row_failed(member: dict, e: Exception):
+        nonlocal failed
+        row_done()
+        failed += 1
+        errors.append((member["email"], str(e)))
+        if store is not None and isinstance(e, smtplib.SMTPRecipientsRefused):
+            for addr, (code, resp) in e.recipients.items():
+                if code >= 500:
+                    store.suppress(addr, REASON_HARD_BOUNCE, f"{code} {resp!r}")
+        mail_metrics.MESSAGES_FAILED.inc()
+        log(f"[ERR] {member['email']} -> {e}")
+        emit(EVENT_ROW_FAILED, member["index"], member["email"], str(e))
+
+    emit(EVENT_STARTED)
+    threads = [threading.Thread(target=reader, name="merge-reader", daemon=True)]
+    threads += [threading.Thread(target=builder, name=f"merge-build-{n}", daemon=True) for n in range(build_workers)]
+    threads += [threading.Thread(target=sender_loop, name=f"merge-send-{n}", daemon=True) for n in range(connections)]
+    crash: BaseException | None = None
+    try:
+        for t in threads:
+            t.start()
+        senders_running = connections
+        while senders_running:
+            res = results.get()
+            kind = res[0]
+            if kind == "sender_done":
+                senders_running -= 1
+                continue
+            if kind == "crash":
+                crash = crash or res[1]
+                continue
+            if kind == "note":
+                log(res[1])
+                continue
+            if kind == "retry":
+                _, job, e, attempt = res
+                mail_metrics.MESSAGES_RETRIED.inc()
+                log(f"[RETRY {attempt}/{max_retries}] {_job_label(job)} -> {e}")
+                emit(EVENT_RETRY, job["index"], job["email"], str(e), attempt)
+                continue
+
+            if kind == "skipped":
+                _, i, email, reason = res
+                row_done()
+                skipped += 1
+                log(f"[SKIP] {email} ({reason})")
+                mail_metrics.MESSAGES_SKIPPED.inc()
+                emit(EVENT_ROW_SKIPPED, i, email, reason)
+                timings.record(i, email, "skipped")
+            elif kind == "unchanged":
+                # Not logged per row: most of a re-run sheet is unchanged.
+                _, i, email = res
+                row_done()
+                skipped += 1
+                unchanged += 1
+                mail_metrics.MESSAGES_SKIPPED.inc()
+                emit(EVENT_ROW_SKIPPED, i, email, "không thay đổi")
+                timings.record(i, email, "skipped")
+            elif kind == "invalid":
+                _, i, email, err_msg = res
+                row_done()
+                failed += 1
+                errors.append((email or "N/A", err_msg))
+                log(f"[ERR] {email} -> {err_msg}")
+                mail_metrics.MESSAGES_FAILED.inc()
+                emit(EVENT_ROW_FAILED, i, email or "N/A", err_msg)
+                timings.record(i, email, "invalid")
+            elif kind == "sent":
+                _, job, rcpts, mt, latency, refused = res
+                members = job.get("members") or [job]
+                if dry_run and spool is None:
+                    log(f"[DRY-RUN] Would send to: {rcpts}")
+                elif spool is None:
+                    mail_metrics.SMTP_LATENCY.observe(latency)
+                for member in members:
+                    err = refused.get(member["email"]) if len(members) > 1 else None
+                    if err:
+                        row_failed(member, smtplib.SMTPRecipientsRefused({member["email"]: err}))
+                    else:
+                        row_sent(member)
+                timings.record(job["index"], _job_label(job), "sent", mt)
+            elif kind == "failed":
+                _, job, e, mt = res
+                for member in job.get("members") or [job]:
+                    row_failed(member, e)
+                timings.record(job["index"], _job_label(job), "failed", mt)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        stop.set()
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        timings.close()
+        if store is not None:
+            store.close()
+        if state is not None:
+            state.close()
+        if attachment_cache is None:
+            attachments.close()
+        mail_metrics.QUEUE_DEPTH.dec(remaining)
+        mail_metrics.CAMPAIGNS_RUNNING.dec()
+        publish_metrics(force=True)
+        emit(EVENT_FINISHED)
+    if crash is not None:
+        raise crash
+
+    if incremental:
+        log(f"[INCREMENTAL] Bỏ qua {unchanged} dòng không thay đổi so với các lần gửi trước")
+    log(f"\nDone. Sent={sent}, Failed={failed}, Skipped={skipped}")
+    if errors:
+        log("Errors:")
+        for em, err in errors:
+            log(f" - {em}: {err}")
+
+    summary = {"sent": sent, "failed": failed, "skipped": skipped, "errors": errors, "timings": timings.summary()}
+    if incremental:
+        summary["unchanged"] = unchanged
+    if dry_run:
+        elapsed = time.monotonic() - started_at
+        capacity = timings.size_summary()
+        capacity.update(
+            recipients=sent,
+            build_seconds=round(elapsed, 3),
+            messages_per_second=round(capacity["messages"] / elapsed, 1) if elapsed > 0 else 0.0,
+            # The rate limiter spaces every message globally, whatever the number of connections.
+            estimated_send_seconds=round(capacity["messages"] * max(0.0, float(rate_delay)), 1),
+        )
+        summary["capacity"] = capacity
+        if capacity["messages"]:
+            log(
+                f"[DRY-RUN] {capacity['messages']} email ({sent} người nhận), tổng {_human_bytes(capacity['total_bytes'])}, "
+                f"TB {_human_bytes(capacity['mean_bytes'])}/email, lớn nhất {_human_bytes(capacity['max_bytes'])}, "
+                f"p95 ≤ {_human_bytes(capacity['p95_bytes'])}"
+            )
+            log(
+                f"[DRY-RUN] Dựng trong {elapsed:.1f}s ({capacity['messages_per_second']} email/s); "
+                f"ước tính gửi thật ~{_human_duration(capacity['estimated_send_seconds'])} với delay {rate_delay}s"
+            )
+    if spool is not None:
+        summary["spool_dir"] = str(spool.path)
+    return summary
+
+def drain_spool(
+    spool_dir: str,
+    smtp_host: str,
+    smtp_port: int,
+    smtp_user: str,
+    smtp_pass: str,
+    rate_delay: float = 2.0,
+    dry_run: bool = False,
+    use_ssl: bool = False,
+    progress_callback=None,
+    event_callback=None,
+    max_retries: int = 0,
+    retry_delay: float = 5.0,
+    suppression_db: str | None = None,
+    retry_failed: bool = True,
+    smtp_pipelining: bool = True,
+) -> dict:
+    """Send the messages previously written by run_merge(spool_dir=...).
+
+    Stored bytes are sent unchanged, so no template, spreadsheet or
+    attachment is touched. Each outcome is appended to the spool's state
+    log; running it again resumes with what is left (and, with
+    retry_failed, with what failed).
+    """
+    spool = Spool(spool_dir)
+    manifest = spool.read_manifest()
+    campaign_id = manifest.get("campaign_id", "")
+    entries = spool.pending(retry_failed=retry_failed)
+    total = sum(len(e.get("members") or [None]) for e in entries)
+    sent = failed = 0
+    errors = ErrorLog()
+    t_start = time.perf_counter()
+    store = SuppressionStore(suppression_db) if suppression_db else None
+
+    def log(message: str):
+        if progress_callback:
+            try:
+                progress_callback(message)
+            except Exception:
+                pass
+        else:
+            print(message)
+
+    def emit(kind: str, row_index=None, email: str = "", detail: str = "", attempt: int = 0):
+        if event_callback is None:
+            return
+        try:
+            event_callback(
+                ProgressEvent(
+                    kind=kind,
+                    total=total,
+                    sent=sent,
+                    failed=failed,
+                    elapsed=time.perf_counter() - t_start,
+                    row_index=row_index,
+                    email=email,
+                    detail=detail,
+                    attempt=attempt,
+                )
+            )
+        except Exception:
+            pass
+
+    log(f"Spool: {spool.path} — {len(entries)} email chờ gửi ({total} người nhận)")
+    smtp = None if dry_run else SmtpSender(
+        smtp_host, smtp_port, smtp_user, smtp_pass, use_starttls=not use_ssl, pipelining=smtp_pipelining
+    )
+    limiter = RateLimiter(rate_delay)
+    mail_metrics.CAMPAIGNS_RUNNING.inc()
+    emit(EVENT_STARTED)
+    try:
+        for entry in entries:
+            members = entry.get("members") or [{"index": entry["row"], "email": entry["email"]}]
+            data = spool.read(entry)
+            if smtp is None:
+                limiter.wait()
+                log(f"[DRY-RUN] Would send to: {entry['recipients']}")
+                refused = {}
+            else:
+                def on_retry(e, attempt, entry=entry):
+                    mail_metrics.MESSAGES_RETRIED.inc()
+                    log(f"[RETRY {attempt}/{max_retries}] {entry['email']} -> {e}")
+                    emit(EVENT_RETRY, entry["row"], entry["email"], str(e), attempt)
+
+                t_send = time.perf_counter()
+                try:
+                    refused = _deliver(
+                        smtp, manifest.get("sender") or smtp_user, entry["recipients"], data, None,
+                        limiter, max_retries, retry_delay, on_retry=on_retry,
+                    )
+                except Exception as e:
+                    spool.mark(entry["seq"], STATUS_FAILED, str(e))
+                    refused = {m["email"]: e for m in members}
+                else:
+                    spool.mark(entry["seq"], STATUS_SENT)
+                    mail_metrics.SMTP_LATENCY.observe(time.perf_counter() - t_send)
+            for member in members:
+                err = refused.get(member["email"])
+                if err is None:
+                    sent += 1
+                    if store is not None and not dry_run:
+                        store.record_sent(campaign_id, member["email"])
+                    mail_metrics.MESSAGES_SENT.inc()
+                    mail_metrics.SEND_METER.mark()
+                    log(f"[OK] {member['email']}")
+                    emit(EVENT_ROW_SENT, member["index"], member["email"])
+                    continue
+                if not isinstance(err, Exception):
+                    err = smtplib.SMTPRecipientsRefused({member["email"]: err})
+                failed += 1
+                errors.append((member["email"], str(err)))
+                if store is not None and isinstance(err, smtplib.SMTPRecipientsRefused):
+                    for addr, (code, resp) in err.recipients.items():
+                        if code >= 500:
+                            store.suppress(addr, REASON_HARD_BOUNCE, f"{code} {resp!r}")
+                mail_metrics.MESSAGES_FAILED.inc()
+                log(f"[ERR] {member['email']} -> {err}")
+                emit(EVENT_ROW_FAILED, member["index"], member["email"], str(err))
+    finally:
+        if smtp is not None:
+            smtp.close()
+        if store is not None:
+            store.close()
+        mail_metrics.CAMPAIGNS_RUNNING.dec()
+        emit(EVENT_FINISHED)
 
     log(f"\nDone. Sent={sent}, Failed={failed}")
     if errors:
         log("Errors:")
         for em, err in errors:
             log(f" - {em}: {err}")
+    return {"sent": sent, "failed": failed, "skipped": 0, "errors": errors, "spool_dir": str(spool.path)}
+
+
+# Command-line options whose run_merge parameter has another name.
+_OPTION_PARAMS = {
+    "timings_jsonl": "timings_path",
+    "no_pipelining": "smtp_pipelining",
+    "fast_dry_run": "dry_run_fast",
+    "no_image_optimization": "optimize_images",
+    "no_compile_template": "compile_html",
+    "domain_limit": "domain_limits",
+}
+
+
+def _given_options(parser: argparse.ArgumentParser, argv=None) -> set:
+    """Destinations of the options present on the command line, including
+    ones given at their default value."""
+    # argparse fills defaults only into missing attributes, so a namespace of
+    # markers keeps them wherever an option was not given. Append options
+    # copy the current list, so a fresh list is their marker.
+    missing = object()
+    markers = {dest: [] if isinstance(value, list) else missing for dest, value in vars(parser.parse_args(argv)).items()}
+    given = parser.parse_args(argv, namespace=argparse.Namespace(**markers))
+    return {dest for dest, value in vars(given).items() if value is not markers[dest]}
+
+
+def _run_merge_kwargs(args, domain_limits: dict) -> dict:
+    """run_merge keyword arguments for the parsed command line."""
+    return {
+        "recipients": args.recipients,
+        "template": args.template,
+        "smtp_host": args.smtp_host,
+        "smtp_port": args.smtp_port,
+        "smtp_user": args.smtp_user,
+        "smtp_pass": args.smtp_pass,
+        "from_name": args.from_name,
+        "default_subject": args.default_subject,
+        "rate_delay": args.rate_delay,
+        "dry_run": args.dry_run,
+        "use_ssl": args.use_ssl,
+        "base_dir": (args.base_dir or None),
+        "timings_path": (args.timings_jsonl or None),
+        "max_retries": args.max_retries,
+        "retry_delay": args.retry_delay,
+        "metrics_textfile": (args.metrics_textfile or None),
+        "suppression_db": (args.suppression_db or None),
+        "campaign_id": args.campaign_id,
+        "dedupe": args.dedupe,
+        "build_workers": args.build_workers,
+        "build_mode": args.build_mode,
+        "connections": args.connections,
+        "queue_size": args.queue_size,
+        "smtp_pipelining": not args.no_pipelining,
+        "batch_size": args.batch_size,
+        "spool_dir": (args.spool_dir or None),
+        "dry_run_fast": args.fast_dry_run,
+        "optimize_images": not args.no_image_optimization,
+        "compile_html": not args.no_compile_template,
+        "dkim_domain": args.dkim_domain,
+        "dkim_selector": args.dkim_selector,
+        "dkim_key": args.dkim_key,
+        "incremental": args.incremental,
+        "interleave_domains": args.interleave_domains,
+        "domain_concurrency": args.domain_concurrency,
+        "domain_rate_delay": args.domain_rate_delay,
+        "domain_limits": domain_limits or None,
+    }
 
-    return {"sent": sent, "failed": failed, "errors": errors}
 
 def main():
     parser = argparse.ArgumentParser(description="Mail Merge kèm PDF per-recipient (local).")
-    parser.add_argument("--recipients", required=True, help="Đường dẫn recipients .xlsx/.csv")
-    parser.add_argument("--template", required=True, help="Đường dẫn template HTML")
-    parser.add_argument("--smtp-host", required=True, help="SMTP host (vd: smtp.gmail.com hoặc smtp.office365.com)")
+    parser.add_argument("--recipients", default="", help="Đường dẫn recipients .xlsx/.csv")
+    parser.add_argument("--template", default="", help="Đường dẫn template HTML")
+    parser.add_argument("--smtp-host", default="", help="SMTP host (vd: smtp.gmail.com hoặc smtp.office365.com)")
     parser.add_argument("--smtp-port", type=int, default=587, help="SMTP port (Gmail/Office365 STARTTLS = 587)")
-    parser.add_argument("--smtp-user", required=True, help="SMTP username (email)")
-    parser.add_argument("--smtp-pass", required=True, help="SMTP password (Gmail dùng App Password)")
+    parser.add_argument("--smtp-user", default="", help="SMTP username (email)")
+    parser.add_argument("--smtp-pass", default="", help="SMTP password (Gmail dùng App Password)")
     parser.add_argument("--from-name", default="", help="Tên hiển thị người gửi (optional)")
     parser.add_argument("--default-subject", default="Kết quả bài thi Versant level 1 - {{Ten}}", help="Subject mặc định nếu cột Subject trống")
     parser.add_argument("--rate-delay", type=float, default=2.0, help="Delay (giây) giữa mỗi email để tránh bị giới hạn")
     parser.add_argument("--dry-run", action="store_true", help="Chạy thử: không gửi email thật")
+    parser.add_argument("--fast-dry-run", action="store_true", help="Chạy thử tốc độ cao: bỏ delay, dựng song song, báo cáo dung lượng và thời gian gửi ước tính (kết hợp --spool-dir để lưu file .eml)")
     parser.add_argument("--use-ssl", action="store_true", help="Dùng SMTPS (SSL) thay vì STARTTLS")
     parser.add_argument("--base-dir", default="", help="Thư mục gốc chứa file đính kèm khi cột FilePDF là đường dẫn tương đối")
+    parser.add_argument("--timings-jsonl", default="", help="Ghi thời gian từng bước (JSON lines) cho mỗi email vào file này")
+    parser.add_argument("--max-retries", type=int, default=0, help="Số lần gửi lại khi gặp lỗi SMTP tạm thời (4xx, mất kết nối)")
+    parser.add_argument("--retry-delay", type=float, default=5.0, help="Delay (giây) trước lần gửi lại đầu tiên, tăng gấp đôi mỗi lần")
+    parser.add_argument("--metrics-port", type=int, default=0, help="Mở endpoint Prometheus /metrics trên port này (0 = tắt)")
+    parser.add_argument("--metrics-textfile", default="", help="Ghi metrics ra file (node_exporter textfile collector)")
+    parser.add_argument("--suppression-db", default="", help="SQLite danh sách chặn + lịch sử đã gửi (bỏ qua email bị chặn/đã gửi)")
+    parser.add_argument("--campaign-id", default="", help="Mã chiến dịch: không gửi lại email đã gửi thành công trong cùng chiến dịch")
+    parser.add_argument("--incremental", action="store_true", help="Chỉ gửi dòng mới hoặc đã thay đổi (nội dung, file PDF) so với các lần chạy trước của --campaign-id")
+    parser.add_argument("--dedupe", action="store_true", help="Bỏ qua dòng trùng email trong 1 file (mặc định gửi mọi dòng, ví dụ cùng người nhận nhưng khác file đính kèm)")
+    parser.add_argument("--build-workers", type=int, default=1, help="Số luồng/tiến trình dựng email song song (0 = số CPU)")
+    parser.add_argument("--build-mode", choices=["thread", "process"], default=None, help="Dựng email bằng thread hoặc process pool (process: nhanh hơn với PDF/ảnh lớn; mặc định process khi --fast-dry-run, còn lại thread)")
+    parser.add_argument("--connections", type=int, default=1, help="Số kết nối SMTP gửi song song")
+    parser.add_argument("--queue-size", type=int, default=64, help="Kích thước hàng đợi giữa các bước (giới hạn bộ nhớ)")
+    parser.add_argument("--no-pipelining", action="store_true", help="Tắt ESMTP PIPELINING/CHUNKING (gửi từng lệnh một)")
+    parser.add_argument("--no-compile-template", action="store_true", help="Giữ nguyên template (không inline CSS/thu gọn HTML)")
+    parser.add_argument("--no-image-optimization", action="store_true", help="Nhúng ảnh nguyên bản (không thu nhỏ/nén lại ảnh inline)")
+    parser.add_argument("--interleave-domains", action="store_true", help="Xen kẽ người nhận theo tên miền (gmail.com, yahoo.com...) thay vì gửi liên tục cho 1 tên miền")
+    parser.add_argument("--domain-concurrency", type=int, default=0, help="Số email gửi đồng thời tối đa cho mỗi tên miền (0 = không giới hạn)")
+    parser.add_argument("--domain-rate-delay", type=float, default=0.0, help="Delay (giây) tối thiểu giữa 2 email tới cùng tên miền")
+    parser.add_argument("--domain-limit", action="append", default=[], metavar="DOMAIN=N[:DELAY]", help="Giới hạn riêng cho 1 tên miền, vd: gmail.com=2:1.5 (lặp lại được)")
+    parser.add_argument("--batch-size", type=int, default=0, help="Template không có token: gộp tối đa N người nhận (BCC) vào 1 email (0 = tắt)")
+    parser.add_argument("--dkim-domain", default="", help="Domain ký DKIM (d=), vd: cdimex.com.vn")
+    parser.add_argument("--dkim-selector", default="", help="Selector DKIM (s=), bản ghi TXT <selector>._domainkey.<domain>")
+    parser.add_argument("--dkim-key", default="", help="File khóa riêng DKIM (PEM, RSA hoặc Ed25519); để trống = không ký")
+    parser.add_argument("--spool-dir", default="", help="Chỉ dựng email và lưu vào thư mục spool (gửi sau bằng --drain-spool)")
+    parser.add_argument("--manifest", default="", help="Chạy nhiều chiến dịch trong 1 tiến trình theo file manifest (.yaml/.json)")
+    parser.add_argument("--drain-spool", default="", help="Gửi các email đã dựng sẵn trong thư mục spool này")
     args = parser.parse_args()
 
-    run_merge(
-        recipients=args.recipients,
-        template=args.template,
-        smtp_host=args.smtp_host,
-        smtp_port=args.smtp_port,
-        smtp_user=args.smtp_user,
-        smtp_pass=args.smtp_pass,
-        from_name=args.from_name,
-        default_subject=args.default_subject,
-        rate_delay=args.rate_delay,
-        dry_run=args.dry_run,
-        use_ssl=args.use_ssl,
-        base_dir=(args.base_dir or None),
-    )
+    if args.manifest:
+        missing = []
+    elif args.drain_spool:
+        missing = [] if args.dry_run else [f for f in ("smtp_host", "smtp_user", "smtp_pass") if not getattr(args, f)]
+    else:
+        args.dry_run = args.dry_run or args.fast_dry_run
+        needs_smtp = not (args.dry_run or args.spool_dir)
+        missing = [f for f in ("recipients", "template", "smtp_user") if not getattr(args, f)]
+        missing += [f for f in ("smtp_host", "smtp_pass") if needs_smtp and not getattr(args, f)]
+        if args.incremental and not args.campaign_id:
+            missing.append("campaign_id")
+    domain_limits = {}
+    for spec in args.domain_limit:
+        try:
+            domain, sep, limit = spec.partition("=")
+            if not sep or not domain.strip():
+                raise ValueError(spec)
+            conc, _, delay = limit.partition(":")
+            domain_limits[domain.strip().lower()] = {"concurrency": int(conc or 0), "rate_delay": float(delay or 0)}
+        except ValueError:
+            parser.error(f"--domain-limit không hợp lệ: {spec} (vd: gmail.com=2:1.5)")
+    if missing:
+        parser.error("thiếu tham số: " + ", ".join("--" + f.replace("_", "-") for f in missing))
+
+    if args.metrics_port:
+        mail_metrics.start_http_server(args.metrics_port)
+
+    if args.manifest:
+        from campaign_manifest import run_manifest  # deferred: imports this module
+
+        # Options given on the command line apply to every campaign of the manifest,
+        # also when given at their default value.
+        kwargs = _run_merge_kwargs(args, domain_limits)
+        params = {_OPTION_PARAMS.get(dest, dest) for dest in _given_options(parser)}
+        overrides = {k: v for k, v in kwargs.items() if k in params and k not in ("smtp_pass", "dry_run")}
+        try:
+            results = run_manifest(args.manifest, smtp_pass=args.smtp_pass, dry_run=args.dry_run or args.fast_dry_run,
+                                   overrides=overrides)
+        except ValueError as exc:
+            parser.error(str(exc))
+        if any(r.get("error") for r in results):
+            raise SystemExit(1)
+        return
+
+    if args.drain_spool:
+        drain_spool(
+            spool_dir=args.drain_spool,
+            smtp_host=args.smtp_host,
+            smtp_port=args.smtp_port,
+            smtp_user=args.smtp_user,
+            smtp_pass=args.smtp_pass,
+            rate_delay=args.rate_delay,
+            dry_run=args.dry_run,
+            use_ssl=args.use_ssl,
+            max_retries=args.max_retries,
+            retry_delay=args.retry_delay,
+            suppression_db=(args.suppression_db or None),
+            smtp_pipelining=not args.no_pipelining,
+        )
+        return
+
+    run_merge(**_run_merge_kwargs(args, domain_limits))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
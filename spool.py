@@ -0,0 +1,97 @@
+"""On-disk outbox: build messages now, send them later.
+
+Layout of a spool directory:
+
+    spool.json      campaign metadata (sender, campaign id, created time)
+    messages/       one serialised .eml per message, exactly as it will be sent
+    index.jsonl     one line per message: seq, row, email, envelope recipients
+    state.jsonl     append-only delivery log (sent / failed), last entry wins
+
+Both .jsonl files are append-only, so the spool doubles as an audit trail
+and a drain can be interrupted and resumed at any point.
+"""
+
+import json
+import threading
+from datetime import datetime
+from pathlib import Path
+
+STATUS_SENT = "sent"
+STATUS_FAILED = "failed"
+
+
+def _now() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class Spool:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.messages_dir = self.path / "messages"
+        self.messages_dir.mkdir(parents=True, exist_ok=True)
+        self._index_path = self.path / "index.jsonl"
+        self._state_path = self.path / "state.jsonl"
+        self._lock = threading.Lock()
+        self._seq = sum(1 for _ in self._read_jsonl(self._index_path))
+
+    @staticmethod
+    def _read_jsonl(path: Path):
+        if not path.exists():
+            return
+        with open(path, encoding="utf-8") as fh:
+            for line in fh:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+    def _append(self, path: Path, record: dict) -> None:
+        with open(path, "a", encoding="utf-8") as fh:
+            fh.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    def write_manifest(self, **meta) -> None:
+        meta.setdefault("created_at", _now())
+        (self.path / "spool.json").write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    def read_manifest(self) -> dict:
+        p = self.path / "spool.json"
+        return json.loads(p.read_text(encoding="utf-8")) if p.exists() else {}
+
+    def add(self, row, email: str, recipients: list, data: bytes, members: list | None = None) -> str:
+        """Store one serialised message and index it; returns its file name."""
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            name = f"{seq:08d}.eml"
+            (self.messages_dir / name).write_bytes(data)
+            record = {"seq": seq, "file": name, "row": row, "email": email, "recipients": recipients, "size": len(data)}
+            if members:
+                record["members"] = members
+            self._append(self._index_path, record)
+        return name
+
+    def entries(self):
+        return self._read_jsonl(self._index_path)
+
+    def statuses(self) -> dict:
+        status = {}
+        for rec in self._read_jsonl(self._state_path):
+            status[rec["seq"]] = rec
+        return status
+
+    def pending(self, retry_failed: bool = True) -> list:
+        """Index entries not yet delivered (and, optionally, previously failed ones)."""
+        status = self.statuses()
+        out = []
+        for entry in self.entries():
+            st = status.get(entry["seq"], {}).get("status")
+            if st == STATUS_SENT or (st == STATUS_FAILED and not retry_failed):
+                continue
+            out.append(entry)
+        return out
+
+    def read(self, entry: dict) -> bytes:
+        return (self.messages_dir / entry["file"]).read_bytes()
+
+    def mark(self, seq: int, status: str, error: str = "") -> None:
+        with self._lock:
+            self._append(self._state_path, {"seq": seq, "status": status, "error": error, "at": _now()})
@@ -19,8 +19,11 @@ try:
 except Exception:
     fcntl = None  # type: ignore
 import base64
+import itertools
 import mimetypes
 import re
+from collections import deque
+from datetime import datetime
 
 import streamlit as st
 try:
@@ -33,8 +36,21 @@ try:
 except Exception:
     st_quill = None
 
-from send_mail_merge import run_merge, render_template
-
+from send_mail_merge import (
+    run_merge, render_template, ProgressEvent, EVENT_FINISHED, STATE_DIR, RECIPIENTS_CACHE_DIR,
+    load_recipients, normalize_field,
+)
+import mail_metrics
+from suppression import SuppressionStore, REASON_UNSUBSCRIBE
+from template_compiler import compile_email_html, compile_template
+from scheduler import Scheduler, SCHEDULER_DB, STATUS_PENDING, STATUS_RUNNING
+from upload_store import UploadStore, UPLOAD_VIEW_DIR, STATUS_REPLACED
+
+# Errors listed in the result panel; the full list is in the log file.
+MAX_ERRORS_SHOWN = 200
+# Full run logs (download button); only the newest LOG_KEEP are kept.
+LOG_DIR = STATE_DIR / "logs"
+LOG_KEEP = 5
 
 # ========== Tiện ích chung ==========
 def _env_str(name: str, default: str = "") -> str:
@@ -126,27 +142,6 @@ def _human_size(num_bytes: int) -> str:
     return f"{size:.1f} {units[unit_idx]}"
 
 
-def _extract_body_html(html: str) -> str:
-    """Return inner HTML of <body> if present, else return original string.
-
-    Users may paste full HTML documents into header/footer editors; for email composition
-    we only want the body portion to avoid nested <html>/<body>.
-    """
-    if not html:
-        return ""
-    m = re.search(r"<body\b[^>]*>(?P<body>[\s\S]*?)</body>", html, flags=re.IGNORECASE)
-    if m:
-        return (m.group("body") or "").strip()
-    return html.strip()
-
-
-def _extract_style_blocks(html: str) -> str:
-    if not html:
-        return ""
-    blocks = re.findall(r"<style\b[^>]*>[\s\S]*?</style>", html, flags=re.IGNORECASE)
-    return "\n".join(blocks).strip()
-
-
 def _looks_empty_rich_html(html: str | None) -> bool:
     """Heuristic for WYSIWYG editors that return '<p><br></p>' etc."""
     if html is None:
@@ -163,54 +158,6 @@ def _looks_empty_rich_html(html: str | None) -> bool:
     return False
 
 
-def _compose_email_html(header_html: str, body_html: str, footer_html: str) -> str:
-    """Compose a single HTML document for sending / preview."""
-    header_body = _extract_body_html(header_html)
-    body_body = _extract_body_html(body_html)
-    footer_body = _extract_body_html(footer_html)
-
-    style_blocks = "\n".join(
-        b
-        for b in [
-            _extract_style_blocks(header_html),
-            _extract_style_blocks(body_html),
-            _extract_style_blocks(footer_html),
-        ]
-        if b
-    ).strip()
-
-    # Email-friendly wrapper: centered 600px content
-    parts: List[str] = [
-        "<!doctype html>",
-        "<html>",
-        "<head>",
-        '  <meta charset="utf-8"/>',
-        '  <meta name="viewport" content="width=device-width, initial-scale=1"/>',
-    ]
-    if style_blocks:
-        parts.append(style_blocks)
-    parts += [
-        "</head>",
-        '<body style="margin:0;padding:0;">',
-        '  <table width="100%" border="0" cellspacing="0" cellpadding="0" align="center" style="background:#ffffff;">',
-        "    <tr>",
-        '      <td align="center" style="padding:0;">',
-        '        <table width="600" border="0" cellspacing="0" cellpadding="0" style="max-width:600px;width:100%;">',
-        "          <tr><td>",
-        header_body,
-        body_body,
-        footer_body,
-        "          </td></tr>",
-        "        </table>",
-        "      </td>",
-        "    </tr>",
-        "  </table>",
-        "</body>",
-        "</html>",
-    ]
-    return "\n".join([p for p in parts if p is not None])
-
-
 def _file_to_data_url(path: Path) -> str | None:
     try:
         mime, _ = mimetypes.guess_type(str(path))
@@ -279,11 +226,13 @@ def _load_preview_tokens(uploaded_recipients) -> Dict[str, str]:
         suffix = Path(name).suffix.lower()
         uploaded_recipients.seek(0)
         if suffix in {".xlsx", ".xls"}:
-            import pandas as pd  # local import
-            df = pd.read_excel(uploaded_recipients)
+            from recipient_cache import read_excel_cached  # local import
+
+            df = read_excel_cached(uploaded_recipients, RECIPIENTS_CACHE_DIR)
         elif suffix == ".csv":
-            import pandas as pd  # local import
-            df = pd.read_csv(uploaded_recipients)
+            from recipient_cache import read_csv_table  # local import
+
+            df = read_csv_table(uploaded_recipients)
         else:
             return tokens
         # Rewind again so later save_upload() reads full content.
@@ -293,7 +242,7 @@ def _load_preview_tokens(uploaded_recipients) -> Dict[str, str]:
             pass
         if df is None or len(df) == 0:
             return tokens
-        row0 = df.iloc[0].to_dict()
+        row0 = next(iter(df.iterrows()))[1]
         for k in ["Ten", "Email", "Code"]:
             if k in row0 and str(row0[k]).strip():
                 tokens[k] = str(row0[k]).strip()
@@ -307,36 +256,228 @@ class ThrottledLogger:
 
     - batch_size: gom N dòng rồi mới vẽ
     - min_interval: ít nhất mỗi X giây mới vẽ 1 lần
+    - max_lines: chỉ giữ khoảng N dòng cuối trên UI
+
+    Mỗi batch là một phần tử text mới nối vào "trang" hiện tại, nên mỗi lần
+    vẽ chỉ gửi các dòng mới lên trình duyệt. Khi trang đủ max_lines/2 dòng
+    thì mở trang mới và xoá trang cũ nhất (giữ 2 trang).
+
+    Toàn bộ log được ghi nối tiếp ra file (spill_path, trong LOG_DIR) để tải
+    về khi xong; close() chỉ giữ lại LOG_KEEP file gần nhất.
     """
-    def __init__(self, placeholder, batch_size: int = 12, min_interval: float = 0.25):
-        self.placeholder = placeholder
+    def __init__(self, placeholder, batch_size: int = 12, min_interval: float = 0.25, max_lines: int = 800):
         self.batch_size = batch_size
         self.min_interval = min_interval
+        self.page_lines = max(1, max_lines // 2)
+        self._root = placeholder.container()
         self._buf: List[str] = []
-        self._all: List[str] = []
+        # [placeholder của trang, container bên trong, số dòng đã vẽ]
+        self._pages: deque = deque()
         self._last_flush = 0.0
+        self.line_count = 0
+        # File chỉ được tạo khi có dòng log đầu tiên (tránh rác mỗi lần rerun)
+        self._spill = None
+        self.spill_path: Path | None = None
 
     def __call__(self, line: str) -> None:
         self._buf.append(line)
-        self._all.append(line)
+        self.line_count += 1
         now = time.time()
         if len(self._buf) >= self.batch_size or (now - self._last_flush) >= self.min_interval:
             # chỉ render một lần cho cả batch
-            self.placeholder.text("\n".join(self._all[-800:]))  # tránh render quá dài
-            self._buf.clear()
-            self._last_flush = now
+            self._render(now)
+
+    def _render(self, now: float) -> None:
+        chunk = "\n".join(self._buf)
+        if self._spill is None:
+            LOG_DIR.mkdir(parents=True, exist_ok=True)
+            self._spill = tempfile.NamedTemporaryFile(
+                "w", encoding="utf-8", delete=False, prefix="mailmerge_log_", suffix=".txt", dir=LOG_DIR
+            )
+            self.spill_path = Path(self._spill.name)
+        self._spill.write(chunk + "\n")
+        if not self._pages or self._pages[-1][2] >= self.page_lines:
+            slot = self._root.empty()
+            self._pages.append([slot, slot.container(), 0])
+            if len(self._pages) > 2:
+                self._pages.popleft()[0].empty()
+        page = self._pages[-1]
+        page[1].text(chunk)
+        page[2] += len(self._buf)
+        self._buf.clear()
+        self._last_flush = now
 
     def flush(self) -> None:
         if self._buf:
-            self.placeholder.text("\n".join(self._all[-800:]))
-            self._buf.clear()
-            self._last_flush = time.time()
+            self._render(time.time())
+        if self._spill is not None:
+            self._spill.flush()
+
+    def close(self) -> None:
+        self.flush()
+        if self._spill is not None:
+            self._spill.close()
+        _rotate_logs(keep=LOG_KEEP)
+
+
+def _rotate_logs(keep: int) -> None:
+    """Delete all but the newest keep full-log files."""
+    try:
+        logs = sorted(LOG_DIR.glob("mailmerge_log_*.txt"), key=lambda p: p.stat().st_mtime, reverse=True)
+    except OSError:
+        return
+    for old in logs[keep:]:
+        try:
+            old.unlink()
+        except OSError:
+            pass
+
+
+class ProgressView:
+    """Hiển thị tiến độ (progress bar, tốc độ, ETA) từ ProgressEvent.
+
+    Chỉ giữ trạng thái gộp (số đã gửi/lỗi/retry) nên chi phí mỗi lần vẽ
+    là O(1), không phụ thuộc độ dài log.
+    """
+    def __init__(self, bar_placeholder, stats_placeholder, min_interval: float = 0.25):
+        self.bar = bar_placeholder
+        self.stats = stats_placeholder
+        self.min_interval = min_interval
+        self.retries = 0
+        self._last: ProgressEvent | None = None
+        self._last_render = 0.0
+
+    def __call__(self, event: ProgressEvent) -> None:
+        if event.kind == "retry":
+            self.retries += 1
+        self._last = event
+        now = time.time()
+        if event.kind == EVENT_FINISHED or (now - self._last_render) >= self.min_interval:
+            self.render()
+            self._last_render = now
+
+    def render(self) -> None:
+        ev = self._last
+        if ev is None:
+            return
+        total = max(ev.total, 1)
+        done = ev.processed
+        rate = done / ev.elapsed if ev.elapsed > 0 else 0.0
+        eta = (ev.total - done) / rate if rate > 0 else None
+        self.bar.progress(min(done / total, 1.0), text=f"{done}/{ev.total} dòng")
+        eta_text = f"{eta:.0f}s" if eta is not None else "—"
+        self.stats.caption(
+            f"Đã gửi: {ev.sent} · Lỗi: {ev.failed} · Bỏ qua: {ev.skipped} · Retry: {self.retries} · "
+            f"Tốc độ: {rate * 60:.1f} email/phút · ETA: {eta_text}"
+        )
 
 
 # ========== File Manager ==========
+@st.cache_resource
+def _get_scheduler() -> Scheduler:
+    """One scheduler (and worker thread) per Streamlit server process."""
+    sched = Scheduler(SCHEDULER_DB)
+    if _env_bool("SCHEDULER_IN_APP", True):
+        sched.start()
+    return sched
+
+
+@st.cache_resource
+def _get_upload_store() -> UploadStore:
+    """Content-addressed store behind uploads/, shared by all sessions."""
+    return UploadStore(view_dir=UPLOAD_VIEW_DIR)
+
+
+def _store_upload(store: UploadStore, name: str, fileobj, replaced: List[str]) -> str:
+    """Save one upload through the store; collects names whose content changed."""
+    digest, status = store.put(name, fileobj)
+    if status == STATUS_REPLACED:
+        replaced.append(name)
+    return digest
+
+
+def _store_attachment_uploads(store: UploadStore, pdf_uploads, zip_upload, replaced: List[str], log) -> List[str]:
+    """Save the PDF/ZIP upload boxes through the store; returns the digests used."""
+    digests: List[str] = []
+    for up in pdf_uploads or []:
+        digests.append(_store_upload(store, Path(up.name).name, up, replaced))
+    if zip_upload is not None:
+        zip_upload.seek(0)
+        with zipfile.ZipFile(zip_upload, "r") as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                try:
+                    with zf.open(info) as member:
+                        digests.append(_store_upload(store, info.filename, member, replaced))
+                except ValueError as exc:
+                    log(f"[WARN] Bỏ qua trong ZIP: {exc}")
+    return digests
+
+
+def _snapshot_for_schedule(store: UploadStore, recipients: Path) -> tuple:
+    """Pin the FilePDF files of a scheduled sheet; returns (base_dir, digests).
+
+    The job then reads its attachments from a folder of its own, so later
+    uploads under the same names (or an upload-store gc) cannot change them.
+    """
+    names = set()
+    for _, row in load_recipients(Path(recipients)).iterrows():
+        value = normalize_field(row.get("FilePDF", ""))
+        if value and not value.startswith(("http://", "https://")) and not Path(value).is_absolute():
+            names.add(value)
+    dest = STATE_DIR / "scheduled" / f"{time.strftime('%Y%m%d-%H%M%S')}_files"
+    return dest, store.snapshot(sorted(names), dest)
+
+
+def _persist_for_schedule(data: bytes, name: str) -> Path:
+    """Copy an input file somewhere that outlives the session for a scheduled job."""
+    dest_dir = STATE_DIR / "scheduled"
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    dest = dest_dir / f"{time.strftime('%Y%m%d-%H%M%S')}_{Path(name).name}"
+    dest.write_bytes(data)
+    return dest
+
+
+def render_schedule_tab(sched: Scheduler) -> None:
+    st.subheader("Lịch gửi")
+    st.caption(f"Lưu tại: {sched.path}")
+    if st.button("Làm mới", key="sched_refresh"):
+        _safe_rerun()
+    jobs = sched.jobs()
+    if not jobs:
+        st.info("Chưa có lịch gửi nào.")
+        return
+    rows = []
+    for j in jobs:
+        window = f"{j['window_start']}–{j['window_end']}" if j["window_start"] else "cả ngày"
+        rows.append(
+            {
+                "#": j["id"],
+                "Tên": j["name"],
+                "Trạng thái": j["status"],
+                "Đã gửi": f"{j['sent']}/{j['total'] or '?'}",
+                "Lỗi": j["failed"],
+                "Bắt đầu": j["start_at"],
+                "Khung giờ": window,
+                "Giới hạn/ngày": j["daily_cap"] or "-",
+                "Lần chạy tới": j["next_run_at"] if j["status"] == STATUS_PENDING else "",
+                "Ghi chú": j["message"],
+            }
+        )
+    st.table(rows)
+    active = [j["id"] for j in jobs if j["status"] in (STATUS_PENDING, STATUS_RUNNING)]
+    if active:
+        job_id = st.selectbox("Huỷ lịch gửi", active, format_func=lambda i: f"#{i}", key="sched_cancel_id")
+        if st.button("Huỷ", key="sched_cancel"):
+            sched.cancel(int(job_id))
+            _safe_rerun()
+
+
 def render_file_manager(root_dir: Path) -> None:
     st.header("Quản lý tệp & thư mục")
     st.caption("Thao tác trong phạm vi thư mục dự án để an toàn.")
+    store = _get_upload_store()
 
     # Session state
     if "fm_root" not in st.session_state:
@@ -404,20 +545,41 @@ def render_file_manager(root_dir: Path) -> None:
     if uploads:
         if st.button("Lưu các file upload", key="fm_save_uploads"):
             saved = 0
+            replaced: List[str] = []
             for uf in uploads:
                 dest = fm_cwd / Path(uf.name).name
                 if not _is_safe_relative_path(fm_root, dest):
                     st.error(f"Bỏ qua tệp không hợp lệ: {uf.name}")
                     continue
                 try:
-                    with open(dest, "wb") as f:
-                        f.write(uf.getbuffer())
+                    if _is_safe_relative_path(store.view_dir, dest):
+                        # Inside uploads/: deduplicated through the store.
+                        _store_upload(store, dest.resolve().relative_to(store.view_dir.resolve()).as_posix(), uf, replaced)
+                    else:
+                        uf.seek(0)
+                        with open(dest, "wb") as f:
+                            shutil.copyfileobj(uf, f, 1 << 20)
                     saved += 1
                 except Exception as exc:
                     st.error(f"Không thể lưu {uf.name}: {exc}")
             st.success(f"Đã lưu {saved} tệp vào {fm_cwd}")
+            if replaced:
+                st.warning(f"Đã thay nội dung của tệp trùng tên: {', '.join(replaced)}")
             _safe_rerun()
 
+    with st.expander("Kho upload (khử trùng lặp)"):
+        stats = store.stats()
+        st.write(
+            f"{stats['names']} tệp trong uploads/ • {stats['blobs']} nội dung khác nhau ({_human_size(stats['bytes'])}) • "
+            f"{stats['unreferenced']} không còn được dùng"
+        )
+        retention = st.number_input(
+            "Giữ tệp của chiến dịch đã gửi trong (ngày)", min_value=0, value=_env_int("UPLOAD_REF_RETENTION_DAYS", 30), key="fm_gc_days"
+        )
+        if st.button("Dọn tệp không dùng", key="fm_gc"):
+            result = store.gc(float(retention))
+            st.success(f"Đã xoá {result['blobs']} tệp ({_human_size(result['bytes'])}).")
+
     st.divider()
 
     # List entries
@@ -465,7 +627,9 @@ def render_file_manager(root_dir: Path) -> None:
                 if st.button("Xoá", key=f"delf_{e.name}", disabled=not allow_delete):
                     if _is_safe_relative_path(fm_root, e):
                         try:
-                            e.unlink(missing_ok=False)
+                            if not (_is_safe_relative_path(store.view_dir, e)
+                                    and store.remove(e.resolve().relative_to(store.view_dir.resolve()).as_posix())):
+                                e.unlink(missing_ok=False)
                             st.success(f"Đã xoá tệp: {e.name}")
                             _safe_rerun()
                         except Exception as exc:
@@ -484,11 +648,21 @@ def main() -> None:
     default_recipients = base / "recipients.xlsx"
     default_template = base / "template.html"
 
+    # Metrics endpoint (Prometheus) nếu được bật qua METRICS_PORT
+    metrics_port = _env_int("METRICS_PORT", 0)
+    if metrics_port:
+        try:
+            mail_metrics.start_http_server(metrics_port)
+        except OSError as exc:
+            st.sidebar.warning(f"Không mở được metrics port {metrics_port}: {exc}")
+
     # Trạng thái chạy để chặn bấm nhiều lần
     if "running" not in st.session_state:
         st.session_state["running"] = False
 
-    tab_send, tab_files = st.tabs(["Gửi Email", "Quản lý tệp & thư mục"])
+    scheduler = _get_scheduler()
+
+    tab_send, tab_schedule, tab_files = st.tabs(["Gửi Email", "Lịch gửi", "Quản lý tệp & thư mục"])
 
     with tab_send:
         # Sidebar: SMTP settings
@@ -515,6 +689,7 @@ def main() -> None:
         )
         dry_run_default = _env_bool("DRY_RUN_DEFAULT", True)
         rate_delay_default = _env_float("RATE_DELAY_DEFAULT", 1.5)
+        max_retries_default = _env_int("MAX_RETRIES_DEFAULT", 0)
 
         smtp_host = st.sidebar.text_input("SMTP Host", value=smtp_host_default)
         smtp_port = st.sidebar.number_input("SMTP Port", min_value=1, max_value=65535, value=int(smtp_port_default))
@@ -527,8 +702,94 @@ def main() -> None:
             value=default_subject_default,
         )
         dry_run = st.sidebar.checkbox("Dry-run (không gửi thật)", value=bool(dry_run_default))
+        dry_run_fast = st.sidebar.checkbox(
+            "Dry-run nhanh (bỏ delay, báo cáo dung lượng)",
+            value=False,
+            disabled=not dry_run,
+            help="Dựng toàn bộ email song song bằng nhiều tiến trình, không chờ delay; báo cáo kích thước email và thời gian gửi ước tính",
+        )
         rate_delay_default_clamped = max(0.0, min(10.0, float(rate_delay_default)))
         rate_delay = st.sidebar.slider("Delay giữa mỗi email (giây)", 0.0, 10.0, rate_delay_default_clamped, 0.5)
+        max_retries = st.sidebar.number_input("Số lần gửi lại khi lỗi tạm thời", min_value=0, max_value=10, value=max(0, min(10, max_retries_default)))
+        build_workers = st.sidebar.number_input(
+            "Luồng dựng email", min_value=1, max_value=16, value=max(1, min(16, _env_int("BUILD_WORKERS_DEFAULT", 2)))
+        )
+        use_process_build = st.sidebar.checkbox(
+            "Dựng email bằng nhiều tiến trình (PDF/ảnh lớn)",
+            value=_env_str("BUILD_MODE_DEFAULT", "thread").strip().lower() == "process",
+        )
+        connections = st.sidebar.number_input(
+            "Số kết nối SMTP song song", min_value=1, max_value=8, value=max(1, min(8, _env_int("SMTP_CONNECTIONS_DEFAULT", 1)))
+        )
+
+        optimize_images = st.sidebar.checkbox(
+            "Thu nhỏ & nén ảnh inline (600px)",
+            value=True,
+            help="Giảm dung lượng mỗi email: ảnh được xử lý 1 lần cho cả chiến dịch (cần Pillow)",
+        )
+        batch_size = st.sidebar.number_input(
+            "Gộp người nhận (BCC) khi nội dung không có token (0 = tắt)",
+            min_value=0,
+            max_value=500,
+            value=max(0, min(500, _env_int("BATCH_SIZE_DEFAULT", 0))),
+            help="Chỉ áp dụng khi nội dung và tiêu đề không chứa {{token}} và dòng không có CC",
+        )
+        with st.sidebar.expander("Giới hạn theo tên miền người nhận"):
+            domain_settings = {
+                "interleave_domains": st.checkbox(
+                    "Xen kẽ theo tên miền",
+                    value=_env_str("INTERLEAVE_DOMAINS_DEFAULT", "false").strip().lower() in {"1", "true", "yes", "y", "on"},
+                    help="Gửi luân phiên gmail.com, yahoo.com, ... thay vì hàng nghìn email liền nhau cho 1 tên miền",
+                ),
+                "domain_concurrency": int(st.number_input(
+                    "Số email đồng thời / tên miền (0 = không giới hạn)",
+                    min_value=0, max_value=8, value=max(0, min(8, _env_int("DOMAIN_CONCURRENCY_DEFAULT", 0))),
+                )),
+                "domain_rate_delay": float(st.number_input(
+                    "Delay giữa 2 email cùng tên miền (giây)",
+                    min_value=0.0, max_value=60.0, step=0.5, value=max(0.0, min(60.0, _env_float("DOMAIN_RATE_DELAY_DEFAULT", 0.0))),
+                )),
+            }
+
+        # Danh sách chặn (unsubscribe / hard bounce) + lịch sử gửi theo chiến dịch
+        suppression_db = _env_str("SUPPRESSION_DB", "") or str(STATE_DIR / "suppression.sqlite3")
+        # Ký DKIM (chỉ cấu hình qua biến môi trường, để trống = không ký)
+        dkim_settings = {
+            "dkim_domain": _env_str("DKIM_DOMAIN", "").strip(),
+            "dkim_selector": _env_str("DKIM_SELECTOR", "").strip(),
+            "dkim_key": _env_str("DKIM_PRIVATE_KEY", "").strip(),
+        }
+        campaign_id = st.sidebar.text_input(
+            "Mã chiến dịch (tùy chọn)",
+            value="",
+            help="Email đã gửi thành công trong cùng mã chiến dịch sẽ không bị gửi lại",
+        )
+        incremental = st.sidebar.checkbox(
+            "Chỉ gửi dòng mới/thay đổi",
+            value=False,
+            disabled=not campaign_id.strip(),
+            help="Cần mã chiến dịch. Bỏ qua các dòng đã gửi trước đó với cùng nội dung và file PDF; "
+            "dòng bị sửa (hoặc PDF đổi) sẽ được gửi lại",
+        )
+        incremental = bool(incremental and campaign_id.strip())
+        dedupe = st.sidebar.checkbox(
+            "Bỏ qua email trùng trong danh sách",
+            value=False,
+            help="Chỉ gửi dòng đầu tiên của mỗi địa chỉ email. Để tắt nếu cùng một người cần nhận nhiều email (ví dụ khác file PDF)",
+        )
+        with st.sidebar.expander("Danh sách chặn (unsubscribe)"):
+            unsub_text = st.text_area("Email cần chặn (mỗi dòng 1 email)", value="", key="unsub_text")
+            if st.button("Thêm vào danh sách chặn", key="unsub_add"):
+                store = SuppressionStore(suppression_db)
+                try:
+                    added = 0
+                    for line in unsub_text.splitlines():
+                        if line.strip():
+                            store.suppress(line, reason=REASON_UNSUBSCRIBE)
+                            added += 1
+                    st.success(f"Đã chặn {added} email (tổng: {store.count()})")
+                finally:
+                    store.close()
 
         # Main form
         st.subheader("Chọn tệp")
@@ -701,9 +962,7 @@ def main() -> None:
                         saved = 0
                         for up in img_uploads:
                             try:
-                                dest = (Path(__file__).parent / "uploads" / Path(up.name).name)
-                                with open(dest, "wb") as f:
-                                    f.write(up.getbuffer())
+                                _get_upload_store().put(Path(up.name).name, up)
                                 saved += 1
                             except Exception as exc:
                                 st.error(f"Không thể lưu {up.name}: {exc}")
@@ -713,7 +972,11 @@ def main() -> None:
                 st.markdown("**Xem trước (preview)**")
                 tokens = _load_preview_tokens(up_recipients)
                 sample_body = (html_content or "").strip() or "<p>(Nội dung trống)</p>"
-                composed = _compose_email_html(header_html or "", sample_body, footer_html or "")
+                # Same compiled HTML as the send path (CSS inlined, minified).
+                if header_html or footer_html:
+                    composed = compile_email_html(header_html or "", sample_body, footer_html or "")
+                else:
+                    composed = compile_template(sample_body)
                 composed = render_template(composed, tokens)  # type: ignore[name-defined]
                 composed_preview = _preview_html_with_embedded_images(composed, base / "uploads", cid_logo_filename=cid_logo_filename)
                 st.components.v1.html(composed_preview, height=520, scrolling=True)
@@ -742,10 +1005,98 @@ def main() -> None:
         st.code(str(default_recipients), language="text")
         st.code(str(default_template), language="text")
 
+        progress_bar = st.empty()
+        progress_stats = st.empty()
+        progress_view = ProgressView(progress_bar, progress_stats)
         log_area = st.empty()
         throttled_log = ThrottledLogger(log_area)
 
         start = st.button("Gửi Email", disabled=st.session_state["running"])
+
+        with st.expander("Hẹn giờ gửi (chạy nền, không cần mở trình duyệt)"):
+            sc_cols = st.columns(2)
+            sc_date = sc_cols[0].date_input("Ngày bắt đầu", key="sched_date")
+            sc_time = sc_cols[1].time_input("Giờ bắt đầu", key="sched_time")
+            sc_window = st.text_input("Khung giờ gửi hằng ngày (để trống = cả ngày)", value="", placeholder="22:00-06:00", key="sched_window")
+            sc_cap = st.number_input("Giới hạn email mỗi ngày (0 = không giới hạn)", min_value=0, value=0, key="sched_cap")
+            sc_name = st.text_input("Tên lịch gửi", value="", key="sched_name")
+            if st.button("Lên lịch", key="sched_add"):
+                try:
+                    if up_recipients is not None:
+                        up_recipients.seek(0)
+                        sc_recipients = _persist_for_schedule(up_recipients.read(), up_recipients.name)
+                    elif default_recipients.exists():
+                        sc_recipients = default_recipients
+                    else:
+                        raise ValueError("Chưa chọn recipients và không tìm thấy recipients.xlsx mặc định.")
+                    if mode == MODE_FILE:
+                        if up_template is not None:
+                            up_template.seek(0)
+                            sc_template = _persist_for_schedule(up_template.read(), up_template.name)
+                        else:
+                            sc_template = default_template
+                    else:
+                        body = (html_content or "").strip()
+                        if not body:
+                            raise ValueError("Nội dung email đang trống.")
+                        hdr = st.session_state.get("header_html", "") or ""
+                        ftr = st.session_state.get("footer_html", "") or ""
+                        full_html = compile_email_html(hdr, body, ftr) if (hdr or ftr) else body
+                        sc_template = _persist_for_schedule(full_html.encode("utf-8"), "template.html")
+                    # Attachments: store this form's uploads, then pin what the sheet uses.
+                    if zip_upload is not None and zip_upload.size and zip_upload.size > 100 * 1024 * 1024:
+                        raise ValueError(f"ZIP quá lớn ({_human_size(zip_upload.size)}). Vui lòng chia nhỏ (< 100MB).")
+                    store = _get_upload_store()
+                    sc_replaced: List[str] = []
+                    sc_digests = _store_attachment_uploads(store, pdf_uploads, zip_upload, sc_replaced, st.warning)
+                    sc_base_dir = Path(base_dir_text or str(upload_dir))
+                    if sc_base_dir.resolve() == store.view_dir.resolve():
+                        sc_base_dir, pinned = _snapshot_for_schedule(store, sc_recipients)
+                        sc_digests += pinned
+                    window = tuple(p.strip() for p in sc_window.split("-", 1)) if sc_window.strip() else None
+                    params = {
+                        "recipients": str(sc_recipients),
+                        "template": str(sc_template),
+                        "smtp_host": smtp_host,
+                        "smtp_port": int(smtp_port),
+                        "smtp_user": smtp_user,
+                        "from_name": from_name,
+                        "default_subject": default_subject,
+                        "rate_delay": float(rate_delay),
+                        "dry_run": bool(dry_run),
+                        "use_ssl": bool(use_ssl),
+                        "base_dir": str(sc_base_dir),
+                        "cid_logo_filename": str(st.session_state.get("cid_logo_filename") or "logomedi.png"),
+                        "max_retries": int(max_retries),
+                        "suppression_db": suppression_db,
+                        "build_workers": int(build_workers),
+                        "connections": int(connections),
+                        "batch_size": int(batch_size),
+                        "optimize_images": bool(optimize_images),
+                        "incremental": incremental,
+                        "dedupe": bool(dedupe),
+                        **domain_settings,
+                        **dkim_settings,
+                    }
+                    if campaign_id.strip():
+                        params["campaign_id"] = campaign_id.strip()
+                    job_id = scheduler.add_job(
+                        params,
+                        start_at=datetime.combine(sc_date, sc_time),
+                        window=window,
+                        daily_cap=int(sc_cap),
+                        name=sc_name.strip(),
+                        smtp_pass=smtp_pass if smtp_pass != smtp_pass_default else "",
+                    )
+                    if sc_digests:
+                        store.reference(params.get("campaign_id") or f"schedule-{job_id}", sc_digests)
+                    st.success(f"Đã lên lịch #{job_id}. Xem tiến độ ở tab 'Lịch gửi'.")
+                    if sc_replaced:
+                        st.warning(f"Tệp trùng tên đã được thay nội dung: {', '.join(sc_replaced)}")
+                    if smtp_pass and smtp_pass != smtp_pass_default:
+                        st.caption("Mật khẩu SMTP chỉ giữ trong bộ nhớ: nếu ứng dụng khởi động lại, lịch gửi sẽ dùng SMTP_PASS trong .env.")
+                except Exception as exc:
+                    st.error(f"Không lên lịch được: {exc}")
         if start:
             # ====== Lock: ngăn chạy trùng tiến trình ======
             st.session_state["running"] = True
@@ -775,30 +1126,16 @@ def main() -> None:
                     else:
                         lock_acquired = False
 
-                    # Persist uploaded PDFs/ZIP to server under uploads/
-                    saved_files: List[Path] = []
-                    if pdf_uploads:
-                        for up in pdf_uploads:
-                            dest = upload_dir / Path(up.name).name
-                            with open(dest, "wb") as f:
-                                f.write(up.getbuffer())
-                            saved_files.append(dest)
-
-                    if zip_upload is not None:
-                        # Giới hạn kích thước zip để tránh out-of-memory
-                        if zip_upload.size and zip_upload.size > 100 * 1024 * 1024:
-                            st.error(f"ZIP quá lớn ({_human_size(zip_upload.size)}). Vui lòng chia nhỏ (< 100MB).")
-                            st.session_state["running"] = False
-                            return
-                        tmp_zip = save_upload(zip_upload, suffix=".zip")
-                        try:
-                            with zipfile.ZipFile(tmp_zip, "r") as zf:
-                                zf.extractall(upload_dir)
-                        finally:
-                            try:
-                                tmp_zip.unlink(missing_ok=True)  # type: ignore[arg-type]
-                            except Exception:
-                                pass
+                    # Persist uploaded PDFs/ZIP under uploads/ via the content-addressed store
+                    store = _get_upload_store()
+                    saved_files: List[Path] = [upload_dir / Path(up.name).name for up in pdf_uploads or []]
+                    replaced_names: List[str] = []
+                    # Giới hạn kích thước zip để tránh out-of-memory
+                    if zip_upload is not None and zip_upload.size and zip_upload.size > 100 * 1024 * 1024:
+                        st.error(f"ZIP quá lớn ({_human_size(zip_upload.size)}). Vui lòng chia nhỏ (< 100MB).")
+                        st.session_state["running"] = False
+                        return
+                    used_digests = _store_attachment_uploads(store, pdf_uploads, zip_upload, replaced_names, throttled_log)
 
                     if up_recipients is not None:
                         recipients_path = save_upload(up_recipients, suffix=Path(up_recipients.name).suffix)
@@ -828,7 +1165,7 @@ def main() -> None:
                         # Gộp header + nội dung + footer thành 1 HTML doc (tránh nested <html>/<body>)
                         hdr = st.session_state.get("header_html", "") or ""
                         ftr = st.session_state.get("footer_html", "") or ""
-                        full_html = _compose_email_html(hdr, content_to_use, ftr) if (hdr or ftr) else content_to_use
+                        full_html = compile_email_html(hdr, content_to_use, ftr) if (hdr or ftr) else content_to_use
                         # Lưu trong uploads/ để các đường dẫn tương đối trong HTML có thể tham chiếu tới tệp trong dự án
                         try:
                             editor_tpl = upload_dir / "_editor_template.html"
@@ -844,6 +1181,10 @@ def main() -> None:
                         throttled_log(f"Đã lưu {len(saved_files)} PDF vào: {upload_dir}")
                     elif zip_upload is not None:
                         throttled_log(f"Đã giải nén ZIP vào: {upload_dir}")
+                    if replaced_names:
+                        throttled_log(f"[WARN] Tệp trùng tên đã được thay nội dung: {', '.join(replaced_names)}")
+                    if used_digests:
+                        store.reference(campaign_id.strip() or f"run-{datetime.now():%Y%m%d-%H%M%S}", used_digests)
 
                     # ==== Chạy merge với callback đã throttle ====
                     summary = run_merge(
@@ -861,14 +1202,58 @@ def main() -> None:
                         base_dir=(base_dir_text or str(upload_dir)),
                         cid_logo_filename=str(st.session_state.get("cid_logo_filename") or "logomedi.png"),
                         progress_callback=throttled_log,
+                        event_callback=progress_view,
+                        max_retries=int(max_retries),
+                        metrics_textfile=(_env_str("METRICS_TEXTFILE", "") or None),
+                        suppression_db=suppression_db,
+                        campaign_id=campaign_id.strip(),
+                        build_workers=int(build_workers),
+                        build_mode="process" if use_process_build else None,
+                        connections=int(connections),
+                        batch_size=int(batch_size),
+                        dry_run_fast=bool(dry_run and dry_run_fast),
+                        optimize_images=bool(optimize_images),
+                        incremental=incremental,
+                        dedupe=bool(dedupe),
+                        **domain_settings,
+                        **dkim_settings,
                     )
 
-                    throttled_log.flush()
-                    st.success(f"Hoàn tất. Sent={summary['sent']}, Failed={summary['failed']}")
+                    throttled_log.close()
+                    st.success(f"Hoàn tất. Sent={summary['sent']}, Failed={summary['failed']}, Skipped={summary.get('skipped', 0)}")
+                    try:
+                        with open(throttled_log.spill_path, "rb") as log_fh:
+                            st.download_button(
+                                f"Tải log đầy đủ ({throttled_log.line_count} dòng)",
+                                data=log_fh,
+                                file_name="mailmerge_log.txt",
+                                mime="text/plain",
+                                key="dl_full_log",
+                            )
+                    except Exception:
+                        pass
                     if summary.get("errors"):
-                        with st.expander("Xem lỗi"):
-                            for em, err in summary["errors"]:
+                        with st.expander(f"Xem lỗi ({len(summary['errors'])})"):
+                            for em, err in itertools.islice(summary["errors"], MAX_ERRORS_SHOWN):
                                 st.write(f"- {em}: {err}")
+                            if len(summary["errors"]) > MAX_ERRORS_SHOWN:
+                                st.caption(f"Chỉ hiển thị {MAX_ERRORS_SHOWN} lỗi đầu tiên, xem đầy đủ trong log.")
+                    cap = summary.get("capacity")
+                    if cap and cap.get("messages"):
+                        st.info(
+                            f"Dry-run: {cap['messages']} email ({cap['recipients']} người nhận), "
+                            f"tổng {_human_size(cap['total_bytes'])}, trung bình {_human_size(cap['mean_bytes'])}/email, "
+                            f"lớn nhất {_human_size(cap['max_bytes'])}. Dựng trong {cap['build_seconds']:.1f}s; "
+                            f"ước tính gửi thật ~{cap['estimated_send_seconds'] / 60:.1f} phút với delay {rate_delay}s."
+                        )
+                    if summary.get("timings"):
+                        with st.expander("Thời gian từng bước (ms)"):
+                            st.table(
+                                {
+                                    stage: {k: v for k, v in h.items() if k != "buckets"}
+                                    for stage, h in summary["timings"].items()
+                                }
+                            )
                 finally:
                     try:
                         if fcntl is not None and lock_acquired:
@@ -884,8 +1269,12 @@ def main() -> None:
                 with st.expander("Chi tiết lỗi (debug)", expanded=False):
                     st.code(traceback.format_exc())
             finally:
+                throttled_log.close()
                 st.session_state["running"] = False
 
+    with tab_schedule:
+        render_schedule_tab(scheduler)
+
     with tab_files:
         render_file_manager(base)
 
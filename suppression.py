@@ -0,0 +1,140 @@
+"""Persistent suppression list and per-campaign sent history (SQLite).
+
+run_merge loads the relevant addresses once into an in-memory set, so the
+per-row check is a single O(1) hash lookup regardless of list size.
+"""
+
+import argparse
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+
+REASON_UNSUBSCRIBE = "unsubscribe"
+REASON_HARD_BOUNCE = "hard_bounce"
+REASON_MANUAL = "manual"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS suppression (
+    address TEXT PRIMARY KEY,
+    reason TEXT NOT NULL,
+    detail TEXT NOT NULL DEFAULT '',
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sent_history (
+    campaign TEXT NOT NULL,
+    address TEXT NOT NULL,
+    sent_at TEXT NOT NULL,
+    PRIMARY KEY (campaign, address)
+);
+CREATE INDEX IF NOT EXISTS idx_sent_history_address ON sent_history(address);
+"""
+
+
+def normalize_address(email: str) -> str:
+    return (email or "").strip().lower()
+
+
+def _now() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class SuppressionStore:
+    """SQLite-backed suppression list plus sent history keyed by campaign."""
+
+    def __init__(self, path, commit_every: int = 200):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self.commit_every = commit_every
+
+    def load_blocked(self, campaign: str | None = None) -> set:
+        """Return suppressed addresses plus those already sent in campaign."""
+        with self._lock:
+            blocked = {r[0] for r in self._conn.execute("SELECT address FROM suppression")}
+            if campaign:
+                blocked.update(
+                    r[0] for r in self._conn.execute("SELECT address FROM sent_history WHERE campaign = ?", (campaign,))
+                )
+        return blocked
+
+    def is_suppressed(self, email: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM suppression WHERE address = ?", (normalize_address(email),)).fetchone()
+        return row is not None
+
+    def suppress(self, email: str, reason: str = REASON_MANUAL, detail: str = "") -> None:
+        addr = normalize_address(email)
+        if not addr:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO suppression(address, reason, detail, created_at) VALUES (?, ?, ?, ?)",
+                (addr, reason, detail, _now()),
+            )
+            self._conn.commit()
+
+    def unsuppress(self, email: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM suppression WHERE address = ?", (normalize_address(email),))
+            self._conn.commit()
+
+    def record_sent(self, campaign: str, email: str) -> None:
+        """Remember a delivered address; commits are batched for throughput."""
+        if not campaign:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sent_history(campaign, address, sent_at) VALUES (?, ?, ?)",
+                (campaign, normalize_address(email), _now()),
+            )
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self._conn.commit()
+                self._pending = 0
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM suppression").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quản lý danh sách chặn gửi (unsubscribe/bounce).")
+    parser.add_argument("--db", required=True, help="Đường dẫn file SQLite")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_add = sub.add_parser("add", help="Thêm email vào danh sách chặn")
+    p_add.add_argument("emails", nargs="*", help="Danh sách email")
+    p_add.add_argument("--file", default="", help="File text, mỗi dòng 1 email")
+    p_add.add_argument("--reason", default=REASON_MANUAL, help="Lý do (unsubscribe, hard_bounce, manual)")
+    p_rm = sub.add_parser("remove", help="Bỏ chặn email")
+    p_rm.add_argument("emails", nargs="+")
+    sub.add_parser("count", help="Đếm số email đang bị chặn")
+    args = parser.parse_args()
+
+    store = SuppressionStore(args.db)
+    try:
+        if args.cmd == "add":
+            emails = list(args.emails)
+            if args.file:
+                emails += Path(args.file).read_text(encoding="utf-8").splitlines()
+            for e in emails:
+                store.suppress(e, reason=args.reason)
+            print(f"Đã chặn {len([e for e in emails if e.strip()])} email")
+        elif args.cmd == "remove":
+            for e in args.emails:
+                store.unsuppress(e)
+        print(f"Tổng số email bị chặn: {store.count()}")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
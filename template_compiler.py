@@ -0,0 +1,327 @@
+"""Compile email templates once: compose, inline CSS, minify.
+
+Many email clients (Gmail, Outlook) drop or ignore <style> blocks, and the
+raw template is re-scanned for every recipient. compile_template() turns a
+template into its sending form once per campaign:
+
+* CSS rules with simple selectors (tag, .class, #id and combinations like
+  td.note) are copied into the matching elements' style attributes;
+  declarations already inline win unless the rule's is !important. Rules
+  that cannot be inlined (media queries, pseudo-classes, descendant
+  selectors) stay in one <style> block.
+* comments and insignificant whitespace are removed (<pre>/<textarea> and
+  conditional comments are left alone).
+
+compile_email_html() also composes header, body and footer into the
+600 px wrapper. Results are memoised by the SHA-256 of the inputs, so the
+Streamlit preview and the send path produce the same bytes at no extra
+cost.
+"""
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+# Bump when the output changes so memoised results are not reused.
+COMPILER_VERSION = 2
+_CACHE_SIZE = 64
+
+_cache: OrderedDict = OrderedDict()
+_cache_lock = threading.Lock()
+
+_STYLE_BLOCK_RE = re.compile(r"<style\b[^>]*>([\s\S]*?)</style>", re.IGNORECASE)
+_CSS_COMMENT_RE = re.compile(r"/\*[\s\S]*?\*/")
+_SIMPLE_SELECTOR_RE = re.compile(r"^([a-zA-Z][a-zA-Z0-9]*)?((?:[.#][\w-]+)*)$")
+_START_TAG_RE = re.compile(r"<([a-zA-Z][a-zA-Z0-9]*)((?:\s+[^<>]*?)?)(\s*/?)>")
+_ATTR_RE = r"""\b{name}\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))"""
+_HTML_COMMENT_RE = re.compile(r"<!--(?!\[if)(?!<!\[endif)[\s\S]*?-->")
+_PRESERVE_RE = re.compile(r"(<(pre|textarea)\b[\s\S]*?</\2>)", re.IGNORECASE)
+# Only elements whose surrounding whitespace never renders; inline ones
+# (img, br, a, span, ...) keep theirs.
+_BLOCK_TAGS = (
+    "html|head|body|meta|title|link|style|table|thead|tbody|tfoot|tr|td|th|div|p|hr|"
+    "h[1-6]|ul|ol|li|center|section|header|footer"
+)
+_SPACE_AFTER_BLOCK_RE = re.compile(rf"(<(?:/?(?:{_BLOCK_TAGS}))\b[^>]*>)\s+", re.IGNORECASE)
+_SPACE_BEFORE_BLOCK_RE = re.compile(rf"\s+(</?(?:{_BLOCK_TAGS})\b)", re.IGNORECASE)
+
+
+def _digest(*parts: str) -> str:
+    h = hashlib.sha256(f"v{COMPILER_VERSION}".encode())
+    for part in parts:
+        h.update(hashlib.sha256((part or "").encode("utf-8")).digest())
+    return h.hexdigest()
+
+
+def _memoised(key: str, build):
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    result = build()
+    with _cache_lock:
+        _cache[key] = result
+        while len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
+
+
+# ---- composition ----
+
+def extract_body_html(html: str) -> str:
+    """Return inner HTML of <body> if present, else return original string.
+
+    Users may paste full HTML documents into header/footer editors; for email composition
+    we only want the body portion to avoid nested <html>/<body>.
+    """
+    if not html:
+        return ""
+    m = re.search(r"<body\b[^>]*>(?P<body>[\s\S]*?)</body>", html, flags=re.IGNORECASE)
+    if m:
+        return (m.group("body") or "").strip()
+    return html.strip()
+
+
+def extract_style_blocks(html: str) -> str:
+    if not html:
+        return ""
+    blocks = re.findall(r"<style\b[^>]*>[\s\S]*?</style>", html, flags=re.IGNORECASE)
+    return "\n".join(blocks).strip()
+
+
+def compose_email_html(header_html: str, body_html: str, footer_html: str) -> str:
+    """Compose a single HTML document for sending / preview."""
+    header_body = extract_body_html(header_html)
+    body_body = extract_body_html(body_html)
+    footer_body = extract_body_html(footer_html)
+
+    style_blocks = "\n".join(
+        b
+        for b in [
+            extract_style_blocks(header_html),
+            extract_style_blocks(body_html),
+            extract_style_blocks(footer_html),
+        ]
+        if b
+    ).strip()
+
+    # Email-friendly wrapper: centered 600px content
+    parts = [
+        "<!doctype html>",
+        "<html>",
+        "<head>",
+        '  <meta charset="utf-8"/>',
+        '  <meta name="viewport" content="width=device-width, initial-scale=1"/>',
+    ]
+    if style_blocks:
+        parts.append(style_blocks)
+    parts += [
+        "</head>",
+        '<body style="margin:0;padding:0;">',
+        '  <table width="100%" border="0" cellspacing="0" cellpadding="0" align="center" style="background:#ffffff;">',
+        "    <tr>",
+        '      <td align="center" style="padding:0;">',
+        '        <table width="600" border="0" cellspacing="0" cellpadding="0" style="max-width:600px;width:100%;">',
+        "          <tr><td>",
+        header_body,
+        body_body,
+        footer_body,
+        "          </td></tr>",
+        "        </table>",
+        "      </td>",
+        "    </tr>",
+        "  </table>",
+        "</body>",
+        "</html>",
+    ]
+    return "\n".join([p for p in parts if p is not None])
+
+
+# ---- CSS inlining ----
+
+def _split_css(css: str) -> tuple[list, list]:
+    """Split a stylesheet into (rules, kept): rules are (selectors, body) pairs,
+    kept are at-rule blocks (@media, @font-face, ...) copied verbatim."""
+    css = _CSS_COMMENT_RE.sub("", css)
+    rules, kept = [], []
+    i, n = 0, len(css)
+    while i < n:
+        open_i = css.find("{", i)
+        if open_i < 0:
+            break
+        prelude = css[i:open_i].strip()
+        depth, j = 1, open_i + 1
+        while j < n and depth:
+            if css[j] == "{":
+                depth += 1
+            elif css[j] == "}":
+                depth -= 1
+            j += 1
+        body = css[open_i + 1 : j - 1]
+        if prelude.startswith("@"):
+            kept.append(f"{prelude}{{{body.strip()}}}")
+        elif prelude:
+            rules.append((prelude, body))
+        i = j
+    return rules, kept
+
+
+def _split_declarations(body: str) -> list:
+    """Split on ";" outside parentheses and quotes (url(data:...;base64,...))."""
+    parts, depth, quote, start = [], 0, "", 0
+    for i, ch in enumerate(body):
+        if quote:
+            if ch == quote:
+                quote = ""
+        elif ch in "\"'":
+            quote = ch
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth = max(0, depth - 1)
+        elif ch == ";" and not depth:
+            parts.append(body[start:i])
+            start = i + 1
+    parts.append(body[start:])
+    return parts
+
+
+def _parse_declarations(body: str) -> list:
+    """(property, value, important) triples; the !important flag is split off."""
+    decls = []
+    for part in _split_declarations(body):
+        if ":" in part:
+            prop, value = part.split(":", 1)
+            prop, value = prop.strip().lower(), value.strip().replace('"', "'")
+            m = re.search(r"\s*!\s*important\s*$", value, flags=re.IGNORECASE)
+            if m:
+                value = value[: m.start()]
+            if prop and value:
+                decls.append((prop, value, bool(m)))
+    return decls
+
+
+def _cascade(merged: dict, decls: list) -> None:
+    """Apply later declarations over merged; !important ones are only
+    overridden by !important ones."""
+    for prop, value, important in decls:
+        current = merged.get(prop)
+        if current is not None and current[1] and not important:
+            continue
+        merged.pop(prop, None)
+        merged[prop] = (value, important)
+
+
+def _attr(attrs: str, name: str) -> str | None:
+    m = re.search(_ATTR_RE.format(name=name), attrs, flags=re.IGNORECASE)
+    if not m:
+        return None
+    return next(g for g in m.groups() if g is not None)
+
+
+def inline_css(html: str) -> str:
+    """Move simple-selector CSS rules from <style> blocks into style attributes."""
+    if not html or "<style" not in html.lower():
+        return html
+    inlinable = []  # (specificity, order, tag, classes, id, declarations)
+    leftover = []
+    order = 0
+    for css in _STYLE_BLOCK_RE.findall(html):
+        rules, kept = _split_css(css)
+        leftover += kept
+        for prelude, body in rules:
+            decls = _parse_declarations(body)
+            rest = []
+            for selector in (s.strip() for s in prelude.split(",")):
+                m = _SIMPLE_SELECTOR_RE.match(selector)
+                if not selector or not m or not decls:
+                    rest.append(selector)
+                    continue
+                tag = (m.group(1) or "").lower()
+                parts = re.findall(r"[.#][\w-]+", m.group(2) or "")
+                classes = {p[1:] for p in parts if p[0] == "."}
+                ids = [p[1:] for p in parts if p[0] == "#"]
+                if len(ids) > 1:
+                    rest.append(selector)
+                    continue
+                spec = (len(ids), len(classes), 1 if tag else 0)
+                inlinable.append((spec, order, tag, classes, ids[0] if ids else None, decls))
+                order += 1
+            if rest:
+                leftover.append(f"{', '.join(rest)}{{{body.strip()}}}")
+    inlinable.sort(key=lambda r: (r[0], r[1]))
+
+    def apply(m: re.Match) -> str:
+        tag, attrs, close = m.group(1), m.group(2) or "", m.group(3)
+        tag_l = tag.lower()
+        if tag_l in ("html", "head", "meta", "title", "style", "script", "link"):
+            return m.group(0)
+        classes = set((_attr(attrs, "class") or "").split())
+        elem_id = _attr(attrs, "id")
+        merged: dict = {}
+        for _spec, _order, r_tag, r_classes, r_id, decls in inlinable:
+            if (r_tag and r_tag != tag_l) or (r_id and r_id != elem_id) or not r_classes <= classes:
+                continue
+            _cascade(merged, decls)
+        if not merged:
+            return m.group(0)
+        existing = _attr(attrs, "style")
+        # Inline declarations beat the stylesheet, except its !important ones.
+        _cascade(merged, _parse_declarations(existing or ""))
+        style = "; ".join(f"{p}: {v}{' !important' if imp else ''}" for p, (v, imp) in merged.items())
+        if existing is not None:
+            attrs = re.sub(_ATTR_RE.format(name="style"), lambda _m: f'style="{style}"', attrs, count=1, flags=re.IGNORECASE)
+        else:
+            attrs = f'{attrs} style="{style}"'
+        return f"<{tag}{attrs}{close}>"
+
+    # Only elements after </head> carry content; leave the head untouched.
+    head_end = html.lower().find("</head>")
+    split = head_end + len("</head>") if head_end >= 0 else 0
+    head, body = html[:split], html[split:]
+    body = _STYLE_BLOCK_RE.sub("", body)
+    head = _STYLE_BLOCK_RE.sub("", head)
+    body = _START_TAG_RE.sub(apply, body)
+    leftover = list(dict.fromkeys(leftover))  # the same block may be pasted twice
+    if leftover:
+        block = "<style>" + "\n".join(leftover) + "</style>"
+        if head_end >= 0:
+            head = head[: -len("</head>")] + block + "</head>"
+        else:
+            body = block + body
+    return head + body
+
+
+# ---- minification ----
+
+def minify_html(html: str) -> str:
+    """Drop comments and whitespace that does not affect rendering."""
+    if not html:
+        return html
+    preserved: list = []
+
+    def keep(m: re.Match) -> str:
+        preserved.append(m.group(1))
+        return f"\x00{len(preserved) - 1}\x00"
+
+    out = _PRESERVE_RE.sub(keep, html)
+    out = _HTML_COMMENT_RE.sub("", out)
+    out = re.sub(r"\s+", " ", out)
+    out = _SPACE_AFTER_BLOCK_RE.sub(r"\1", out)
+    out = _SPACE_BEFORE_BLOCK_RE.sub(r"\1", out)
+    out = re.sub(r"\x00(\d+)\x00", lambda m: preserved[int(m.group(1))], out)
+    return out.strip()
+
+
+# ---- entry points ----
+
+def compile_template(html: str) -> str:
+    """Inline CSS and minify a complete template (memoised by content hash)."""
+    return _memoised(_digest("template", html), lambda: minify_html(inline_css(html)))
+
+
+def compile_email_html(header_html: str, body_html: str, footer_html: str) -> str:
+    """Compose header/body/footer and compile the result (memoised by input hashes)."""
+    key = _digest("compose", header_html, body_html, footer_html)
+    return _memoised(key, lambda: compile_template(compose_email_html(header_html, body_html, footer_html)))
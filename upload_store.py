@@ -0,0 +1,385 @@
+"""Content-addressed store for uploaded attachments.
+
+Uploaded files (the Streamlit PDF/ZIP boxes and the file manager) are kept
+once per content: blobs are named by their SHA-256 under
+STATE_DIR/uploads/blobs, and an SQLite index maps upload names to blobs.
+
+* Writes are streamed in chunks and hashed on the way; a blob that already
+  exists is not written again. Seekable uploads (Streamlit keeps them in
+  memory) are hashed first, so a re-upload of known bytes writes nothing.
+* The upload folder (uploads/) stays a plain folder of names, so FilePDF
+  values and base_dir keep working: each name is a hard link to its blob
+  (a copy on Windows or where links are not possible), replaced atomically.
+  Blobs are read-only, and so are the names linked to them: a tool that
+  writes into uploads/<name> in place fails instead of changing every name
+  sharing the content. Replace the file (delete, then copy) or upload again.
+* Uploading different content under an existing name re-points the name;
+  put() reports it instead of silently overwriting, and the old version
+  stays in the store as long as a campaign references it.
+* Blobs are reference counted: one reference per name and one per
+  campaign that used the blob (reference()). gc() drops campaign
+  references older than the retention period and names whose file was
+  deleted from the upload folder, then deletes blobs nobody references.
+* Scheduled jobs run from snapshot(): a folder of links to the blobs they
+  were scheduled with, referenced under the job's campaign.
+
+    python upload_store.py gc [--retention-days 30]
+    python upload_store.py stats
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path, PurePosixPath
+
+from send_mail_merge import STATE_DIR
+
+UPLOAD_STORE_DIR = STATE_DIR / "uploads"
+UPLOAD_VIEW_DIR = Path(__file__).parent / "uploads"
+CHUNK_SIZE = 1 << 20
+# Campaign references older than this are dropped by gc().
+REF_RETENTION_DAYS = 30
+# Leftover temp files of interrupted uploads are removed after this long.
+_TMP_MAX_AGE = 3600
+# Blobs are immutable; every hard-linked name shares this mode.
+_BLOB_MODE = 0o444
+
+STATUS_NEW = "new"            # name did not exist
+STATUS_UNCHANGED = "unchanged"  # name already held these bytes
+STATUS_REPLACED = "replaced"  # name held different bytes
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS names (
+    name TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS campaign_refs (
+    campaign TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    used_at TEXT NOT NULL,
+    PRIMARY KEY (campaign, digest)
+);
+CREATE INDEX IF NOT EXISTS idx_blobs_refs ON blobs(refs);
+"""
+
+
+def _now() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def clean_name(name: str) -> str:
+    """Relative POSIX upload name; raises ValueError for unsafe names."""
+    parts = [p for p in PurePosixPath(str(name).replace("\\", "/")).parts if p not in ("", ".")]
+    if not parts or parts[0] == "/" or ".." in parts:
+        raise ValueError(f"Tên tệp không hợp lệ: {name}")
+    return "/".join(parts)
+
+
+def _unlink_blob(path: Path) -> None:
+    try:
+        path.unlink(missing_ok=True)
+    except PermissionError:  # Windows refuses to delete read-only files
+        os.chmod(path, 0o644)
+        path.unlink(missing_ok=True)
+
+
+class UploadStore:
+    """Hash-named blobs plus a name index, materialised into view_dir."""
+
+    def __init__(self, root=UPLOAD_STORE_DIR, view_dir=UPLOAD_VIEW_DIR, chunk_size: int = CHUNK_SIZE):
+        self.root = Path(root)
+        self.blob_dir = self.root / "blobs"
+        self.tmp_dir = self.root / "tmp"
+        self.view_dir = Path(view_dir)
+        self.chunk_size = chunk_size
+        for folder in (self.blob_dir, self.tmp_dir, self.view_dir):
+            folder.mkdir(parents=True, exist_ok=True)
+        # Autocommit mode: write transactions are opened explicitly with
+        # BEGIN IMMEDIATE so put() and gc() exclude each other across processes.
+        self._conn = sqlite3.connect(str(self.root / "index.sqlite3"), check_same_thread=False,
+                                     isolation_level=None, timeout=30)
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def blob_path(self, digest: str) -> Path:
+        return self.blob_dir / digest[:2] / digest
+
+    # ---- writing ----
+    def _hash_stream(self, fileobj) -> tuple:
+        h = hashlib.sha256()
+        size = 0
+        for chunk in iter(lambda: fileobj.read(self.chunk_size), b""):
+            h.update(chunk)
+            size += len(chunk)
+        return h.hexdigest(), size
+
+    def _write_tmp(self, fileobj) -> tuple:
+        """Stream fileobj into a temp file, hashing as it goes."""
+        h = hashlib.sha256()
+        size = 0
+        tmp = self.tmp_dir / f"{os.getpid()}.{threading.get_ident()}.{time.monotonic_ns()}"
+        with open(tmp, "wb") as out:
+            for chunk in iter(lambda: fileobj.read(self.chunk_size), b""):
+                h.update(chunk)
+                size += len(chunk)
+                out.write(chunk)
+        return tmp, h.hexdigest(), size
+
+    def put(self, name: str, fileobj) -> tuple:
+        """Store the content of fileobj under name; returns (digest, status)."""
+        name = clean_name(name)
+        tmp = None
+        seekable = hasattr(fileobj, "seek") and getattr(fileobj, "seekable", lambda: True)()
+        if seekable:
+            fileobj.seek(0)
+            digest, size = self._hash_stream(fileobj)
+        else:
+            tmp, digest, size = self._write_tmp(fileobj)
+        try:
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    blob = self.blob_path(digest)
+                    if not blob.exists():
+                        if tmp is None:
+                            fileobj.seek(0)
+                            tmp, _, _ = self._write_tmp(fileobj)
+                        blob.parent.mkdir(exist_ok=True)
+                        os.chmod(tmp, _BLOB_MODE)
+                        os.replace(tmp, blob)
+                        tmp = None
+                    self._conn.execute(
+                        "INSERT OR IGNORE INTO blobs(digest, size, refs, created_at) VALUES (?, ?, 0, ?)",
+                        (digest, size, _now()),
+                    )
+                    row = self._conn.execute("SELECT digest FROM names WHERE name = ?", (name,)).fetchone()
+                    old = row[0] if row else None
+                    if old == digest:
+                        status = STATUS_UNCHANGED
+                    else:
+                        # A file saved before the store existed counts as replaced too.
+                        replaced = old or (self.view_dir / name).exists()
+                        status = STATUS_REPLACED if replaced else STATUS_NEW
+                        self._conn.execute(
+                            "INSERT OR REPLACE INTO names(name, digest, updated_at) VALUES (?, ?, ?)",
+                            (name, digest, _now()),
+                        )
+                        self._conn.execute("UPDATE blobs SET refs = refs + 1 WHERE digest = ?", (digest,))
+                        if old:
+                            self._conn.execute("UPDATE blobs SET refs = refs - 1 WHERE digest = ?", (old,))
+                    self._materialise(name, blob, unchanged=status == STATUS_UNCHANGED)
+                    self._conn.execute("COMMIT")
+                except BaseException:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        finally:
+            if tmp is not None:
+                tmp.unlink(missing_ok=True)
+        return digest, status
+
+    def _materialise(self, name: str, blob: Path, unchanged: bool = False) -> None:
+        view = self.view_dir / name
+        try:
+            if os.path.samefile(view, blob):
+                return
+            # A copied (not linked) view of the same content is still current.
+            if unchanged and view.stat().st_size == blob.stat().st_size:
+                return
+        except OSError:
+            pass
+        self._link(blob, view)
+
+    @staticmethod
+    def _link(blob: Path, dest: Path) -> None:
+        """Atomically point dest at blob (read-only hard link, copy as fallback)."""
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_name(f".{dest.name}.{os.getpid()}.tmp")
+        tmp.unlink(missing_ok=True)
+        try:
+            # Windows: a read-only file cannot be replaced or deleted, and
+            # clearing the flag on a link would clear it on the blob too.
+            if os.name == "nt":
+                raise OSError("no read-only links on Windows")
+            if blob.stat().st_mode & 0o222:
+                os.chmod(blob, _BLOB_MODE)  # blob stored before blobs were read-only
+            os.link(blob, tmp)
+        except OSError:
+            shutil.copyfile(blob, tmp)  # other filesystem, or no hard links
+        os.replace(tmp, dest)
+
+    # ---- names ----
+    def digest_of(self, name: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute("SELECT digest FROM names WHERE name = ?", (clean_name(name),)).fetchone()
+        return row[0] if row else None
+
+    def remove(self, name: str) -> bool:
+        """Drop name from the index and the upload folder; False if unknown."""
+        name = clean_name(name)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT digest FROM names WHERE name = ?", (name,)).fetchone()
+                if row:
+                    self._conn.execute("DELETE FROM names WHERE name = ?", (name,))
+                    self._conn.execute("UPDATE blobs SET refs = refs - 1 WHERE digest = ?", (row[0],))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        (self.view_dir / name).unlink(missing_ok=True)
+        return row is not None
+
+    def snapshot(self, names, dest_dir) -> list:
+        """Freeze the current content of names into dest_dir; returns the digests.
+
+        For deferred runs: dest_dir is used as their base_dir, so a later
+        re-upload under the same name or a gc() does not change what they
+        send. Upload-folder files the index does not know yet (or that were
+        replaced by hand) are stored first; missing or unsafe names are skipped.
+        """
+        dest_dir = Path(dest_dir)
+        digests = []
+        for raw in names:
+            try:
+                name = clean_name(raw)
+            except ValueError:
+                continue
+            view = self.view_dir / name
+            if not view.is_file():
+                continue
+            digest = self.digest_of(name)
+            try:
+                current = digest is not None and os.path.samefile(view, self.blob_path(digest))
+            except OSError:
+                current = False
+            if not current:
+                with open(view, "rb") as fh:
+                    digest, _ = self.put(name, fh)
+            self._link(self.blob_path(digest), dest_dir / name)
+            digests.append(digest)
+        return digests
+
+    # ---- campaign references ----
+    def reference(self, campaign: str, digests) -> None:
+        """Record that campaign used the given blobs (keeps them through gc)."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for digest in set(digests):
+                    cur = self._conn.execute(
+                        "UPDATE campaign_refs SET used_at = ? WHERE campaign = ? AND digest = ?",
+                        (_now(), campaign, digest),
+                    )
+                    if cur.rowcount == 0:
+                        self._conn.execute(
+                            "INSERT INTO campaign_refs(campaign, digest, used_at) VALUES (?, ?, ?)",
+                            (campaign, digest, _now()),
+                        )
+                        self._conn.execute("UPDATE blobs SET refs = refs + 1 WHERE digest = ?", (digest,))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def release(self, campaign: str) -> int:
+        """Drop every reference of campaign; returns how many were dropped."""
+        return self._drop_refs("campaign = ?", (campaign,))
+
+    def _drop_refs(self, where: str, args: tuple) -> int:
+        # Caller must not hold the lock.
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(f"SELECT campaign, digest FROM campaign_refs WHERE {where}", args).fetchall()
+                for campaign, digest in rows:
+                    self._conn.execute("DELETE FROM campaign_refs WHERE campaign = ? AND digest = ?", (campaign, digest))
+                    self._conn.execute("UPDATE blobs SET refs = refs - 1 WHERE digest = ?", (digest,))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(rows)
+
+    # ---- garbage collection ----
+    def gc(self, retention_days: float | None = REF_RETENTION_DAYS) -> dict:
+        """Delete unreferenced blobs; returns {"blobs": n, "bytes": freed, "refs": expired}."""
+        expired = 0
+        if retention_days is not None:
+            cutoff = (datetime.now() - timedelta(days=retention_days)).strftime("%Y-%m-%d %H:%M:%S")
+            expired = self._drop_refs("used_at < ?", (cutoff,))
+        freed = removed = 0
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Names whose file was deleted from the upload folder by hand.
+                for name, digest in self._conn.execute("SELECT name, digest FROM names").fetchall():
+                    if not (self.view_dir / name).exists():
+                        self._conn.execute("DELETE FROM names WHERE name = ?", (name,))
+                        self._conn.execute("UPDATE blobs SET refs = refs - 1 WHERE digest = ?", (digest,))
+                for digest, size in self._conn.execute("SELECT digest, size FROM blobs WHERE refs <= 0").fetchall():
+                    _unlink_blob(self.blob_path(digest))
+                    self._conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+                    removed += 1
+                    freed += size
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        now = time.time()
+        for tmp in self.tmp_dir.iterdir():
+            try:
+                if now - tmp.stat().st_mtime > _TMP_MAX_AGE:
+                    tmp.unlink()
+            except OSError:
+                pass
+        return {"blobs": removed, "bytes": freed, "refs": expired}
+
+    def stats(self) -> dict:
+        with self._lock:
+            blobs, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+            names = self._conn.execute("SELECT COUNT(*) FROM names").fetchone()[0]
+            unused = self._conn.execute("SELECT COUNT(*) FROM blobs WHERE refs <= 0").fetchone()[0]
+        return {"blobs": blobs, "bytes": size, "names": names, "unreferenced": unused}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Kho tệp upload (khử trùng lặp theo nội dung).")
+    parser.add_argument("--root", default=str(UPLOAD_STORE_DIR), help="Thư mục kho blob")
+    parser.add_argument("--view-dir", default=str(UPLOAD_VIEW_DIR), help="Thư mục uploads/")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_gc = sub.add_parser("gc", help="Xoá blob không còn được tham chiếu")
+    p_gc.add_argument("--retention-days", type=float, default=float(os.getenv("UPLOAD_REF_RETENTION_DAYS", REF_RETENTION_DAYS)),
+                      help="Bỏ tham chiếu của chiến dịch cũ hơn số ngày này")
+    sub.add_parser("stats", help="Thống kê kho")
+    args = parser.parse_args()
+
+    store = UploadStore(args.root, args.view_dir)
+    try:
+        if args.cmd == "gc":
+            result = store.gc(args.retention_days)
+            print(f"Đã xoá {result['blobs']} blob ({result['bytes'] / (1024 * 1024):.1f} MB), bỏ {result['refs']} tham chiếu hết hạn")
+        s = store.stats()
+        print(f"{s['names']} tên, {s['blobs']} blob ({s['bytes'] / (1024 * 1024):.1f} MB), {s['unreferenced']} không còn tham chiếu")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()